@@ -0,0 +1,420 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+""" Long running agent that keeps warm SSH sessions for eapictl
+
+The eapictl agent keeps a pool of authenticated SSH sessions keyed by
+connection profile and accepts eapictl requests over a local UNIX socket.
+When the agent is running, the eapictl command hands its request to the
+agent so repeated operations against the same nodes skip the SSH key
+exchange, authentication and shell setup.
+
+Example:
+
+    # start the agent in the background
+    $ eapictl-agent &
+
+    # this request opens a new session and leaves it in the agent pool
+    $ eapictl status veos01
+
+    # this request reuses the pooled session
+    $ eapictl start veos01
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import SocketServer
+
+from eapictl.fleet import set_stack_size
+
+DEFAULT_AGENT_SOCKET = os.environ.get('EAPICTL_AGENT_SOCKET',
+                                      '~/.eapictl.sock')
+
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_CHECK_INTERVAL = 30
+
+
+class LocalRequest(Exception):
+    """ Raised by the runner when the request must run in the client
+    """
+
+
+class SessionPool(object):
+    """ Manages a pool of SSH sessions keyed by connection profile
+
+    A session is taken out of the pool while it is in use, so each session
+    is only ever used by one request at a time.  Sessions that are no longer
+    alive are closed instead of being handed out.
+
+    Attributes:
+        idle_timeout (int): The number of seconds a session may stay unused
+            in the pool before it is closed
+        sessions (dict): The pooled sessions as (session, last used) tuples
+
+    Args:
+        idle_timeout (int): The idle timeout value.  Default value is 300secs
+
+    """
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.sessions = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, factory):
+        """ Takes the session for key out of the pool
+
+        Args:
+            key (tuple): The key identifying the session
+            factory (callable): Creates a new session if no live session is
+                found in the pool
+
+        Returns:
+            Ssh: The session to use
+
+        """
+        with self._lock:
+            entry = self.sessions.pop(key, None)
+        if entry is not None:
+            session = entry[0]
+            if session.isalive():
+                return session
+            session.close()
+        return factory()
+
+    def release(self, key, session):
+        """ Returns the session to the pool
+
+        If another session was returned for the same key in the meantime,
+        the session is closed instead.
+
+        Args:
+            key (tuple): The key identifying the session
+            session (Ssh): The session to return to the pool
+
+        """
+        with self._lock:
+            if key not in self.sessions:
+                self.sessions[key] = (session, time.time())
+                return
+        session.close()
+
+    def evict(self, now=None):
+        """ Closes sessions that have been idle too long or are not alive
+
+        Args:
+            now (float): The current time.  Defaults to time.time()
+
+        Returns:
+            int: The number of sessions closed
+
+        """
+        now = now or time.time()
+        expired = list()
+        with self._lock:
+            for key, (session, used) in self.sessions.items():
+                if now - used > self.idle_timeout or not session.isalive():
+                    expired.append(self.sessions.pop(key)[0])
+        for session in expired:
+            session.close()
+        return len(expired)
+
+    def close(self):
+        """ Closes all of the sessions in the pool
+        """
+        with self._lock:
+            sessions = [entry[0] for entry in self.sessions.values()]
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+class AgentHandler(SocketServer.StreamRequestHandler):
+    """ Handles a single eapictl request received over the agent socket
+
+    Each request is one JSON line with the keys args (the eapictl command
+    line), cwd (the client working directory) and config (the eapi.conf
+    file found by the client).  Output lines are streamed back as they are
+    produced, each as a JSON line with the key line.  The response ends
+    with one JSON line with the keys retcode and output.  The retcode is
+    null if the client has to run the request itself.
+    """
+
+    def emit(self, line):
+        self.wfile.write(json.dumps(dict(line=line)) + '\n')
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            retcode, output = self.server.runner(request['args'],
+                                                 request.get('cwd'),
+                                                 self.emit,
+                                                 request.get('config'))
+        except LocalRequest as exc:
+            retcode, output = None, [str(exc)]
+        except SystemExit as exc:
+            retcode, output = 2, [str(exc.code or 'invalid request')]
+        except Exception as exc:    # pylint: disable=broad-except
+            retcode, output = 2, ['Error: %s' % exc]
+        response = dict(retcode=retcode, output=output)
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Serves eapictl requests over a local UNIX socket
+
+    Args:
+        path (str): The path of the UNIX socket to listen on
+        runner (callable): Called with the command line, working directory,
+            output line callback and eapi.conf path of each request.
+            Returns the retcode and output
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, runner):
+        SocketServer.UnixStreamServer.__init__(self, path, AgentHandler)
+        self.runner = runner
+
+
+def connect(path):
+    """ Connects to the agent UNIX socket
+
+    Args:
+        path (str): The path of the agent UNIX socket
+
+    Returns:
+        socket: The connected socket or None if no agent is listening
+
+    """
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def request(path, argv, cwd=None, emit=None, config=None):
+    """ Sends an eapictl request to the agent
+
+    Args:
+        path (str): The path of the agent UNIX socket
+        argv (list): The eapictl command line to run
+        cwd (str): The working directory used to resolve relative paths
+            in the command line.  Defaults to the current directory
+        emit (callable): Optional function called with each output line
+            streamed by the agent.  By default the lines are returned
+        config (str): The absolute path of the eapi.conf file the client
+            would load, found with the client environment, or None
+
+    Returns:
+        tuple: The retcode and the list of output lines or None if no agent
+            is listening on the socket or the agent would load another
+            eapi.conf file
+
+    Raises:
+        IOError: If the agent closes the connection without a response
+
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+
+    output = list()
+    emit = emit or output.append
+    try:
+        message = dict(args=argv, cwd=cwd or os.getcwd(), config=config)
+        sock.sendall(json.dumps(message) + '\n')
+        stream = sock.makefile('rb')
+        while True:
+            response = stream.readline()
+            if not response:
+                raise IOError('eapictl agent closed the connection')
+            response = json.loads(response)
+            if 'line' not in response:
+                break
+            emit(response['line'])
+    finally:
+        sock.close()
+
+    if response['retcode'] is None:
+        return None
+    return response['retcode'], output + response['output']
+
+def make_runner(sessions):
+    """ Returns the function used by the agent to run eapictl requests
+
+    Args:
+        sessions (SessionPool): The pool of sessions shared by all requests
+
+    Returns:
+        callable: The runner for AgentServer
+
+    """
+    from eapictl import app
+    from eapictl import config as eapiconf
+    from eapictl.fleet import CircuitBreaker
+
+    # the circuit breaker outlives a single request so hosts that keep
+    # failing are not retried by every request
+    breakers = dict()
+
+    def runner(argv, cwd=None, emit=None, config=None):
+        args = app.parse_args(argv)
+        for key in ['config', 'inventory', 'resume', 'state_db']:
+            value = getattr(args, key)
+            if value and cwd:
+                setattr(args, key,
+                        os.path.join(cwd, os.path.expanduser(value)))
+
+        # the client found its eapi.conf file with its own environment, so
+        # the request runs in the client if the agent would load another
+        if config:
+            args.config = config
+        found = config_path(eapiconf.Config(args.config) if args.config
+                            else eapiconf.config)
+        if found != config:
+            raise LocalRequest('eapictl agent loads %s instead of %s'
+                               % (found, config))
+        key = (args.breaker_threshold, args.breaker_prefix)
+        breaker = breakers.get(key)
+        if breaker is None:
+            breaker = breakers.setdefault(key, CircuitBreaker(
+                args.breaker_threshold, prefix=args.breaker_prefix))
+        return app.run(args, sessions, emit, breaker)
+
+    return runner
+
+def config_path(conf):
+    """ Returns the absolute path of the eapi.conf file of the config
+
+    Args:
+        conf (Config): The eapi.conf file configuration
+
+    Returns:
+        str: The absolute path or None if no file is found
+
+    """
+    filename = conf.find()
+    return os.path.abspath(filename) if filename else None
+
+def check_sessions(sessions, interval=DEFAULT_CHECK_INTERVAL):
+    """ Periodically evicts idle and dead sessions from the pool
+
+    Args:
+        sessions (SessionPool): The pool of sessions to check
+        interval (int): The number of seconds between checks
+
+    """
+    while True:
+        time.sleep(interval)
+        sessions.evict()
+
+def parse_args(args):
+    """ Handles parsing of the eapictl-agent command line arguments
+
+    Args:
+        args (list): The list of arguments provided by the command line
+
+    Returns:
+        Namespace: An instance of Namespace generate by argparse
+    """
+    parser = argparse.ArgumentParser(prog='eapictl-agent')
+
+    parser.add_argument('--socket',
+                        default=DEFAULT_AGENT_SOCKET,
+                        help='Sets the path of the UNIX socket to listen on')
+
+    parser.add_argument('--idle-timeout',
+                        type=int,
+                        default=DEFAULT_IDLE_TIMEOUT,
+                        help='Sets the number of seconds an unused SSH '
+                             'session is kept open')
+
+    return parser.parse_args(args)
+
+def main(args=None):
+    """The eapictl-agent main routine
+
+    Args:
+        args (list): The list of command line args
+
+    Returns:
+        0: When the agent is stopped
+
+    """
+    args = parse_args(args)
+    path = os.path.expanduser(args.socket)
+
+    sock = connect(path)
+    if sock is not None:
+        sock.close()
+        sys.exit('eapictl-agent: error: agent already listening on %s' % path)
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    set_stack_size()
+    sessions = SessionPool(args.idle_timeout)
+
+    umask = os.umask(0o077)
+    try:
+        server = AgentServer(path, make_runner(sessions))
+    finally:
+        os.umask(umask)
+
+    checker = threading.Thread(target=check_sessions, args=(sessions,))
+    checker.daemon = True
+    checker.start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sessions.close()
+        os.unlink(path)
+
+    return 0
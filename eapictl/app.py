@@ -50,54 +50,341 @@ Example:
     # override the conf file settings
     $ eapictl enable veos01 --username sshuser --password sshpassword
 
+    # start eAPI on all nodes matching a connection profile glob
+    $ eapictl start 'veos*' --parallel 20
+
+    # report the last known state of all nodes without connecting
+    $ eapictl state
+
 """
+import os
 import re
+import sys
 import socket
 import argparse
 import json
 import time
-
-from StringIO import StringIO
-
-import paramiko
-
-import pyeapi
-
-from pyeapi.client import DEFAULT_TRANSPORT
+import copy
+import random
+import binascii
+import threading
+
+from contextlib import contextmanager
+
+from eapictl import agent
+from eapictl import config as eapiconf
+from eapictl.metrics import Metrics
+from eapictl.fleet import DEFAULT_PARALLEL, DEFAULT_MAX_HANDSHAKES
+from eapictl.fleet import DEFAULT_BREAKER_THRESHOLD, DEFAULT_BREAKER_PREFIX
+from eapictl.fleet import isselector, load_inventory, select_targets
+from eapictl.fleet import handshake_limiter, run_fleet, fleet_retcode
+from eapictl.fleet import CircuitBreaker, set_stack_size
+from eapictl.rollout import DEFAULT_MAX_FAILURES, batch_count, run_rollout
+from eapictl.scan import DEFAULT_SCAN_TIMEOUT, UNREACHABLE, SSH_ONLY
+from eapictl.scan import EAPI_LISTENING, classify
+from eapictl.state import DEFAULT_MAX_AGE, DEFAULT_STATE_FILE, open_store
+from eapictl.verify import DEFAULT_VERIFY_REQUESTS, EapiClient, verify_eapi
 
 DEFAULT_SSH_PORT = 22
 DEFAULT_SSH_USERNAME = 'admin'
 DEFAULT_SSH_PASSWORD = ''
 
+DEFAULT_TRANSPORT = 'https'
+
 DEFAULT_HTTP_PORT = '80'
 DEFAULT_HTTPS_PORT = '443'
 
 DEFAULT_POLL_TIMEOUT = 10
 DEFAULT_CONNECTION_TIMEOUT = 10
+DEFAULT_PROBE_TIMEOUT = 1
+DEFAULT_STATUS_TTL = 5
+DEFAULT_CONNECT_RETRIES = 2
+
+# sshd limits the number of sessions multiplexed over one connection, the
+# OpenSSH default is 10
+DEFAULT_MAX_CHANNELS = 4
+
+TRUE_VALUES = ['yes', 'true', 'on', '1']
+
+POLL_TIMEOUT_ERROR = 'poll timeout expired before eAPI operation completed'
+
+# The eapi.conf configuration is global so loading it and reading profiles
+# is serialized when requests are run concurrently by the agent
+CONFIG_LOCK = threading.Lock()
+
+POLL_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 2
+
+RETRY_INTERVAL = 0.5
+RETRY_MAX_INTERVAL = 4
 
 PROMPT_RE = [
     re.compile(r"[\r\n]?[\w+\-\.:\/]+(?:\([^\)]+\)){,3}(?:>|#) ?$"),
     re.compile(r"\[\w+\@[\w\-\.]+(?: [^\]])\] ?[>#\$] ?$")
 ]
 
+# All known prompts combined into a single pattern so each check is a
+# single regex pass
+PROMPT_PATTERN = re.compile('|'.join('(?:%s)' % r.pattern for r in PROMPT_RE))
+
+# The anchored prompt pattern built once the node hostname is learned
+LEARNED_PROMPT = r"[\r\n]?%s(?:\([^\)]+\)){,3}(?:>|#) ?$"
+
+# The prompt pattern used to find prompts within pipelined output
+BOUNDARY_PROMPT = r"[\r\n]%s(?:\([^\)]+\)){,3}(?:>|#) ?"
+HOSTNAME_RE = re.compile(r"([\w+\-\.:\/]+)(?:\([^\)]+\)){,3}(?:>|#) ?$")
 
-def connect_ssh(hostname, username, password):
+# Prompts are only searched for in the tail of the received output
+PROMPT_WINDOW = 256
+
+# The CLI modes tracked from the prompt.  Configuration submodes are named
+# after the prompt, such as config-mgmt-api-http-cmds
+EXEC_MODE = 'exec'
+PRIVILEGED_MODE = 'enable'
+CONFIG_MODE = 'config'
+
+MODE_RE = re.compile(r"(?:\(([^\)]+)\))?(>|#) ?$")
+
+STATUS_COMMAND = 'show management api http-commands'
+JSON_PIPE = ' | json'
+
+STATUS_RE = re.compile(r"^(Enabled|HTTPS server|HTTP server|Local HTTP server|"
+                       r"Unix Socket server|VRFs?):[ \t]*(.*?)\s*$", re.M)
+PORT_RE = re.compile(r"port (\d+)")
+
+STATUS_KEYS = {
+    'HTTP server': 'http',
+    'HTTPS server': 'https',
+    'Local HTTP server': 'local_http',
+    'Unix Socket server': 'unix_socket'
+}
+
+STATUS_TEMPLATE = dict(enabled=False, http=None, http_port=None, https=None,
+                       https_port=None, local_http=None, local_http_port=None,
+                       unix_socket=None, vrfs=None)
+
+CONFIG_COMMAND = 'show running-config all | section management api ' \
+                 'http-commands'
+
+PROTOCOL_CONFIG_RE = re.compile(r"^ {3}(no )?protocol (https?)(?: port (\d+))?"
+                                r"\s*$", re.M)
+SHUTDOWN_CONFIG_RE = re.compile(r"^ {3}(no )?shutdown\s*$", re.M)
+
+MIN_READ_SIZE = 4096
+MAX_READ_SIZE = 65536
+
+# Configuration lines that leave the eAPI protocol and port untouched, so
+# sending them over eAPI cannot cut the connection before they are applied
+EAPI_SAFE_CONFIG = ['management api http-commands', 'shutdown', 'no shutdown']
+
+ERROR_RE = re.compile(r"^% (?:Invalid input|Incomplete command|"
+                      r"Ambiguous command|Unrecognized command).*$", re.M)
+
+class CommandError(IOError):
+    """ Raised when the node rejects a command
+
+    Attributes:
+        hostname (str): The hostname of the destination node
+        command (str): The command rejected by the node
+        output (str): The response received for the command
+
+    """
+
+    def __init__(self, hostname, command, output):
+        match = ERROR_RE.search(output)
+        message = match.group(0).strip() if match else 'command failed'
+        IOError.__init__(self, 'Command "%s" failed on host %s: %s'
+                         % (command, hostname, message))
+        self.hostname = hostname
+        self.command = command
+        self.output = output
+
+
+def check_responses(hostname, commands, responses):
+    """ Raises CommandError for the first response reporting an error
+
+    Args:
+        hostname (str): The hostname of the destination node
+        commands (list): The list of commands sent
+        responses (list): The list of responses, one per command
+
+    Raises:
+        CommandError: If the node rejected any of the commands
+
+    """
+    for command, response in zip(commands, responses):
+        if ERROR_RE.search(response):
+            raise CommandError(hostname, command, response)
+
+def format_timer(seconds):
+    """ Returns the seconds as the hh:mm:ss value of a commit timer
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%02d:%02d:%02d' % (hours, minutes, seconds)
+
+def time_left(deadline, hostname):
+    """ Returns the number of seconds left before the deadline
+
+    Args:
+        deadline (float): The deadline as a time.time() value or None
+        hostname (str): The host the deadline applies to
+
+    Returns:
+        float: The seconds left or None if there is no deadline
+
+    Raises:
+        IOError: If the deadline has expired
+
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise IOError('Deadline expired for host %s' % hostname)
+    return left
+
+def timeout_for(timeout, deadline, hostname):
+    """ Returns the timeout bounded by the time left before the deadline
+
+    Args:
+        timeout (float): The timeout value or None for no timeout
+        deadline (float): The deadline as a time.time() value or None
+        hostname (str): The host the deadline applies to
+
+    Returns:
+        float: The smaller of the timeout and the time left
+
+    Raises:
+        IOError: If the deadline has expired
+
+    """
+    left = time_left(deadline, hostname)
+    if timeout is None or left is None:
+        return left if timeout is None else float(timeout)
+    return min(float(timeout), left)
+
+def backoff(attempt, interval=RETRY_INTERVAL, max_interval=RETRY_MAX_INTERVAL):
+    """ Returns the jittered delay before the next retry
+
+    The delay doubles with each attempt up to max_interval and is randomly
+    spread by +/- 50% so that retries of many nodes do not synchronize.
+
+    Args:
+        attempt (int): The number of attempts already made
+        interval (float): The delay after the first attempt
+        max_interval (float): The maximum delay before jitter
+
+    Returns:
+        float: The number of seconds to wait
+
+    """
+    delay = min(interval * 2 ** max(0, attempt - 1), max_interval)
+    return delay * random.uniform(0.5, 1.5)
+
+def connect_ssh(hostname, username, password, handshakes=None,
+                port=DEFAULT_SSH_PORT, metrics=None,
+                timeout=DEFAULT_CONNECTION_TIMEOUT, deadline=None,
+                retries=0, breaker=None):
     """ Creates the SSH connection to the specified host
 
+    The TCP connect, SSH banner, key exchange and authentication must all
+    complete within timeout seconds and before the deadline.  A watchdog
+    closes the socket if they do not, so a black-holed host never blocks
+    for the operating system TCP timeout.  Transient failures are retried
+    with jittered backoff while time is left.  Authentication failures are
+    never retried.
+
     Args:
         hostname (str): The IP address or fully qualified domain name of the
             destination node to connect to
         username (str): The username used to authenticate the SSH connection
         password (str): The password used to authenticate the SSH connection
+        handshakes (Semaphore): Optional semaphore used to cap the number
+            of SSH handshakes in progress at the same time
+        port (int): The SSH port to connect to.  Default value is 22
+        metrics (Metrics): Optional Metrics instance to record the TCP
+            connect and SSH handshake spans
+        timeout (float): The number of seconds allowed to set up the
+            connection, including retries.  Default value is 10secs
+        deadline (float): Optional time.time() value the connection must be
+            set up by
+        retries (int): The number of times a transient failure is retried
+        breaker (CircuitBreaker): Optional circuit breaker shared between
+            nodes.  No attempt, including retries, is made while the circuit
+            of the host domain is open.  A host that cannot be connected is
+            recorded as one failure
 
     Returns:
         SSHClient: An instance of paramiko.SSHClient
 
+    Raises:
+        IOError: If the deadline expires or the circuit for the host is open
+
     """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname, username=username, password=password)
-    return ssh
+    # paramiko is imported here to keep it off the start-up path of
+    # commands that never open a connection
+    import paramiko
+
+    metrics = metrics if metrics is not None else Metrics()
+    if timeout is not None:
+        limit = time.time() + float(timeout)
+        deadline = limit if deadline is None else min(deadline, limit)
+
+    def connect():
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with metrics.span('tcp_connect'):
+            sock = socket.create_connection(
+                (hostname, int(port)), time_left(deadline, hostname))
+
+        left = time_left(deadline, hostname)
+        watchdog = None
+        if left is not None:
+            watchdog = threading.Timer(left, sock.close)
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            with metrics.span('ssh_handshake'):
+                ssh.connect(hostname, port=int(port), username=username,
+                            password=password, sock=sock, timeout=left,
+                            banner_timeout=left, auth_timeout=left)
+        except Exception:
+            ssh.close()
+            sock.close()
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+        return ssh
+
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow(hostname):
+            raise IOError('Circuit open for host %s' % hostname)
+        attempt += 1
+        try:
+            if handshakes is None:
+                ssh = connect()
+            else:
+                with handshakes:
+                    ssh = connect()
+        except paramiko.AuthenticationException:
+            raise
+        except (socket.error, EOFError, paramiko.SSHException):
+            delay = backoff(attempt)
+            left = time_left(deadline, hostname)
+            if attempt > retries or (left is not None and delay >= left):
+                if breaker is not None:
+                    breaker.failure(hostname)
+                raise
+            metrics.incr('connect_retries')
+            time.sleep(delay)
+            continue
+
+        if breaker is not None:
+            breaker.success(hostname)
+        return ssh
 
 def check_prompt(string):
     """ Checks the specified string against known EOS prompts
@@ -109,10 +396,249 @@ def check_prompt(string):
         True: If the string includes a valid EOS prompt
 
     """
-    for regex in PROMPT_RE:
-        match = regex.search(string)
+    if PROMPT_PATTERN.search(string):
+        return True
+
+def prompt_mode(output):
+    """ Returns the CLI mode shown by the prompt at the end of the output
+
+    Args:
+        output (str): Output received from the node ending with a prompt
+
+    Returns:
+        str: EXEC_MODE, PRIVILEGED_MODE or the configuration mode shown in
+            the prompt, such as config.  None if the output does not end
+            with an EOS style prompt
+
+    """
+    match = MODE_RE.search(output[-PROMPT_WINDOW:])
+    if not match:
+        return None
+    elif match.group(2) == '>':
+        return EXEC_MODE
+    return match.group(1) or PRIVILEGED_MODE
+
+def strip_echo(chunks):
+    """ Drops the echoed command line from the start of the output chunks
+
+    Args:
+        chunks (iterable): The chunks of output received from the shell
+
+    Yields:
+        str: The chunks of output following the first line
+
+    """
+    echo = True
+    for chunk in chunks:
+        if echo:
+            index = chunk.find('\n')
+            if index < 0:
+                continue
+            chunk, echo = chunk[index + 1:], False
+        if chunk:
+            yield chunk
+
+def iter_lines(chunks):
+    """ Splits the output chunks into lines
+
+    Lines split across chunks are joined and the line endings are removed.
+
+    Args:
+        chunks (iterable): The chunks of output
+
+    Yields:
+        str: The lines of output
+
+    """
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if partial:
+        yield partial.rstrip('\r')
+
+class ResponseReader(object):
+    """ Reads command responses from the SSH shell channel
+
+    The ResponseReader accumulates the output received from the channel
+    until a prompt is found at the end of the output.  Reads start at
+    MIN_READ_SIZE bytes and double each time a read fills the buffer, up to
+    MAX_READ_SIZE.  Only the last PROMPT_WINDOW characters of the output are
+    checked for a prompt, which also finds prompts split across reads.
+
+    Attributes:
+        channel: The SSH shell channel to read from
+        hostname (str): The hostname of the destination node
+        prompt: The compiled regular expression used to find the prompt
+        boundary: The compiled regular expression used to find prompts in
+            pipelined output.  This is None until the prompt is learned
+        read_size (int): The number of bytes requested by the next read
+        metrics (Metrics): Records the recv calls, bytes received and
+            prompt checks
+        timeout (float): The timeout value of each read
+        deadline (float): Optional time.time() value reads must complete
+            by.  Each read waits for at most the time left
+        mode (str): The CLI mode shown by the last prompt received or None
+            if unknown
+
+    Args:
+        channel: The SSH shell channel to read from
+        hostname (str): The hostname of the destination node
+        metrics (Metrics): Optional Metrics instance to record into
+
+    """
+
+    def __init__(self, channel, hostname, metrics=None):
+        self.channel = channel
+        self.hostname = hostname
+        self.prompt = PROMPT_PATTERN
+        self.boundary = None
+        self.read_size = MIN_READ_SIZE
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.timeout = None
+        self.deadline = None
+        self.mode = None
+
+    def learn(self, output):
+        """ Anchors the prompt pattern on the prompt found in output
+
+        Once learned, only prompts that start with the node hostname are
+        matched.  If the output does not end with an EOS style prompt the
+        combined prompt pattern remains in use.
+
+        Args:
+            output (str): Output received from the node ending with a prompt
+
+        """
+        match = HOSTNAME_RE.search(output[-PROMPT_WINDOW:])
         if match:
-            return True
+            hostname = re.escape(match.group(1))
+            self.prompt = re.compile(LEARNED_PROMPT % hostname)
+            self.boundary = re.compile(BOUNDARY_PROMPT % hostname)
+
+    def recv(self):
+        """ Receives the next chunk of output from the channel
+
+        Returns:
+            str: The output received from the channel
+
+        Raises:
+            IOError: If the channel times out or is closed or the deadline
+                expires
+
+        """
+        if self.deadline is not None:
+            self.channel.settimeout(timeout_for(self.timeout, self.deadline,
+                                                self.hostname))
+        try:
+            chunk = self.channel.recv(self.read_size)
+        except socket.timeout:
+            raise IOError('Socket timeout for host %s' % self.hostname)
+
+        if not chunk:
+            raise IOError('Connection closed by host %s' % self.hostname)
+
+        self.metrics.incr('recv_calls')
+        self.metrics.incr('bytes_received', len(chunk))
+
+        if len(chunk) == self.read_size:
+            self.read_size = min(self.read_size * 2, MAX_READ_SIZE)
+
+        return chunk
+
+    def read(self):
+        """ Reads from the channel until the prompt is received
+
+        Returns:
+            str: The output received including the trailing prompt
+
+        Raises:
+            IOError: If the channel times out or is closed before the prompt
+                is received
+
+        """
+        chunks = list()
+        tail = ''
+
+        while True:
+            chunk = self.recv()
+            chunks.append(chunk)
+            tail = (tail + chunk)[-PROMPT_WINDOW:]
+            self.metrics.incr('prompt_checks')
+            if self.prompt.search(tail):
+                self.mode = prompt_mode(tail)
+                return ''.join(chunks)
+
+    def stream(self):
+        """ Yields the output received from the channel until the prompt
+
+        The last PROMPT_WINDOW characters received are held back until more
+        output arrives, so no part of the prompt is yielded even when it is
+        split across reads and the memory used does not grow with the size
+        of the output.
+
+        Yields:
+            str: The chunks of output, without the trailing prompt
+
+        Raises:
+            IOError: If the channel times out or is closed before the prompt
+                is received
+
+        """
+        pending = ''
+
+        while True:
+            pending += self.recv()
+            self.metrics.incr('prompt_checks')
+            if self.prompt.search(pending[-PROMPT_WINDOW:]):
+                self.mode = prompt_mode(pending)
+                # the prompt is the last line of the output
+                output = pending[:pending.rfind('\n') + 1]
+                if output:
+                    yield output
+                return
+            if len(pending) > PROMPT_WINDOW:
+                yield pending[:-PROMPT_WINDOW]
+                pending = pending[-PROMPT_WINDOW:]
+
+    def read_batch(self, count):
+        """ Reads the responses for a batch of pipelined commands
+
+        The output is split into one response per command by counting the
+        prompts received.  Each response ends with the prompt that follows
+        the command output.
+
+        Args:
+            count (int): The number of commands sent in the batch
+
+        Returns:
+            list: The list of responses, one per command
+
+        Raises:
+            IOError: If the channel times out or is closed before all of
+                the prompts are received
+
+        """
+        responses = list()
+        output = ''
+        start = 0
+        offset = 0
+
+        while len(responses) < count:
+            output += self.recv()
+            self.metrics.incr('prompt_checks')
+            for match in self.boundary.finditer(output, offset):
+                responses.append(output[start:match.end()])
+                start = match.end()
+                if len(responses) == count:
+                    break
+            offset = max(start, len(output) - PROMPT_WINDOW)
+
+        if responses:
+            self.mode = prompt_mode(responses[-1])
+        return responses
 
 class Ssh(object):
     """ Manages the SSH connection to a remote node
@@ -125,62 +651,622 @@ class Ssh(object):
         hostname (str): The hostname of the destination node
         ssh (SSHClient): An instance of paramiko.SSHClient
         timeout (int): The timeout value for connecting to the remote node
+            and for each read from the channel
+        deadline (float): Optional time.time() value the current operation
+            must complete by.  Connecting, opening the shell and every read
+            wait for at most the time left
         channel: The SSH shell channel invoked over the SSH transport
+        reader (ResponseReader): The reader for responses from the channel
+        pipeline (bool): Sends command batches in a single write when True
+        metrics (Metrics): Records the timing spans and I/O counters
+        max_channels (int): The maximum number of channels open at the same
+            time over the SSH transport
+        mode (str): The CLI mode of the shell parsed from the last prompt
+
+    The CLI mode is tracked from the prompts received, so enable and
+    configure are only sent when the shell is not already in the mode the
+    commands need.  Configuration commands leave the shell in configuration
+    mode, where EOS also accepts show commands.
+
+    Additional sessions sharing the authenticated SSH transport are opened
+    with the session method.  Each one uses its own channel so commands
+    sent through them run concurrently with the commands of this session.
 
     Args:
         hostname (str): The hostanem of the destination node
         username (str): The username to authenticate the SSH session
         password (str): The password to authenticate the SSH session
         timeout (int): The connection timeout value.  Default value is 10secs
+        handshakes (Semaphore): Optional semaphore shared between sessions
+            to cap the number of concurrent SSH handshakes
+        pipeline (bool): Writes each batch of commands to the channel at
+            once instead of waiting for the prompt after each command
+        port (int): The SSH port to connect to.  Default value is 22
+        metrics (Metrics): Optional Metrics instance to record into
+        max_channels (int): The maximum number of concurrently open
+            channels.  Default value is 4
+        deadline (float): Optional deadline of the first operation
+        retries (int): The number of times a transient connection failure
+            is retried.  Default value is 2
+        breaker (CircuitBreaker): Optional circuit breaker shared between
+            sessions
     """
 
-    def __init__(self, hostname, username, password, timeout=10):
+    def __init__(self, hostname, username, password, timeout=10,
+                 handshakes=None, pipeline=False, port=DEFAULT_SSH_PORT,
+                 metrics=None, max_channels=DEFAULT_MAX_CHANNELS,
+                 deadline=None, retries=DEFAULT_CONNECT_RETRIES,
+                 breaker=None):
         self.hostname = hostname
-        self.ssh = connect_ssh(hostname, username, password)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.ssh = connect_ssh(hostname, username, password, handshakes,
+                               port, self.metrics, timeout, deadline,
+                               retries, breaker)
 
         self.timeout = timeout
+        self._deadline = deadline
         self.channel = None
+        self.reader = None
+        self.pipeline = pipeline
+        self.max_channels = max(1, max_channels)
+        self._slots = threading.BoundedSemaphore(self.max_channels)
+        self._parent = None
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, value):
+        self._deadline = value
+        if self.reader is not None:
+            self.reader.deadline = value
 
     @property
     def shell(self):
         if self.channel is None:
-            self.channel = self.ssh.invoke_shell()
-            self.channel.settimeout(self.timeout)
+            with self.metrics.span('shell'):
+                self._slots.acquire()
+                try:
+                    channel = self.ssh.invoke_shell()
+                    channel.settimeout(timeout_for(self.timeout,
+                                                   self.deadline,
+                                                   self.hostname))
+                    self.reader = ResponseReader(channel, self.hostname,
+                                                 self.metrics)
+                    self.reader.timeout = self.timeout
+                    self.reader.deadline = self.deadline
+                    self.reader.learn(self.reader.read())
+                except Exception:
+                    self._slots.release()
+                    raise
+                self.channel = channel
         return self.channel
 
-    def send(self, command):
-        command += '\n'
-        self.shell.sendall(str(command))
+    def write(self, data):
+        """ Writes data to the shell channel
 
-        cache = StringIO()
-        response = ''
+        Args:
+            data (str): The data to write
 
-        while True:
+        """
+        self.shell.sendall(str(data))
+        self.metrics.incr('bytes_sent', len(data))
+
+    def send(self, command):
+        with self.metrics.span('command'):
+            self.write(command + '\n')
+            self.metrics.incr('commands')
+            return self.reader.read()
+
+    def stream(self, command, lines=True, enable=False):
+        """ Sends the command and yields its output as it is received
+
+        The output is yielded without the echoed command and the trailing
+        prompt, so large outputs such as show running-config are processed
+        with constant memory.  Closing the generator before the prompt is
+        received reads and discards the rest of the output, which keeps the
+        session usable.
+
+        Args:
+            command (str): The command to send
+            lines (bool): Yields the lines of output without line endings
+                when True, otherwise the raw chunks read from the channel
+            enable (bool): Enters the privileged mode before sending the
+                command
+
+        Yields:
+            str: The lines or chunks of output
+
+        Raises:
+            IOError: If the channel times out or is closed before the prompt
+                is received
+
+        """
+        if enable:
+            for prefix in self.mode_commands(PRIVILEGED_MODE):
+                self.send(prefix)
+        with self.metrics.span('command'):
+            self.write(command + '\n')
+            self.metrics.incr('commands')
+            chunks = self.reader.stream()
             try:
-                response = self.shell.recv(200)
-            except socket.timeout:
-                raise IOError('Socket timeout for host %s' % self.hostname)
+                output = strip_echo(chunks)
+                for item in iter_lines(output) if lines else output:
+                    yield item
+            finally:
+                for _ in chunks:
+                    pass
 
-            cache.write(response)
-            if check_prompt(response):
-                return cache.getvalue()
+    def send_batch(self, commands):
+        """ Sends the commands in a single write and reads all responses
+
+        Args:
+            commands (list): The list of commands to send
+
+        Returns:
+            list: The list of responses, one per command
+
+        Raises:
+            CommandError: If the node rejects any of the commands
+
+        """
+        with self.metrics.span('batch'):
+            self.write(''.join('%s\n' % c for c in commands))
+            self.metrics.incr('commands', len(commands))
+            responses = self.reader.read_batch(len(commands))
+        check_responses(self.hostname, commands, responses)
+        return responses
 
     def sendall(self, commands):
+        if self.pipeline and len(commands) > 1:
+            # opening the shell learns the prompt needed to split responses
+            assert self.shell is not None
+            if self.reader.boundary is not None:
+                return self.send_batch(commands)
         return [self.send(c) for c in commands]
 
+    @property
+    def mode(self):
+        assert self.shell is not None
+        return self.reader.mode
+
+    def mode_commands(self, mode):
+        """ Returns the commands that move the shell to the CLI mode
+
+        Args:
+            mode (str): The mode to move to, PRIVILEGED_MODE or CONFIG_MODE
+
+        Returns:
+            list: The commands to send, empty if the shell is already in the
+                mode.  Configuration submodes count as configuration mode
+
+        """
+        current = self.mode or EXEC_MODE
+        if current.startswith(CONFIG_MODE):
+            return list()
+        commands = list()
+        if current == EXEC_MODE:
+            commands.append('enable')
+        if mode == CONFIG_MODE:
+            commands.append('configure')
+        return commands
+
     def send_enable(self, commands):
-        commands.insert(0, 'enable')
-        response = self.sendall(commands)
-        return response
+        """ Sends the commands in privileged mode
+
+        Args:
+            commands (list): The list of commands to send.  The list is not
+                modified
+
+        Returns:
+            list: The list of responses, one per command
+
+        """
+        prefix = self.mode_commands(PRIVILEGED_MODE)
+        return self.sendall(prefix + list(commands))[len(prefix):]
 
     def send_config(self, commands):
-        commands.insert(0, 'configure')
-        response = self.send_enable(commands)
-        self.send('enable 0')
-        return response
+        """ Sends the commands in configuration mode
+
+        The shell is left in configuration mode.
+
+        Args:
+            commands (list): The list of commands to send.  The list is not
+                modified
+
+        Returns:
+            list: The list of responses, one per command
+
+        """
+        prefix = self.mode_commands(CONFIG_MODE)
+        return self.sendall(prefix + list(commands))[len(prefix):]
+
+    def send_session(self, commands, timer=None):
+        """ Sends the commands in a configuration session and commits it
+
+        The commands are staged in a new configure session and applied by a
+        single commit, so the node either takes all of them or none.  The
+        session is aborted if the node rejects any of the commands.  With a
+        commit timer, the node restores the previous configuration unless
+        the commit is confirmed with confirm_session before the timer ends.
+
+        Args:
+            commands (list): The list of configuration commands to stage
+            timer (int): The commit timer in seconds or None to commit
+                without a timer
+
+        Returns:
+            str: The name of the committed session
+
+        Raises:
+            CommandError: If the node rejects any of the commands
+
+        """
+        name = 'eapictl-%s' % binascii.hexlify(os.urandom(4))
+        if self.mode and self.mode.startswith(CONFIG_MODE):
+            prefix = ['end']
+        else:
+            prefix = self.mode_commands(PRIVILEGED_MODE)
+        staged = ['configure session %s' % name] + list(commands) + ['end']
+        try:
+            responses = self.sendall(prefix + staged)
+            check_responses(self.hostname, staged, responses[len(prefix):])
+        except CommandError:
+            self.send_enable(['configure session %s abort' % name])
+            raise
+
+        commit = 'configure session %s commit' % name
+        if timer:
+            commit += ' timer %s' % format_timer(timer)
+        check_responses(self.hostname, [commit], self.send_enable([commit]))
+        return name
+
+    def confirm_session(self, name):
+        """ Confirms a session committed with a commit timer
+
+        Args:
+            name (str): The name returned by send_session
+
+        Raises:
+            CommandError: If the node rejects the confirmation, usually
+                because the commit timer has already expired
+
+        """
+        commit = 'configure session %s commit' % name
+        check_responses(self.hostname, [commit], self.send_enable([commit]))
+
+    def isalive(self):
+        """ Checks if the SSH session can still be used
+
+        Returns:
+            bool: True if the transport and the shell channel are open
+
+        """
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        return self.channel is None or not self.channel.closed
+
+    def close_channel(self):
+        """ Closes the shell channel and frees its channel slot
+        """
+        if self.channel is not None:
+            channel, self.channel, self.reader = self.channel, None, None
+            channel.close()
+            self._slots.release()
 
     def close(self):
-        self.ssh.close()
+        """ Closes the session
+
+        A session opened with the session method only closes its own
+        channel.  Otherwise the SSH connection and all of its channels are
+        closed.
+        """
+        if self._parent is not None:
+            self.close_channel()
+        else:
+            self.ssh.close()
+
+    @contextmanager
+    def session(self):
+        """ Opens another session over the same SSH transport
+
+        The new session uses its own channel and can be used from another
+        thread while this session is busy.  It counts against max_channels
+        while its channel is open, so opening a channel blocks while the
+        limit is reached.  The channel is closed when the block exits.
+
+        Yields:
+            Ssh: The session sharing the transport of this session
+
+        """
+        child = copy.copy(self)
+        child.channel = None
+        child.reader = None
+        child._parent = self
+        try:
+            yield child
+        finally:
+            child.close()
+
+    def parallel(self, *tasks):
+        """ Runs the tasks concurrently, each with its own session
+
+        Each task is called with an Ssh session opened with the session
+        method, so the tasks share the SSH transport but not a channel.
+
+        Args:
+            tasks (callable): The functions to run.  Each one is called
+                with a session as its only argument
+
+        Returns:
+            list: The return values of the tasks in the same order
+
+        Raises:
+            Exception: The first exception raised by a task is re-raised
+                once all of the tasks have completed
+
+        """
+        results = [None] * len(tasks)
+        errors = [None] * len(tasks)
+
+        def work(index, task):
+            try:
+                with self.session() as session:
+                    results[index] = task(session)
+            except Exception:   # pylint: disable=broad-except
+                errors[index] = sys.exc_info()
+
+        threads = [threading.Thread(target=work, args=(index, task))
+                   for index, task in enumerate(tasks)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error[0], error[1], error[2]
+        return results
+
+class SshExec(Ssh):
+    """ Manages the SSH connection using non-interactive exec channels
+
+    The SshExec class provides the same interface as Ssh but runs each batch
+    of commands in a new exec channel instead of an interactive shell.  The
+    end of the output is signalled by the channel closing, so no prompt
+    matching, echo or pagination is involved.  EOS does not delimit the
+    output of the individual commands in a batch, so the whole output is
+    returned as the response of the last command and empty responses are
+    returned for the commands before it.
+
+    Args:
+        hostname (str): The hostname of the destination node
+        username (str): The username to authenticate the SSH session
+        password (str): The password to authenticate the SSH session
+        timeout (int): The connection timeout value.  Default value is 10secs
+        handshakes (Semaphore): Optional semaphore shared between sessions
+            to cap the number of concurrent SSH handshakes
+        pipeline (bool): Ignored.  Batches are always sent at once
+        port (int): The SSH port to connect to.  Default value is 22
+        metrics (Metrics): Optional Metrics instance to record into
+        max_channels (int): The maximum number of exec channels open at the
+            same time.  Default value is 4
+        deadline (float): Optional deadline of the first operation
+        retries (int): The number of times a transient connection failure
+            is retried.  Default value is 2
+        breaker (CircuitBreaker): Optional circuit breaker shared between
+            sessions
+    """
+
+    def execute(self, commands):
+        """ Runs the commands in a single exec channel
+
+        Args:
+            commands (list): The list of commands to run
+
+        Returns:
+            str: The combined output of the commands
+
+        Raises:
+            CommandError: If the node rejects any of the commands
+            IOError: If the channel times out
+
+        """
+        chunks = list()
+        failed = False
+        with self.metrics.span('batch'):
+            try:
+                for chunk in self.iter_exec(commands):
+                    chunks.append(chunk)
+            except CommandError:
+                failed = True
+
+        output = ''.join(chunks)
+        if failed or ERROR_RE.search(output):
+            raise CommandError(self.hostname, '; '.join(commands), output)
+        return output
+
+    def iter_exec(self, commands):
+        """ Runs the commands in a single exec channel and yields the output
+
+        The channel and its slot are released once the output is consumed
+        or the generator is closed.
+
+        Args:
+            commands (list): The list of commands to run
+
+        Yields:
+            str: The chunks of output as they are received
+
+        Raises:
+            CommandError: If the commands exit with a non-zero status once
+                the output is consumed.  The error holds the last
+                PROMPT_WINDOW characters of output
+            IOError: If the channel times out
+
+        """
+        self._slots.acquire()
+        try:
+            channel = self.ssh.get_transport().open_session()
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            self.metrics.incr('commands', len(commands))
+            channel.settimeout(timeout_for(self.timeout, self.deadline,
+                                           self.hostname))
+            channel.set_combine_stderr(True)
+            command = '\n'.join(commands)
+            channel.exec_command(str(command))
+            self.metrics.incr('bytes_sent', len(command))
+
+            tail = ''
+            while True:
+                if self.deadline is not None:
+                    channel.settimeout(timeout_for(self.timeout,
+                                                   self.deadline,
+                                                   self.hostname))
+                try:
+                    chunk = channel.recv(MAX_READ_SIZE)
+                except socket.timeout:
+                    raise IOError('Socket timeout for host %s'
+                                  % self.hostname)
+                self.metrics.incr('recv_calls')
+                if not chunk:
+                    break
+                self.metrics.incr('bytes_received', len(chunk))
+                tail = (tail + chunk)[-PROMPT_WINDOW:]
+                yield chunk
+
+            if channel.recv_exit_status() != 0:
+                raise CommandError(self.hostname, '; '.join(commands), tail)
+        finally:
+            channel.close()
+            self._slots.release()
+
+    def stream(self, command, lines=True, enable=False):
+        with self.metrics.span('command'):
+            commands = ['enable', command] if enable else [command]
+            output = self.iter_exec(commands)
+            try:
+                for item in iter_lines(output) if lines else output:
+                    yield item
+            finally:
+                output.close()
+
+    @property
+    def mode(self):
+        # every exec channel starts in the unprivileged exec mode
+        return EXEC_MODE
+
+    def send(self, command):
+        return self.execute([command])
+
+    def sendall(self, commands):
+        if not commands:
+            return list()
+        output = self.execute(commands)
+        return [''] * (len(commands) - 1) + [output]
+
+class EapiBackend(object):
+    """ Sends the commands of Eapi as eAPI requests with SSH as fallback
+
+    The EapiBackend provides the send_enable and send_config methods of Ssh
+    used by Eapi.  While eAPI answers, the commands are sent as a single
+    eAPI request over the keep-alive connection of the client, which avoids
+    the SSH handshake, the shell and the prompt matching.  Once a request
+    fails to reach the node, and for configuration lines that would change
+    the eAPI protocol or port, the commands are sent over SSH instead.  The
+    SSH session is only connected when first needed.
+
+    Attributes:
+        client (EapiClient): The eAPI client or None once eAPI has failed
+        hostname (str): The hostname of the destination node
+        metrics (Metrics): Records the eAPI requests and fallbacks
+
+    Args:
+        client (EapiClient): The eAPI client connected to the node
+        connect (callable): Returns the Ssh session to fall back to
+        hostname (str): The hostname of the destination node
+        metrics (Metrics): Optional Metrics instance to record into
+
+    """
+
+    def __init__(self, client, connect, hostname, metrics=None):
+        self.client = client
+        self.hostname = hostname
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._connect = connect
+        self._ssh = None
+
+    @property
+    def ssh(self):
+        if self._ssh is None:
+            self._ssh = self._connect()
+        return self._ssh
+
+    def execute(self, commands, encoding='text'):
+        """ Sends the commands in a single eAPI request
+
+        Args:
+            commands (list): The list of commands to send
+            encoding (str): The eAPI encoding of the response, text or json
+
+        Returns:
+            list: The output of each command, as a JSON document with the
+                json encoding, or None if eAPI did not answer
+
+        Raises:
+            CommandError: If the node rejects any of the commands
+
+        """
+        if self.client is None:
+            return None
+
+        from pyeapi.eapilib import CommandError as EapiCommandError
+        self.metrics.incr('commands', len(commands))
+        try:
+            with self.metrics.span('eapi_request'):
+                response = self.client.execute(commands, encoding=encoding)
+        except EapiCommandError as exc:
+            raise CommandError(self.hostname, '; '.join(commands), str(exc))
+        except Exception:   # pylint: disable=broad-except
+            self.client = None
+            self.metrics.incr('eapi_fallbacks')
+            return None
+        if encoding == 'json':
+            return [json.dumps(result) for result in response['result']]
+        return [result.get('output', '') for result in response['result']]
+
+    def send_enable(self, commands):
+        # eAPI returns the JSON model itself, the pipe is only for the CLI
+        encoding = 'text'
+        requests = list(commands)
+        if requests and all(cmd.endswith(JSON_PIPE) for cmd in requests):
+            encoding = 'json'
+            requests = [cmd[:-len(JSON_PIPE)] for cmd in requests]
+
+        output = self.execute(['enable'] + requests, encoding)
+        if output is None:
+            return self.ssh.send_enable(commands)
+        return output[1:]
+
+    def send_config(self, commands):
+        if all(command in EAPI_SAFE_CONFIG for command in commands):
+            output = self.execute(['enable', 'configure'] + list(commands))
+            if output is not None:
+                return output[2:]
+        return self.ssh.send_config(commands)
+
+    def send_session(self, commands, timer=None):
+        return self.ssh.send_session(commands, timer)
+
+    def confirm_session(self, name):
+        return self.ssh.confirm_session(name)
+
 
 class Eapi(object):
     """ Manages the eAPI configuration and state information
@@ -189,52 +1275,143 @@ class Eapi(object):
     state of eAPI derived from the node and provides an instance for
     configuring eAPI over an SSH transport.
 
+    The status is requested as JSON first.  If the node does not support
+    JSON output for the show command, the text output is used for this and
+    all later status requests.
+
+    The last status received is kept as a snapshot for ttl seconds and
+    reused by status requests that do not ask for a refresh.  Any
+    configuration change discards the snapshot.
+
+    With session set, configuration changes are sent in EOS configure
+    sessions.  The changes made within a staged block are committed
+    together once the block exits.  With a commit timer, the first commit
+    is left pending and the node rolls the changes back unless confirm is
+    called before the timer expires.
+
+    Attributes:
+        pending (str): The name of the session committed with a timer and
+            not yet confirmed or None
+
     Args:
         ssh(Ssh): The instance of Ssh used to send and receive commands to
-            the destination node
+            the destination node.  An EapiBackend sends them over eAPI
+            instead
+        ttl (float): The number of seconds the status snapshot is reused.
+            Default value is 5secs
+        session (bool): Sends configuration changes in configure sessions
+        commit_timer (int): The commit timer in seconds of the sessions or
+            None to commit without a timer
 
     """
 
-    def __init__(self, ssh):
+    def __init__(self, ssh, ttl=DEFAULT_STATUS_TTL, session=False,
+                 commit_timer=None):
         self._ssh = ssh
+        self._json = True
+        self.ttl = ttl
+        self._snapshot = None
+        self._snapshot_time = 0
+        self.session = session or bool(commit_timer)
+        self.commit_timer = commit_timer
+        self.pending = None
+        self._staged = None
 
-    def status(self):
-        cmd = ['show management api http-commands']
-        output = self._ssh.send_enable(cmd)
-        output = output[1]
-
-        status = dict()
-        status['enabled'] = parse_enabled_state(output)
-        status['http'] = parse_http_state(output)
-        status['http_port'] = parse_http_port(output)
-        status['https'] = parse_https_state(output)
-        status['https_port'] = parse_https_port(output)
-        return status
-
-    def isenabled(self):
-        status = self.status()
+    @property
+    def metrics(self):
+        return self._ssh.metrics
+
+    def invalidate(self):
+        """ Discards the status snapshot
+        """
+        self._snapshot = None
+
+    def status(self, refresh=False):
+        if not refresh and self._snapshot is not None:
+            if time.time() - self._snapshot_time < self.ttl:
+                return dict(self._snapshot)
+
+        status = self._fetch_status()
+        self._snapshot = status
+        self._snapshot_time = time.time()
+        return dict(status)
+
+    def _fetch_status(self):
+        if self._json:
+            try:
+                output = self._ssh.send_enable([STATUS_COMMAND + JSON_PIPE])
+                status = parse_status_json(output[-1])
+                if status is not None:
+                    return status
+            except CommandError:
+                pass
+            self._json = False
+
+        output = self._ssh.send_enable([STATUS_COMMAND])
+        return parse_status(output[-1])
+
+    def isenabled(self, refresh=False):
+        status = self.status(refresh)
         return status['enabled']
 
-    def isrunning(self):
-        status = self.status()
+    def isrunning(self, refresh=False):
+        status = self.status(refresh)
         http = status['http']
         https = status['https']
         return http == 'running' or https == 'running'
 
-    def isstopped(self):
-        status = self.status()
+    def isstopped(self, refresh=False):
+        status = self.status(refresh)
         http = status['http']
         https = status['https']
         notrunning = ['shutdown', 'enabled']
         return (http in notrunning) and (https in notrunning)
 
+    @contextmanager
+    def staged(self):
+        """ Commits the changes made within the block in a single session
+
+        Without session the changes are sent as they are made.
+        """
+        if not self.session or self._staged is not None:
+            yield
+            return
+        self._staged = list()
+        try:
+            yield
+            lines, self._staged = self._staged, None
+            if lines:
+                self._configure(lines)
+        finally:
+            self._staged = None
+
+    def _configure(self, lines):
+        self.invalidate()
+        if self._staged is not None:
+            self._staged.extend(lines)
+            return list()
+        commands = ['management api http-commands'] + lines
+        if not self.session:
+            return self._ssh.send_config(commands)
+        # later sessions are covered by the rollback of the pending one
+        timer = self.commit_timer if self.pending is None else None
+        name = self._ssh.send_session(commands, timer)
+        if timer:
+            self.pending = name
+        return list()
+
+    def confirm(self):
+        """ Confirms the pending session so the node keeps the changes
+        """
+        if self.pending is not None:
+            self._ssh.confirm_session(self.pending)
+            self.pending = None
+
     def enable(self):
-        commands = ['management api http-commands', 'no shutdown']
-        return self._ssh.send_config(commands)
+        return self._configure(['no shutdown'])
 
     def disable(self):
-        commands = ['management api http-commands', 'shutdown']
-        return self._ssh.send_config(commands)
+        return self._configure(['shutdown'])
 
     def set_protocol(self, protocol, port=None):
         if protocol not in ['http', 'https']:
@@ -243,12 +1420,40 @@ class Eapi(object):
         if not port:
             port = default_port(protocol)
 
-        cmds = ['management api http-commands']
         if protocol == 'http':
-            cmds += ['no protocol https', 'protocol http port %s' % port]
+            lines = ['no protocol https', 'protocol http port %s' % port]
         elif protocol == 'https':
-            cmds += ['no protocol http', 'protocol https port %s' % port]
-        return self._ssh.send_config(cmds)
+            lines = ['no protocol http', 'protocol https port %s' % port]
+        return self._configure(lines)
+
+    def config(self):
+        output = self._ssh.send_enable([CONFIG_COMMAND])
+        return parse_http_commands(output[-1])
+
+    def apply(self, protocol, port=None, shutdown=False):
+        """ Converges the eAPI configuration to the desired state
+
+        The current management api http-commands configuration is read once
+        and only the lines that differ from the desired state are sent.
+        Nothing is sent if the node already complies.
+
+        Args:
+            protocol (str): The desired protocol, "http" or "https"
+            port (str): The desired port.  Defaults to the protocol default
+            shutdown (bool): True if eAPI should be shutdown
+
+        Returns:
+            list: The configuration lines sent to the node
+
+        """
+        if protocol not in ['http', 'https']:
+            raise TypeError('Protocol must be one of "http" or "https"')
+
+        port = port or default_port(protocol)
+        changes = config_delta(self.config(), protocol, port, shutdown)
+        if changes:
+            self._configure(changes)
+        return changes
 
 
 def default_port(protocol):
@@ -264,6 +1469,123 @@ def default_port(protocol):
     """
     return '443' if protocol == 'https' else '80'
 
+def parse_status(output):
+    """ Parses the show command text output for the eAPI status
+
+    The output is parsed in a single pass.  Any field not found in the
+    output is returned as None (or False for enabled) so this function never
+    raises on unexpected output.
+
+    Args:
+        output (str): Output from show management api http-commands
+
+    Returns:
+        dict: The eAPI status with keys enabled, http, http_port, https,
+            https_port, local_http, local_http_port, unix_socket and vrfs
+
+    """
+    status = dict(STATUS_TEMPLATE)
+    for match in STATUS_RE.finditer(output):
+        field, value = match.groups()
+        if field == 'Enabled':
+            status['enabled'] = value == 'Yes'
+        elif field in ('VRF', 'VRFs'):
+            status['vrfs'] = [v.strip() for v in value.split(',') if v.strip()]
+        else:
+            key = STATUS_KEYS[field]
+            status[key] = value.split(',')[0].strip() or None
+            port = PORT_RE.search(value)
+            if port and '%s_port' % key in status:
+                status['%s_port' % key] = port.group(1)
+    return status
+
+def parse_status_json(output):
+    """ Parses the show command JSON output for the eAPI status
+
+    Args:
+        output (str): Output from show management api http-commands | json
+
+    Returns:
+        dict: The eAPI status using the same keys as parse_status or None if
+            the output does not contain a valid JSON document
+
+    """
+    try:
+        data = json.loads(output[output.index('{'):output.rindex('}') + 1])
+    except ValueError:
+        return None
+
+    def server(name):
+        values = data.get(name) or dict()
+        if values.get('running'):
+            state = 'running'
+        elif values.get('configured'):
+            state = 'enabled'
+        else:
+            state = 'shutdown'
+        port = values.get('port')
+        return state, str(port) if port is not None else None
+
+    status = dict(STATUS_TEMPLATE)
+    status['enabled'] = bool(data.get('enabled'))
+    status['http'], status['http_port'] = server('httpServer')
+    status['https'], status['https_port'] = server('httpsServer')
+    status['local_http'], status['local_http_port'] = \
+        server('localHttpServer')
+    status['unix_socket'] = server('unixSocketServer')[0]
+
+    vrfs = data.get('vrfs', data.get('vrf'))
+    if isinstance(vrfs, basestring):
+        vrfs = [vrfs]
+    status['vrfs'] = sorted(vrfs) if vrfs else None
+    return status
+
+def parse_http_commands(output):
+    """ Parses the management api http-commands configuration
+
+    Args:
+        output (str): Output from show running-config all with the
+            management api http-commands section
+
+    Returns:
+        dict: The configuration with keys http and https, each set to the
+            configured port or False if the protocol is disabled, and
+            shutdown.  Any setting not found in the output is None
+
+    """
+    config = dict(http=None, https=None, shutdown=None)
+    for match in PROTOCOL_CONFIG_RE.finditer(output):
+        negate, protocol, port = match.groups()
+        config[protocol] = False if negate else port or default_port(protocol)
+    match = SHUTDOWN_CONFIG_RE.search(output)
+    if match:
+        config['shutdown'] = match.group(1) is None
+    return config
+
+def config_delta(config, protocol, port, shutdown=False):
+    """ Returns the configuration lines needed to reach the desired state
+
+    Args:
+        config (dict): The current configuration from parse_http_commands
+        protocol (str): The desired protocol, "http" or "https"
+        port (str): The desired port
+        shutdown (bool): True if eAPI should be shutdown
+
+    Returns:
+        list: The configuration lines to send.  The list is empty if the
+            current configuration already matches the desired state
+
+    """
+    changes = list()
+    other = 'https' if protocol == 'http' else 'http'
+    if config.get(other) is not False:
+        changes.append('no protocol %s' % other)
+    if config.get(protocol) != str(port):
+        changes.append('protocol %s port %s' % (protocol, port))
+    if config.get('shutdown') != shutdown:
+        changes.append('shutdown' if shutdown else 'no shutdown')
+    return changes
+
 def parse_enabled_state(output):
     """ Parses the show command for the eAPI status
 
@@ -274,8 +1596,7 @@ def parse_enabled_state(output):
         bool: True if eAPI is enabled otherwise False
 
     """
-    status = re.search(r'Enabled:\s+(\w+)', output)
-    return status.group(1) == 'Yes'
+    return parse_status(output)['enabled']
 
 def parse_http_state(output):
     """ Parses the show command for the eAPI status
@@ -287,8 +1608,7 @@ def parse_http_state(output):
         str: The current state value for HTTP Server
 
     """
-    status = re.search(r'HTTP server:\s+(\w+)', output)
-    return status.group(1)
+    return parse_status(output)['http']
 
 def parse_http_port(output):
     """ Parses the show command for the eAPI status
@@ -300,8 +1620,7 @@ def parse_http_port(output):
         str: The current state value for HTTP Server port
 
     """
-    status = re.search(r'HTTP .* port (\d+)', output)
-    return status.group(1)
+    return parse_status(output)['http_port']
 
 def parse_https_state(output):
     """ Parses the show command for the eAPI status
@@ -313,8 +1632,7 @@ def parse_https_state(output):
         str: The current state value for HTTPS Server
 
     """
-    status = re.search(r'HTTPS server:\s+(\w+)', output)
-    return status.group(1)
+    return parse_status(output)['https']
 
 def parse_https_port(output):
     """ Parses the show command for the eAPI status
@@ -326,49 +1644,133 @@ def parse_https_port(output):
         str: The current state value for HTTPS Server port
 
     """
-    status = re.search(r'HTTPS .* port (\d+)', output)
-    return status.group(1)
+    return parse_status(output)['https_port']
+
+def probe_port(host, port, timeout=DEFAULT_PROBE_TIMEOUT):
+    """ Checks if the TCP port is accepting connections
+
+    Args:
+        host (str): The hostname or IP address to connect to
+        port (str): The TCP port to connect to
+        timeout (float): The timeout value for the connection attempt
+
+    Returns:
+        bool: True if a connection could be established otherwise False
+
+    """
+    try:
+        sock = socket.create_connection((host, int(port)), timeout)
+    except (socket.error, ValueError):
+        return False
+    sock.close()
+    return True
+
+def wait_for(check, deadline, interval=POLL_INTERVAL,
+             max_interval=POLL_MAX_INTERVAL, metrics=None):
+    """ Polls the check function until it returns True
+
+    The check is polled at short intervals first.  The interval doubles
+    after each poll, up to max_interval, and is randomized by +/-50% so
+    many nodes polled at once do not poll in lockstep.
+
+    Args:
+        check (callable): The function to poll
+        deadline (float): The wall clock time at which to stop polling
+        interval (float): The interval before the second poll
+        max_interval (float): The maximum interval between polls
+        metrics (Metrics): Optional Metrics instance to record the poll
+            spans and iterations
+
+    Raises:
+        RuntimeWarning: Raises if the deadline expires before the check
+            returns True
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.span('poll'):
+        while True:
+            metrics.incr('poll_iterations')
+            if check():
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeWarning
+            with metrics.span('poll_sleep'):
+                time.sleep(min(remaining,
+                               interval * random.uniform(0.5, 1.5)))
+            interval = min(interval * 2, max_interval)
+
+def wait_running(eapi, deadline, address=None):
+    """ Waits for the eAPI server to be running
+
+    Args:
+        eapi: The instance of Eapi
+        deadline (float): The wall clock time at which to stop polling
+        address (tuple): Optional (host, port) of the eAPI server to probe
+            with a TCP connect before the status is confirmed over SSH
+
+    Raises:
+        RuntimeWarning: Raises if the deadline expires first
+    """
+    if address is not None:
+        wait_for(lambda: probe_port(*address), deadline,
+                 metrics=eapi.metrics)
+    wait_for(lambda: eapi.isrunning(refresh=True), deadline,
+             metrics=eapi.metrics)
+
+def wait_stopped(eapi, deadline, address=None):
+    """ Waits for the eAPI server to be stopped
+
+    Args:
+        eapi: The instance of Eapi
+        deadline (float): The wall clock time at which to stop polling
+        address (tuple): Optional (host, port) of the eAPI server to probe
+            with a TCP connect before the status is confirmed over SSH
+
+    Raises:
+        RuntimeWarning: Raises if the deadline expires first
+    """
+    if address is not None:
+        wait_for(lambda: not probe_port(*address), deadline,
+                 metrics=eapi.metrics)
+    wait_for(lambda: eapi.isstopped(refresh=True), deadline,
+             metrics=eapi.metrics)
 
-def enable_eapi(eapi, timeout=DEFAULT_POLL_TIMEOUT):
+def enable_eapi(eapi, timeout=DEFAULT_POLL_TIMEOUT, address=None):
     """ Administratively enables eAPI on the destination node
 
     Args:
         eapi: The instance of Eapi
-        timeout (int): Polling interval to watch for status change
+        timeout (float): Polling interval to watch for status change
+        address (tuple): Optional (host, port) of the eAPI server.  When
+            provided, the port is probed with a TCP connect until it is
+            listening before the status is confirmed over SSH
 
     Raises:
         RuntimeWarning: Raises if the poll timeout interval expires before
             the staus change.  This does not mean the change did not finish
     """
+    deadline = time.time() + float(timeout)
     eapi.enable()
-    while True:
-        if eapi.isrunning():
-            return
-        time.sleep(1)
-        timeout -= 1
-        if timeout == 0:
-            raise RuntimeWarning
+    wait_running(eapi, deadline, address)
 
 
-def disable_eapi(eapi, timeout=DEFAULT_POLL_TIMEOUT):
+def disable_eapi(eapi, timeout=DEFAULT_POLL_TIMEOUT, address=None):
     """ Administratively disables eAPI on the destination node
 
     Args:
         eapi: The instance of Eapi
-        timeout (int): Polling interval to watch for status change
+        timeout (float): Polling interval to watch for status change
+        address (tuple): Optional (host, port) of the eAPI server.  When
+            provided, the port is probed with a TCP connect until it is
+            closed before the status is confirmed over SSH
 
     Raises:
         RuntimeWarning: Raises if the poll timeout interval expires before
             the staus change.  This does not mean the change did not finish
     """
+    deadline = time.time() + float(timeout)
     eapi.disable()
-    while True:
-        if eapi.isstopped():
-            return
-        time.sleep(1)
-        timeout -= 1
-        if timeout == 0:
-            raise RuntimeWarning
+    wait_stopped(eapi, deadline, address)
 
 
 def parse_args(args):
@@ -384,13 +1786,53 @@ def parse_args(args):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('action',
-                        choices=['start', 'stop', 'status', 'restart'],
+                        choices=['start', 'stop', 'status', 'restart',
+                                 'apply', 'verify', 'state'],
                         help='Specifies the action to perform on the '
                              'destination node')
 
     parser.add_argument('connection',
+                        nargs='*',
                         help='Specifies the name of the node.  This is the '
-                             'name of the connection profile to load')
+                             'name of the connection profile to load.  '
+                             'Multiple names, glob patterns matching '
+                             'connection profiles and @tag selectors are '
+                             'accepted')
+
+    parser.add_argument('--inventory',
+                        help='Loads additional connection names from a '
+                             'file with one name per line')
+
+    parser.add_argument('--parallel',
+                        type=int,
+                        default=DEFAULT_PARALLEL,
+                        help='Sets the maximum number of nodes to work on '
+                             'concurrently')
+
+    parser.add_argument('--batch-size',
+                        help='Rolls the action out in batches of this many '
+                             'nodes or percentage of the nodes, such as '
+                             '10%%, and checks the health of each batch '
+                             'before starting the next')
+
+    parser.add_argument('--max-failures',
+                        type=int,
+                        default=DEFAULT_MAX_FAILURES,
+                        help='Sets the number of failed nodes tolerated '
+                             'before a batched rollout halts')
+
+    parser.add_argument('--resume',
+                        metavar='STATE_FILE',
+                        help='Records the progress of a batched rollout in '
+                             'the file and skips the nodes it lists as '
+                             'completed')
+
+    parser.add_argument('--max-handshakes',
+                        type=int,
+                        default=DEFAULT_MAX_HANDSHAKES,
+                        help='Sets the maximum number of SSH handshakes in '
+                             'progress at once when working on many nodes.  '
+                             'Use 0 for no limit')
 
     parser.add_argument('--config',
                         help='Overrides the default eapi.conf')
@@ -400,15 +1842,13 @@ def parse_args(args):
                              'destination node to configure')
 
     parser.add_argument('--username', '-u',
-                        default=DEFAULT_SSH_USERNAME,
                         help='Overrides the SSH username to use')
 
     parser.add_argument('--password', '-p',
-                        default=DEFAULT_SSH_PASSWORD,
                         help='Overrides the SSH password to use')
 
     parser.add_argument('--server-port',
-                        default=DEFAULT_SSH_PORT,
+                        type=int,
                         help='Overrides the SSH port to connect to on the '
                              'destination node')
 
@@ -420,73 +1860,903 @@ def parse_args(args):
                         help='Overrides the eAPI transport endpoint port')
 
     parser.add_argument('--poll-timeout',
+                        type=float,
                         default=DEFAULT_POLL_TIMEOUT,
                         help='Sets the timeout value waiting for eAPI to '
                              'be enabled')
 
     parser.add_argument('--connection-timeout',
+                        type=float,
                         default=DEFAULT_CONNECTION_TIMEOUT,
                         help='Sets the connection timeout value for '
-                             'establishing SSH connections')
-
-    return parser.parse_args(args)
-
-def main(args=None):
-    """The eapictl main routine
+                             'establishing SSH connections, including '
+                             'retries, and for each read')
+
+    parser.add_argument('--deadline',
+                        type=float,
+                        help='Sets the number of seconds allowed for the '
+                             'whole operation on each node.  Connecting, '
+                             'every command and polling share this budget')
+
+    parser.add_argument('--retries',
+                        type=int,
+                        default=DEFAULT_CONNECT_RETRIES,
+                        help='Sets the number of times a transient SSH '
+                             'connection failure is retried')
+
+    parser.add_argument('--breaker-threshold',
+                        type=int,
+                        default=DEFAULT_BREAKER_THRESHOLD,
+                        help='Stops connecting to the hosts of a subnet '
+                             'after this many hosts of the subnet failed to '
+                             'connect in a row.  Use 0 to disable')
+
+    parser.add_argument('--breaker-prefix',
+                        type=int,
+                        default=DEFAULT_BREAKER_PREFIX,
+                        help='Sets the prefix length of the subnets the '
+                             'circuit breaker counts failures for.  Use 32 '
+                             'to count failures per host')
+
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='Sends eAPI requests to the node after start or '
+                             'restart to confirm eAPI answers and reports '
+                             'their latency')
+
+    parser.add_argument('--verify-requests',
+                        type=int,
+                        default=DEFAULT_VERIFY_REQUESTS,
+                        help='Sets the number of eAPI requests sent to each '
+                             'node to verify it')
+
+    parser.add_argument('--prescan',
+                        action='store_true',
+                        help='Probes the SSH and eAPI ports of all nodes in '
+                             'parallel before connecting.  Unreachable nodes '
+                             'fail at once and nodes listening on the eAPI '
+                             'port are verified instead of started')
+
+    parser.add_argument('--prescan-timeout',
+                        type=float,
+                        default=DEFAULT_SCAN_TIMEOUT,
+                        help='Sets the number of seconds the port probes of '
+                             'the prescan wait for an answer')
+
+    parser.add_argument('--state-db',
+                        default=DEFAULT_STATE_FILE,
+                        help='Sets the path to the database recording the '
+                             'last known eAPI state of each node')
+
+    parser.add_argument('--no-state',
+                        action='store_true',
+                        help='Neither reads nor records the state of the '
+                             'nodes in the state database')
+
+    parser.add_argument('--skip-converged',
+                        action='store_true',
+                        help='Skips the nodes the state database records in '
+                             'the desired state when a TCP probe of the '
+                             'eAPI port agrees')
+
+    parser.add_argument('--state-max-age',
+                        type=float,
+                        default=DEFAULT_MAX_AGE,
+                        help='Sets the age in seconds after which recorded '
+                             'states are no longer used to skip nodes')
+
+    parser.add_argument('--probe',
+                        action='store_true',
+                        help='Probes the eAPI port with a TCP connect while '
+                             'waiting for eAPI to start or stop')
+
+    parser.add_argument('--backend',
+                        choices=['ssh', 'eapi'],
+                        default='ssh',
+                        help='Selects how the eAPI status is read and '
+                             'changed.  The eapi backend sends eAPI requests '
+                             'while eAPI answers and falls back to SSH')
+
+    parser.add_argument('--config-session',
+                        action='store_true',
+                        help='Sends the configuration changes of the action '
+                             'in an EOS configure session committed at once')
+
+    parser.add_argument('--commit-timer',
+                        type=int,
+                        metavar='SECONDS',
+                        help='Commits the configure session with a commit '
+                             'timer.  The changes are rolled back by the '
+                             'node unless the action and the verification '
+                             'succeed.  Implies --config-session')
+
+    parser.add_argument('--channel',
+                        choices=['shell', 'exec'],
+                        default='shell',
+                        help='Selects the SSH channel type used to send '
+                             'commands.  The exec channel runs commands '
+                             'non-interactively')
+
+    parser.add_argument('--output',
+                        choices=['json', 'jsonl'],
+                        default='json',
+                        help='Selects the output format.  The jsonl format '
+                             'prints one compact JSON line per node as soon '
+                             'as the node completes')
+
+    parser.add_argument('--metrics',
+                        choices=['json', 'prometheus'],
+                        help='Prints the timing spans and I/O counters '
+                             'after the status in the selected format')
+
+    parser.add_argument('--agent-socket',
+                        default=agent.DEFAULT_AGENT_SOCKET,
+                        help='Sets the path to the eapictl agent socket')
+
+    parser.add_argument('--no-agent',
+                        action='store_true',
+                        help='Runs the action in this process even if an '
+                             'eapictl agent is running')
+
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        help='Sends each batch of commands in a single write '
+                             'instead of waiting for the prompt after each '
+                             'command')
+
+    # argparse fills the connection positional before the first option, so
+    # node names following an option are returned as extra arguments
+    args, extra = parser.parse_known_args(args)
+    unknown = [arg for arg in extra if arg.startswith('-')]
+    if unknown:
+        parser.error('unrecognized arguments: %s' % ' '.join(unknown))
+    args.connection.extend(extra)
+
+    if args.batch_size is not None:
+        try:
+            batch_count(args.batch_size, 1)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    return args
+
+def profile_for(connection, args, conf=None):
+    """ Returns the connection settings for the node
+
+    The connection profile is loaded from the eapi.conf file and then
+    updated with any values overridden on the command line.  If no profile
+    exists, the connection name is used as the host.
 
     Args:
-        args (list): The list of command line args
+        connection (str): The name of the connection profile to load
+        args (Namespace): The parsed command line arguments
+        conf (Config): The eapi.conf profiles to read from.  Defaults to
+            the loaded eapi.conf file
 
     Returns:
-        0: If the application completed successfully
-
-        2: If there as an error during the transaction
+        dict: The connection settings for the node
 
     """
-
-    retcode = 0
-    args = parse_args(args)
-
-    if args.config:
-        pyeapi.load_config(args.config)
-
-    config = pyeapi.config_for(args.connection)
+    conf = conf or eapiconf.config
+    config = conf.get_connection(connection)
     if config is None:
-        config = dict(host=args.connection)
+        config = dict(host=connection)
 
     for key in ['host', 'server_port', 'username', 'password']:
         if getattr(args, key) is not None:
             config[key] = getattr(args, key)
 
-    ssh = Ssh(config['host'], config['username'], config['password'],
-              timeout=args.connection_timeout)
+    config.setdefault('server_port', DEFAULT_SSH_PORT)
+    config.setdefault('username', DEFAULT_SSH_USERNAME)
+    config.setdefault('password', DEFAULT_SSH_PASSWORD)
+
+    return config
+
+def run_action(eapi, action, protocol, port, timeout=DEFAULT_POLL_TIMEOUT,
+               address=None, shutdown=False):
+    """ Performs the action against the node
+
+    Args:
+        eapi (Eapi): The instance of Eapi for the node
+        action (str): The action to perform.  Valid values are "start",
+            "stop", "status", "restart" and "apply".  The "verify" action
+            does not use SSH and is handled by verify_node
+        protocol (str): The eAPI protocol to configure
+        port (str): The eAPI port to configure
+        timeout (float): Polling interval to watch for status change
+        address (tuple): Optional (host, port) of the eAPI server to probe
+            while waiting for status changes
+        shutdown (bool): The desired shutdown state used by apply
+
+    Returns:
+        list: The configuration lines sent by apply otherwise None
+
+    Raises:
+        RuntimeWarning: Raises if the poll timeout interval expires before
+            the staus change
+
+    """
+    if action == 'apply':
+        deadline = time.time() + float(timeout)
+        changes = eapi.apply(protocol, port, shutdown)
+        if changes and shutdown:
+            wait_stopped(eapi, deadline, address)
+        elif changes:
+            wait_running(eapi, deadline, address)
+        return changes
+    elif action == 'start':
+        if not eapi.isenabled():
+            deadline = time.time() + float(timeout)
+            with eapi.staged():
+                eapi.set_protocol(protocol, port)
+                eapi.enable()
+            wait_running(eapi, deadline, address)
+    elif action == 'stop':
+        if eapi.isenabled():
+            disable_eapi(eapi, timeout, address)
+    elif action == 'restart':
+        deadline = time.time() + float(timeout)
+        with eapi.staged():
+            eapi.set_protocol(protocol, port)
+            eapi.disable()
+        wait_stopped(eapi, deadline, address)
+        enable_eapi(eapi, timeout, address)
+
+def eapi_endpoint(config, args):
+    """ Returns the eAPI protocol and port for the node
 
-    eapi = Eapi(ssh)
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+
+    Returns:
+        tuple: The protocol and port
 
+    """
     proto = args.transport or config.get('transport', DEFAULT_TRANSPORT)
     port = args.eapi_port or config.get('port', default_port(proto))
+    return proto, port
+
+def check_health(config, args, result):
+    """ Checks that eAPI is running and answering on the node
+
+    The status returned by the action must show eAPI running and the eAPI
+    port must accept a TCP connection.  Nodes the action left disabled,
+    such as after a stop, are only checked when the action should have
+    enabled eAPI.
+
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        result (dict): The result of the action for the node
+
+    Returns:
+        str: The reason the node is unhealthy or None if it is healthy
+
+    """
+    if result.get('verify'):
+        return None
+
+    status = result.get('status') or dict()
+    if not status.get('enabled'):
+        if args.action in ['start', 'restart']:
+            return 'eAPI is not enabled'
+        return None
+
+    if 'running' not in [status.get('http'), status.get('https')]:
+        return 'eAPI is not running'
+
+    _, port = eapi_endpoint(config, args)
+    if not probe_port(config['host'], port):
+        return 'eAPI is not answering on port %s' % port
+    return None
+
+def desired_config(config, args):
+    """ Returns the eAPI configuration the action applies to the node
+
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+
+    Returns:
+        dict: The protocol, port and shutdown state
+
+    """
+    proto, port = eapi_endpoint(config, args)
+    shutdown = str(config.get('shutdown', '')).lower() in TRUE_VALUES
+    return dict(protocol=proto, port=str(port), shutdown=shutdown)
+
+def is_converged(config, args, record):
+    """ Checks if the recorded state shows the action has nothing to do
+
+    Only the start, stop and apply actions are skipped.  The record must be
+    recent and free of errors, it must show eAPI in the state the action
+    leads to and a TCP probe of the eAPI port must agree with it.  The apply
+    action also requires the recorded configuration to match.
 
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        record (dict): The node record from the state database or None
+
+    Returns:
+        bool: True if the node can be skipped
+
+    """
+    if record is None or args.action not in ['start', 'stop', 'apply']:
+        return False
+    if record['error'] or time.time() - record['updated'] > args.state_max_age:
+        return False
+
+    desired = desired_config(config, args)
+    if args.action == 'apply' and record['applied'] != desired:
+        return False
+
+    enabled = args.action == 'start' or \
+        (args.action == 'apply' and not desired['shutdown'])
+    status = record['status'] or dict()
+    if bool(status.get('enabled')) != enabled:
+        return False
+    if enabled and 'running' not in [status.get('http'), status.get('https')]:
+        return False
+    return probe_port(config['host'], desired['port']) == enabled
+
+def record_state(store, connection, config, args, result):
+    """ Records the status returned by the node in the state database
+
+    Args:
+        store (StateStore): The state database or None
+        connection (str): The name of the connection profile
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        result (dict): The result of the action for the node
+
+    """
+    if store is None or result.get('status') is None:
+        return
+    applied = None
+    if args.action == 'apply' and not result.get('retcode'):
+        applied = desired_config(config, args)
+    store.record(config['host'], connection, result['status'], args.action,
+                 applied, result.get('error'))
+
+def run_state(args, names, conf, emit):
+    """ Reports the recorded state of the nodes without connecting to them
+
+    Args:
+        args (Namespace): The parsed command line arguments
+        names (list): The connection names, glob patterns and tag
+            selectors to report.  All recorded nodes are reported if empty
+        conf (Config): The eapi.conf profiles used to expand selectors
+        emit (callable): Called with each output line
+
+    Returns:
+        int: The return code
+
+    """
+    store = open_store(args.state_db)
+    if store is None:
+        emit('Error: unable to open the state database %s' % args.state_db)
+        return 2
     try:
-        if args.action == 'start':
-            if not eapi.isenabled():
-                eapi.set_protocol(proto, port)
-                enable_eapi(eapi, args.poll_timeout)
-        elif args.action == 'stop':
-            if eapi.isenabled():
-                disable_eapi(eapi, args.poll_timeout)
-        elif args.action == 'restart':
-            eapi.set_protocol(proto, port)
-            disable_eapi(eapi, args.poll_timeout)
-            enable_eapi(eapi, args.poll_timeout)
-    except RuntimeWarning:
-        print 'Warning: Poll timeout expired before eAPI operation completed'
-        retcode = 2
-
-    print json.dumps(eapi.status())
-
-    ssh.close()
+        records = store.query()
+    finally:
+        store.close()
+
+    if names:
+        profiles = sorted(set(conf.connections) |
+                          set(record['profile'] for record in records))
+        selected = set(select_targets(names, profiles, conf.tags))
+        records = [r for r in records if r['profile'] in selected]
+
+    now = time.time()
+    for record in records:
+        record['age'] = round(now - record['updated'], 3)
+
+    if args.output == 'jsonl':
+        for record in records:
+            emit(json.dumps(record))
+    else:
+        emit(json.dumps(records))
+    return 0
+
+def session_key(config, args):
+    """ Returns the key used to pool the SSH session for a node
 
-    return retcode
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+
+    Returns:
+        tuple: The key identifying sessions that can be shared
+
+    """
+    return (config['host'], config['server_port'], config['username'],
+            config['password'], args.channel, args.pipeline)
+
+def client_key(config, args):
+    """ Returns the key used to pool the eAPI client for a node
+
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+
+    Returns:
+        tuple: The key identifying clients that can be shared
+
+    """
+    proto, port = eapi_endpoint(config, args)
+    return ('eapi', proto, config['host'], port, config['username'],
+            config['password'])
+
+def eapi_client(config, args, sessions=None):
+    """ Returns a keep-alive eAPI client connected to the node
+
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        sessions (SessionPool): Optional pool of eAPI clients to take the
+            client from
+
+    Returns:
+        EapiClient: The client for the node
+
+    """
+    proto, port = eapi_endpoint(config, args)
+
+    def factory():
+        return EapiClient(proto, config['host'], config['username'],
+                          config['password'], port, args.connection_timeout)
+
+    if sessions:
+        return sessions.acquire(client_key(config, args), factory)
+    return factory()
+
+def verify_node(config, args, sessions=None, metrics=None):
+    """ Verifies that eAPI answers requests on the node
+
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        sessions (SessionPool): Optional pool of eAPI clients to reuse
+        metrics (Metrics): Optional Metrics instance to record into
+
+    Returns:
+        dict: The verification result as returned by verify_eapi
+
+    Raises:
+        Exception: Any error raised by pyeapi for a failed request
+
+    """
+    client = eapi_client(config, args, sessions)
+    try:
+        resp = verify_eapi(client, args.verify_requests, metrics)
+    except Exception:
+        client.close()
+        raise
+
+    if sessions:
+        sessions.release(client_key(config, args), client)
+    else:
+        client.close()
+    return resp
+
+def eapi_backend(config, args, connect, sessions=None, metrics=None):
+    """ Returns the eAPI backend used to manage the node over eAPI
+
+    Args:
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        connect (callable): Returns the Ssh session to fall back to
+        sessions (SessionPool): Optional pool of eAPI clients to reuse
+        metrics (Metrics): Optional Metrics instance to record into
+
+    Returns:
+        EapiBackend: The backend for the node
+
+    """
+    client = eapi_client(config, args, sessions)
+    return EapiBackend(client, connect, config['host'], metrics)
+
+def run_verify(connection, config, args, sessions=None, metrics=None):
+    """ Runs the verify action against a single node
+
+    Args:
+        connection (str): The name of the connection profile to run against
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        sessions (SessionPool): Optional pool of eAPI clients to reuse
+        metrics (Metrics): Optional Metrics instance to record into
+
+    Returns:
+        dict: The result for the node with keys connection, host, retcode,
+            verify and error
+
+    """
+    result = dict(connection=connection, host=config['host'], retcode=0,
+                  error=None, changes=None, status=None, verify=None)
+    try:
+        result['verify'] = verify_node(config, args, sessions, metrics)
+    except Exception as exc:    # pylint: disable=broad-except
+        result['retcode'] = 2
+        result['error'] = 'eAPI verification failed: %s' % exc
+    return result
+
+def prescan_targets(names, args, conf=None):
+    """ Classifies the nodes by the ports they answer on
+
+    Args:
+        names (list): The connection names of the nodes
+        args (Namespace): The parsed command line arguments
+        conf (Config): The eapi.conf profiles to read from
+
+    Returns:
+        dict: The scan class of each node keyed by connection name
+
+    """
+    targets = dict()
+    for name in names:
+        config = profile_for(name, args, conf)
+        _, port = eapi_endpoint(config, args)
+        targets[name] = (config['host'], config['server_port'], port)
+    return classify(targets, args.prescan_timeout)
+
+def prescan_result(connection, config, args, reach, sessions=None,
+                   metrics=None):
+    """ Returns the result of a node decided by the reachability scan
+
+    Unreachable nodes fail without a connection attempt and so does the
+    verify action for nodes not listening on the eAPI port.  Nodes already
+    listening on the eAPI port are verified instead of started over SSH.
+    If the verification fails, the node is started as usual.
+
+    Args:
+        connection (str): The name of the connection profile
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        reach (str): The scan class of the node or None if not scanned
+        sessions (SessionPool): Optional pool of eAPI clients to reuse
+        metrics (Metrics): Optional Metrics instance to record into
+
+    Returns:
+        dict: The result for the node or None if the action must be run
+
+    """
+    _, port = eapi_endpoint(config, args)
+    result = dict(connection=connection, host=config['host'], retcode=2,
+                  error=None, changes=None, status=None)
+    if reach == UNREACHABLE:
+        result['error'] = 'Host unreachable, no answer on SSH port %s or ' \
+                          'eAPI port %s' % (config['server_port'], port)
+    elif reach == SSH_ONLY and args.action == 'verify':
+        result['error'] = 'eAPI is not listening on port %s' % port
+    elif reach == EAPI_LISTENING and args.action == 'start':
+        result = run_verify(connection, config, args, sessions, metrics)
+        if result['retcode']:
+            return None
+    else:
+        return None
+    return result
+
+def run_node(connection, config, args, handshakes=None, sessions=None,
+             metrics=None, breaker=None):
+    """ Runs the requested action against a single node
+
+    Args:
+        connection (str): The name of the connection profile to run against
+        config (dict): The connection settings for the node
+        args (Namespace): The parsed command line arguments
+        handshakes (Semaphore): Optional semaphore used to cap the number
+            of concurrent SSH handshakes
+        sessions (SessionPool): Optional pool of SSH sessions to reuse.  The
+            session is returned to the pool when the action completes
+        metrics (Metrics): Optional Metrics instance to record into
+        breaker (CircuitBreaker): Optional circuit breaker shared between
+            nodes
+
+    Returns:
+        dict: The result for the node with keys connection, host, retcode,
+            status and error.  When eAPI is verified, the verify key holds
+            the verification result.  The rollback key is set when a commit
+            timer is left to expire
+
+    """
+    if args.action == 'verify':
+        return run_verify(connection, config, args, sessions, metrics)
+
+    deadline = time.time() + args.deadline if args.deadline else None
 
+    cls = SshExec if args.channel == 'exec' else Ssh
 
+    def factory():
+        return cls(config['host'], config['username'], config['password'],
+                   timeout=args.connection_timeout, handshakes=handshakes,
+                   pipeline=args.pipeline, port=config['server_port'],
+                   metrics=metrics, deadline=deadline, retries=args.retries,
+                   breaker=breaker)
 
+    key = session_key(config, args)
+    opened = list()
+
+    def connect():
+        ssh = sessions.acquire(key, factory) if sessions else factory()
+        opened.append(ssh)
+        ssh.deadline = deadline
+        if metrics is not None:
+            ssh.metrics = metrics
+            if ssh.reader is not None:
+                ssh.reader.metrics = metrics
+        return ssh
+
+    backend = None
+    healthy = False
+
+    try:
+        if args.backend == 'eapi':
+            backend = eapi_backend(config, args, connect, sessions, metrics)
+        eapi = Eapi(backend or connect(), session=args.config_session,
+                    commit_timer=args.commit_timer)
+
+        proto, port = eapi_endpoint(config, args)
+
+        address = (config['host'], port) if args.probe else None
+        shutdown = str(config.get('shutdown', '')).lower() in TRUE_VALUES
+
+        result = dict(connection=connection, host=config['host'],
+                      retcode=0, error=None, changes=None)
+        timeout = args.poll_timeout
+        if deadline is not None:
+            timeout = min(timeout, max(0, deadline - time.time()))
+        try:
+            result['changes'] = run_action(eapi, args.action, proto, port,
+                                           timeout, address, shutdown)
+        except RuntimeWarning:
+            result['retcode'] = 2
+            result['error'] = POLL_TIMEOUT_ERROR
+
+        result['status'] = eapi.status()
+        healthy = True
+
+        if args.verify and args.action in ['start', 'restart'] and \
+                not result['retcode']:
+            verify = run_verify(connection, config, args, sessions, metrics)
+            result.update(retcode=verify['retcode'], error=verify['error'],
+                          verify=verify['verify'])
+
+        if eapi.pending is not None:
+            if result['retcode']:
+                # left unconfirmed, the node rolls the changes back
+                result['rollback'] = True
+            else:
+                eapi.confirm()
+        return result
+    finally:
+        for ssh in opened:
+            if sessions and healthy:
+                sessions.release(key, ssh)
+            else:
+                ssh.close()
+        if backend is not None and backend.client is not None:
+            if sessions and healthy:
+                sessions.release(client_key(config, args), backend.client)
+            else:
+                backend.client.close()
+
+def format_metrics(metrics, fmt=None):
+    """ Formats the metrics for output
+
+    Args:
+        metrics (Metrics): The metrics recorded for the run
+        fmt (str): The output format, "json" or "prometheus".  No output is
+            produced if fmt is None
+
+    Returns:
+        list: The list of output lines
+
+    """
+    if fmt == 'json':
+        return [json.dumps(dict(metrics=metrics.todict()))]
+    elif fmt == 'prometheus':
+        return [metrics.prometheus()]
+    return list()
+
+def compact_result(result, action):
+    """ Returns the node result as a compact dict for JSON Lines output
+
+    Args:
+        result (dict): The result for the node
+        action (str): The action run against the node
+
+    Returns:
+        dict: The action and the result keys that have a value
+
+    """
+    line = dict((key, value) for key, value in result.items()
+                if value is not None)
+    line['action'] = action
+    return line
+
+def run(args, sessions=None, emit=None, breaker=None):
+    """ Runs the action for the parsed command line arguments
+
+    When more than one node is selected, either by naming several
+    connections, using a glob pattern or an inventory file, the action is
+    run against all nodes concurrently and a JSON list with one result per
+    node is returned.  With a batch size the action is rolled out batch by
+    batch with health checks between batches.
+
+    With the jsonl output format one compact JSON line is emitted per node
+    as soon as the node completes and the results are not kept.
+
+    With --prescan, the SSH and eAPI ports of all nodes are probed in
+    parallel first and the nodes that do not answer fail without an SSH
+    connection attempt.
+
+    The status of each node is recorded in the state database.  With
+    --skip-converged, nodes the database shows in the desired state are
+    not connected to and their recorded status is reported with the cached
+    key set.  The state action only reports the recorded states.
+
+    Args:
+        args (Namespace): The parsed command line arguments
+        sessions (SessionPool): Optional pool of SSH sessions to reuse
+        emit (callable): Optional function called with each output line as
+            soon as it is available.  By default the lines are returned
+        breaker (CircuitBreaker): Optional circuit breaker to share with
+            other runs.  By default a new one is used for this run
+
+    Returns:
+        tuple: The return code and the list of output lines not emitted
+
+    """
+    metrics = Metrics()
+    output = list()
+    emit = emit or output.append
+    stream = args.output == 'jsonl'
+
+    with CONFIG_LOCK:
+        # the agent keeps the index of the file loaded by earlier requests
+        if args.config and args.config != eapiconf.config.filename:
+            eapiconf.load_config(args.config)
+        conf = eapiconf.config
+
+        names = list(args.connection)
+        if args.inventory:
+            names.extend(load_inventory(args.inventory))
+
+        if args.action != 'state':
+            if not names:
+                raise SystemExit('eapictl: error: no connection specified')
+
+            fleet = len(names) > 1 or args.inventory or \
+                isselector(names[0]) or args.batch_size is not None
+
+            if fleet:
+                args.host = None
+                names = select_targets(names, conf.connections, conf.tags)
+
+    if args.action == 'state':
+        return run_state(args, names, conf, emit), output
+
+    store = None if args.no_state else open_store(args.state_db)
+    try:
+        handshakes = handshake_limiter(args.max_handshakes) if fleet else None
+        if breaker is None:
+            breaker = CircuitBreaker(args.breaker_threshold,
+                                     prefix=args.breaker_prefix)
+
+        reach = dict()
+        if fleet and args.prescan:
+            with metrics.span('prescan'):
+                reach = prescan_targets(names, args, conf)
+
+        def worker(name):
+            start = time.time()
+            config = profile_for(name, args, conf)
+            record = None
+            if store is not None and args.skip_converged:
+                record = store.get(config['host'], name)
+            if is_converged(config, args, record):
+                result = dict(connection=name, host=config['host'], retcode=0,
+                              error=None, status=record['status'], cached=True,
+                              changes=[] if args.action == 'apply' else None)
+            else:
+                result = prescan_result(name, config, args, reach.get(name),
+                                        sessions, metrics)
+                if result is None:
+                    result = run_node(name, config, args, handshakes,
+                                      sessions, metrics, breaker)
+                    record_state(store, name, config, args, result)
+            if name in reach:
+                result['prescan'] = reach[name]
+            result['elapsed'] = round(time.time() - start, 3)
+            return result
+
+        def callback(result):
+            emit(json.dumps(compact_result(result, args.action)))
+
+        if not fleet:
+            result = worker(names[0])
+            if stream:
+                callback(result)
+            elif result['error'] == POLL_TIMEOUT_ERROR:
+                emit('Warning: Poll timeout expired before eAPI operation '
+                     'completed')
+            elif result['error']:
+                emit('Error: %s' % result['error'])
+            if not stream and result['status'] is not None:
+                emit(json.dumps(result['status']))
+            if not stream and result.get('verify') is not None:
+                emit(json.dumps(dict(verify=result['verify'])))
+            for line in format_metrics(metrics, args.metrics):
+                emit(line)
+            return result['retcode'], output
+
+        halted = False
+        if args.batch_size is not None:
+            def health(name, result):
+                return check_health(profile_for(name, args, conf), args,
+                                    result)
+
+            results, halted = run_rollout(names, worker, args.batch_size,
+                                          args.parallel, args.max_failures,
+                                          health, args.resume,
+                                          callback if stream else None)
+        else:
+            results = run_fleet(names, worker, args.parallel,
+                                callback if stream else None)
+
+        if halted:
+            error = 'Rollout halted after more than %d failed nodes' % \
+                args.max_failures
+            emit(json.dumps(dict(error=error)) if stream
+                 else 'Error: %s' % error)
+        if not stream:
+            emit(json.dumps(results))
+        for line in format_metrics(metrics, args.metrics):
+            emit(line)
+        return 2 if halted else fleet_retcode(results), output
+    finally:
+        if store is not None:
+            store.close()
+
+def main(args=None):
+    """The eapictl main routine
+
+    If an eapictl agent is listening on the agent socket, the request is
+    handed to the agent, which reuses its warm SSH sessions.  Otherwise the
+    action is run by this process.
+
+    Args:
+        args (list): The list of command line args
+
+    Returns:
+        0: If the application completed successfully
+
+        2: If there as an error during the transaction
+
+    """
+    argv = sys.argv[1:] if args is None else list(args)
+    args = parse_args(argv)
+
+    def emit(line):
+        print line
+        sys.stdout.flush()
+
+    response = None
+    if not args.no_agent:
+        conf = eapiconf.Config(args.config) if args.config \
+            else eapiconf.config
+        response = agent.request(args.agent_socket, argv, emit=emit,
+                                 config=agent.config_path(conf))
+
+    if response is not None:
+        retcode, output = response
+    else:
+        set_stack_size()
+        retcode, output = run(args, emit=emit)
+
+    for line in output:
+        print line
+
+    return retcode
@@ -0,0 +1,328 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+""" Lightweight reader for pyeapi eapi.conf connection profiles
+
+The reader follows the same rules as the pyeapi client for locating and
+reading the eapi.conf file, but avoids importing pyeapi and its
+dependencies, which dominates the start-up time of short eapictl runs.
+The file is only read the first time a profile is requested.
+
+The eapi.conf file is located using the EAPI_CONF environment variable or
+the first file found in CONFIG_SEARCH_PATH.
+
+Generated eapi.conf files can hold tens of thousands of connection
+profiles, so the parsed profiles are kept in an index file under
+DEFAULT_INDEX_DIR.  The index is keyed by the path, modification time and
+size of the eapi.conf file and is rebuilt only when the file changes.  The
+key is also checked before each lookup of the in-memory index.
+Loading the index is much faster than parsing the INI file and profiles
+are then looked up by name in constant time.
+
+"""
+import os
+import sys
+import marshal
+import hashlib
+import tempfile
+
+from ConfigParser import SafeConfigParser, Error as ConfigParserError
+
+CONFIG_SEARCH_PATH = ['~/.eapi.conf', '/mnt/flash/eapi.conf']
+
+DEFAULT_INDEX_DIR = os.environ.get('EAPICTL_CACHE_DIR', '~/.cache/eapictl')
+
+INDEX_VERSION = 1
+
+
+class Config(object):
+    """ Manages the connection profiles loaded from the eapi.conf file
+
+    Attributes:
+        filename (str): The full path of the loaded file or None if no file
+            was found
+        index_dir (str): The directory holding the profile index files or
+            None to disable the on-disk index
+
+    Args:
+        filename (str): The full path to the file to load.  If not
+            provided the file is located using the search path
+        index_dir (str): The index directory.  Default value is
+            ~/.cache/eapictl
+
+    """
+
+    def __init__(self, filename=None, index_dir=DEFAULT_INDEX_DIR):
+        self.filename = filename
+        self.index_dir = index_dir
+        self._index = None
+
+    def load(self, filename):
+        """ Loads the file specified by filename
+
+        Args:
+            filename (str): The full path to the file to load
+
+        """
+        self.filename = filename
+        self._index = None
+
+    def find(self):
+        """ Returns the path of the eapi.conf file to load
+
+        Returns:
+            str: The full path to the file or None if no file is found
+
+        """
+        if 'EAPI_CONF' in os.environ:
+            paths = [os.environ['EAPI_CONF']]
+        elif self.filename:
+            paths = [self.filename]
+        else:
+            paths = CONFIG_SEARCH_PATH
+
+        for path in paths:
+            path = os.path.expanduser(path)
+            if os.path.exists(path):
+                return path
+
+    @property
+    def index(self):
+        """ Returns the profile index of the eapi.conf file
+
+        The file is checked on every call and the index is reloaded when
+        its path, modification time or size has changed, so a long running
+        agent picks up edits to the file.
+        """
+        filename = self.find()
+        if self._index is None or \
+                self._index['source'] != index_source(filename):
+            self._index = load_index(filename, self.index_dir)
+        return self._index
+
+    @property
+    def connections(self):
+        """ Returns the sorted list of connection names
+        """
+        return self.index['names']
+
+    @property
+    def tags(self):
+        """ Returns the connection names keyed by tag
+        """
+        return self.index['tags']
+
+    def get_connection(self, name):
+        """ Returns the settings for the connection name
+
+        Args:
+            name (str): The name of the connection profile
+
+        Returns:
+            dict: A copy of the profile settings or None if the profile does
+                not exist
+
+        """
+        profile = self.index['profiles'].get(name)
+        return dict(profile) if profile is not None else None
+
+
+def read_profiles(filename):
+    """ Reads the connection profiles from the eapi.conf file
+
+    Parsing errors are ignored the same way pyeapi ignores them.
+
+    Args:
+        filename (str): The full path to the file to read.  If None, no
+            profiles are returned
+
+    Returns:
+        tuple: The profiles keyed by connection name and the connection
+            names keyed by tag
+
+    """
+    profiles = dict()
+    tags = dict()
+    if filename is None:
+        return profiles, tags
+
+    parser = SafeConfigParser()
+    try:
+        parser.read(filename)
+    except ConfigParserError:
+        return profiles, tags
+
+    for section in parser.sections():
+        if not section.startswith('connection:'):
+            continue
+        name = section.split(':', 1)[1]
+        profile = dict(parser.items(section))
+        profile.setdefault('host', name)
+        profiles[name] = profile
+        for tag in profile.get('tags', '').split(','):
+            if tag.strip():
+                tags.setdefault(tag.strip(), list()).append(name)
+    return profiles, tags
+
+
+def build_index(filename):
+    """ Builds the profile index of the eapi.conf file
+
+    Args:
+        filename (str): The full path to the file to index.  If None, an
+            empty index is returned
+
+    Returns:
+        dict: The index with the source key, the sorted connection names,
+            the tags and the profiles keyed by name
+
+    """
+    profiles, tags = read_profiles(filename)
+    return dict(version=INDEX_VERSION, source=index_source(filename),
+                names=sorted(profiles), tags=tags, profiles=profiles)
+
+def index_source(filename):
+    """ Returns the key identifying the contents of the eapi.conf file
+
+    Args:
+        filename (str): The full path to the file
+
+    Returns:
+        list: The absolute path, modification time and size of the file or
+            None if filename is None
+
+    """
+    if filename is None:
+        return None
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_mtime, stat.st_size]
+
+def index_path(filename, index_dir):
+    """ Returns the path of the index file for the eapi.conf file
+
+    Args:
+        filename (str): The full path to the eapi.conf file
+        index_dir (str): The directory holding the index files
+
+    Returns:
+        str: The full path to the index file
+
+    """
+    digest = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    name = 'profiles-%s-py%d%d.idx' % ((digest,) + sys.version_info[:2])
+    return os.path.join(os.path.expanduser(index_dir), name)
+
+def load_index(filename, index_dir=DEFAULT_INDEX_DIR):
+    """ Returns the profile index of the eapi.conf file
+
+    The index file is used when its source key matches the eapi.conf file.
+    Otherwise the index is rebuilt and saved.  Failing to read or write
+    the index file is not an error, the file is then simply parsed.
+
+    Args:
+        filename (str): The full path to the eapi.conf file or None
+        index_dir (str): The directory holding the index files or None to
+            disable the on-disk index
+
+    Returns:
+        dict: The profile index as returned by build_index
+
+    """
+    if filename is None or index_dir is None:
+        return build_index(filename)
+
+    source = index_source(filename)
+    path = index_path(filename, index_dir)
+    try:
+        with open(path, 'rb') as handle:
+            index = marshal.load(handle)
+        if index.get('version') == INDEX_VERSION and \
+                index.get('source') == source:
+            return index
+    except (IOError, EOFError, ValueError, TypeError, AttributeError):
+        pass
+
+    index = build_index(filename)
+    save_index(path, index)
+    return index
+
+def save_index(path, index):
+    """ Atomically writes the index file
+
+    Args:
+        path (str): The full path to the index file
+        index (dict): The profile index to write
+
+    Returns:
+        bool: True if the index file was written
+
+    """
+    try:
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        handle, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as tmpfile:
+            marshal.dump(index, tmpfile)
+        os.rename(tmpname, path)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+config = Config()
+
+
+def load_config(filename):
+    """ Loads the eapi.conf file specified by filename
+
+    The module level config is replaced rather than updated, so callers
+    holding a reference to the previous config keep a consistent view.
+
+    Args:
+        filename (str): The full path to the file to load
+
+    """
+    global config   # pylint: disable=global-statement
+    config = Config(filename)
+
+def config_for(name):
+    """ Returns the settings for the connection profile name
+
+    Args:
+        name (str): The name of the connection profile
+
+    Returns:
+        dict: The profile settings or None if the profile does not exist
+
+    """
+    return config.get_connection(name)
@@ -0,0 +1,411 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+""" Fleet support for running eapictl actions against many nodes
+
+The fleet module expands a set of connection names, connection profile
+globs and inventory files into a list of targets and runs an action against
+each target using a bounded pool of worker threads.
+
+Example:
+
+    # start eAPI on every profile matching veos* using 20 workers
+    $ eapictl start 'veos*' --parallel 20
+
+    # get the status of every node listed in an inventory file
+    $ eapictl status --inventory site01.txt --parallel 50
+
+    # stop eAPI on every profile tagged leaf in the eapi.conf file
+    $ eapictl stop @leaf
+
+"""
+import time
+import socket
+import fnmatch
+import threading
+
+from Queue import Queue, Empty
+
+DEFAULT_PARALLEL = 10
+DEFAULT_MAX_HANDSHAKES = 20
+
+DEFAULT_BREAKER_THRESHOLD = 3
+DEFAULT_BREAKER_RESET = 60
+DEFAULT_BREAKER_PREFIX = 24
+
+# Each node uses a worker thread plus the paramiko transport thread, neither
+# of which needs the default 8MB stack.  Shrinking the stack keeps the
+# memory footprint of a few thousand sessions manageable.  The stack size is
+# process wide, so it is set once by set_stack_size at start-up.
+THREAD_STACK_SIZE = 512 * 1024
+
+GLOB_CHARS = '*?['
+
+TAG_PREFIX = '@'
+
+
+def isglob(name):
+    """ Checks if the connection name is a glob pattern
+
+    Args:
+        name (str): The connection name to check
+
+    Returns:
+        bool: True if the name contains glob wildcard characters
+
+    """
+    return any(char in name for char in GLOB_CHARS)
+
+def isselector(name):
+    """ Checks if the connection name selects a set of profiles
+
+    Args:
+        name (str): The connection name to check
+
+    Returns:
+        bool: True if the name is a glob pattern or a tag selector
+
+    """
+    return isglob(name) or name.startswith(TAG_PREFIX)
+
+def load_inventory(filename):
+    """ Loads the list of connection names from an inventory file
+
+    The inventory file is a plain text file with one connection name (or
+    glob pattern) per line.  Blank lines and lines starting with # are
+    ignored.
+
+    Args:
+        filename (str): The full path to the inventory file
+
+    Returns:
+        list: The list of connection names found in the file
+
+    """
+    names = list()
+    with open(filename) as inventory:
+        for line in inventory:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                names.append(line)
+    return names
+
+def select_targets(names, profiles, tags=None):
+    """ Expands the list of connection names into the list of targets
+
+    Names that include glob wildcard characters are matched against the
+    list of loaded connection profiles and names starting with @ select the
+    profiles with that tag.  All other names are used as is.  Duplicate
+    targets are removed while the original order is preserved.
+
+    Args:
+        names (list): The list of connection names, glob patterns and tag
+            selectors
+        profiles (list): The list of connection profile names loaded from
+            the eapi.conf file
+        tags (dict): The connection profile names keyed by tag
+
+    Returns:
+        list: The ordered list of unique target connection names
+
+    """
+    targets = list()
+    seen = set()
+    for name in names:
+        if name.startswith(TAG_PREFIX):
+            matches = (tags or dict()).get(name[len(TAG_PREFIX):], [])
+        elif isglob(name):
+            matches = fnmatch.filter(profiles, name)
+        else:
+            matches = [name]
+        for match in matches:
+            if match not in seen:
+                seen.add(match)
+                targets.append(match)
+    return targets
+
+def handshake_limiter(limit=DEFAULT_MAX_HANDSHAKES):
+    """ Returns a semaphore used to cap the number of in-flight handshakes
+
+    Args:
+        limit (int): The maximum number of concurrent SSH handshakes.  A
+            value of 0 disables the limit
+
+    Returns:
+        BoundedSemaphore: The semaphore instance or None if disabled
+
+    """
+    if not limit:
+        return None
+    return threading.BoundedSemaphore(limit)
+
+def failure_domain(host, prefix=DEFAULT_BREAKER_PREFIX):
+    """ Returns the failure domain of the host
+
+    Hosts in the same IPv4 subnet usually share a rack, a switch or a
+    management network, so they tend to fail together.
+
+    Args:
+        host (str): The hostname or IP address of the node
+        prefix (int): The length of the subnet prefix.  A value of 0 or 32
+            makes every host its own domain
+
+    Returns:
+        str: The subnet of the host address in CIDR notation or the host
+            itself if the address is not IPv4 or cannot be resolved
+
+    """
+    if not prefix or prefix >= 32:
+        return host
+    try:
+        address = socket.inet_aton(socket.gethostbyname(host))
+    except (socket.error, UnicodeError):
+        return host
+    value = int(address.encode('hex'), 16)
+    value &= (0xffffffff << (32 - prefix)) & 0xffffffff
+    network = socket.inet_ntoa(('%08x' % value).decode('hex'))
+    return '%s/%d' % (network, prefix)
+
+class CircuitBreaker(object):
+    """ Stops connection attempts to failure domains that keep failing
+
+    Failures are counted per failure domain, the subnet of the host by
+    default, once per host that could not be connected after its retries.
+    Once threshold hosts of a domain fail in a row its circuit opens and no
+    attempt to any host of the domain is allowed for reset_timeout seconds,
+    including the remaining retries of hosts being connected.  After that a
+    single trial attempt is allowed.  The circuit closes again on the first
+    success.  Sharing one breaker between the batches of a rollout and the
+    requests of the agent keeps a failed rack from being retried by each
+    of them.
+
+    Attributes:
+        threshold (int): The number of consecutive failures that opens the
+            circuit of a domain.  A value of 0 disables the breaker
+        reset_timeout (float): The number of seconds a circuit stays open
+        prefix (int): The subnet prefix length of the failure domains
+
+    Args:
+        threshold (int): The threshold value.  Default value is 3
+        reset_timeout (float): The reset timeout value.  Default value is
+            60secs
+        prefix (int): The prefix value.  Default value is 24, use 32 to
+            count failures per host
+
+    """
+
+    def __init__(self, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset_timeout=DEFAULT_BREAKER_RESET,
+                 prefix=DEFAULT_BREAKER_PREFIX):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.prefix = prefix
+        self._failures = dict()
+        self._opened = dict()
+        self._domains = dict()
+        self._lock = threading.Lock()
+
+    def domain(self, host):
+        """ Returns the failure domain of the host
+
+        The domain is looked up once per host.
+
+        Args:
+            host (str): The hostname or IP address of the node
+
+        Returns:
+            str: The key the failures of the host are counted under
+
+        """
+        if not self.threshold:
+            return host
+        domain = self._domains.get(host)
+        if domain is None:
+            domain = failure_domain(host, self.prefix)
+            self._domains[host] = domain
+        return domain
+
+    def allow(self, host):
+        """ Checks if an attempt to connect to the host is allowed
+
+        Args:
+            host (str): The host to connect to
+
+        Returns:
+            bool: False if the circuit of the host domain is open
+
+        """
+        key = self.domain(host)
+        with self._lock:
+            opened = self._opened.get(key)
+            if opened is None:
+                return True
+            if time.time() - opened < self.reset_timeout:
+                return False
+            # half open, the next failure opens the circuit again
+            del self._opened[key]
+            self._failures[key] = self.threshold - 1
+            return True
+
+    def success(self, host):
+        """ Records a successful attempt and closes the circuit
+
+        Args:
+            host (str): The host connected to
+
+        """
+        key = self.domain(host)
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened.pop(key, None)
+
+    def failure(self, host):
+        """ Records a host that could not be connected
+
+        Args:
+            host (str): The host that failed
+
+        """
+        if not self.threshold:
+            return
+        key = self.domain(host)
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures >= self.threshold:
+                self._opened[key] = time.time()
+
+    def isopen(self, host):
+        """ Checks if the circuit of the host is open
+
+        Args:
+            host (str): The host to check
+
+        Returns:
+            bool: True if attempts to the host domain are currently refused
+
+        """
+        key = self.domain(host)
+        with self._lock:
+            opened = self._opened.get(key)
+            return opened is not None and \
+                time.time() - opened < self.reset_timeout
+
+def set_stack_size(size=THREAD_STACK_SIZE):
+    """ Sets the stack size of the threads started by the process
+
+    The stack size applies to every thread started afterwards, so it is
+    set once at start-up rather than around each fleet run.
+
+    Args:
+        size (int): The stack size in bytes
+
+    """
+    try:
+        threading.stack_size(size)
+    except (ValueError, threading.ThreadError):
+        pass
+
+def run_fleet(targets, worker, parallel=DEFAULT_PARALLEL, callback=None):
+    """ Runs the worker function against each target concurrently
+
+    The worker is called once per target from a pool of at most parallel
+    threads.  The worker is expected to return a result dict for the node.
+    Any exception raised by the worker is captured and recorded in the
+    result for that node so that one failed node never stops the fleet.
+
+    When a callback is provided, each result is handed to it as soon as
+    the node completes and only the return code of the node is kept, so
+    the memory used does not grow with the size of the results.  The
+    callback is never called concurrently.
+
+    Args:
+        targets (list): The list of connection names to run against
+        worker (callable): The function called with the connection name
+        parallel (int): The maximum number of nodes to work on at once
+        callback (callable): Optional function called with each result
+
+    Returns:
+        list: The list of result dicts in the same order as targets or the
+            list of return codes if a callback is provided
+
+    """
+    results = [None] * len(targets)
+    queue = Queue()
+    for index, target in enumerate(targets):
+        queue.put((index, target))
+    lock = threading.Lock()
+
+    def work():
+        # every target is queued up front, so the worker stops once the
+        # queue is empty
+        while True:
+            try:
+                index, target = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                result = worker(target)
+            except Exception as exc:    # pylint: disable=broad-except
+                result = dict(connection=target, retcode=2, status=None,
+                              error=str(exc))
+            if callback is not None:
+                with lock:
+                    callback(result)
+                result = result['retcode']
+            results[index] = result
+
+    threads = list()
+    for _ in range(max(1, min(parallel, len(targets)))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+def fleet_retcode(results):
+    """ Returns the fleet-level exit code for the list of node results
+
+    Args:
+        results (list): The list of node result dicts or return codes
+
+    Returns:
+        int: 0 if every node completed successfully otherwise the highest
+            node return code
+
+    """
+    return max([r if isinstance(r, int) else r['retcode']
+                for r in results] or [0])
@@ -0,0 +1,211 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+""" Timing and I/O instrumentation for eapictl
+
+The Metrics class collects timing spans and counters recorded by Ssh, Eapi
+and the polling helpers.  Spans are aggregated by name into a count, total
+and maximum duration so the memory used does not grow with the number of
+operations.
+
+Applications embedding eapictl can subscribe to every span and counter
+update as it is recorded:
+
+    def hook(kind, name, value):
+        print kind, name, value
+
+    eapictl.metrics.subscribe(hook)
+
+The following spans are recorded:
+
+    tcp_connect     TCP connection to the SSH port
+    ssh_handshake   SSH key exchange and authentication
+    shell           opening the interactive shell and reading the prompt
+    command         a single command round trip
+    batch           a pipelined or exec channel batch of commands
+    poll            waiting for an eAPI status change
+    poll_sleep      sleeping between status polls
+    eapi_request    an eAPI request sent to verify the service
+    prescan         probing the SSH and eAPI ports of all nodes of a run
+
+The following counters are recorded:
+
+    bytes_sent, bytes_received, recv_calls, prompt_checks, commands,
+    poll_iterations, connect_retries, eapi_fallbacks
+
+"""
+import time
+import threading
+
+from contextlib import contextmanager
+
+HOOKS = list()
+
+
+def subscribe(hook):
+    """ Subscribes the hook to the updates of all Metrics instances
+
+    Args:
+        hook (callable): Called with the kind ("span" or "counter"), the
+            name and the value of each update
+
+    """
+    HOOKS.append(hook)
+
+def unsubscribe(hook):
+    """ Removes a hook added with subscribe
+
+    Args:
+        hook (callable): The hook to remove
+
+    """
+    HOOKS.remove(hook)
+
+def percentile(values, pct):
+    """ Returns the nearest-rank percentile of values
+
+    Args:
+        values (list): The list of samples
+        pct (float): The percentile to return, between 0 and 100
+
+    Returns:
+        float: The sample at the percentile or None if there are no samples
+
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+class Metrics(object):
+    """ Collects timing spans and counters
+
+    Attributes:
+        counters (dict): The counter values keyed by name
+        spans (dict): The span aggregates keyed by name.  Each aggregate is
+            a list of count, total seconds and maximum seconds
+
+    """
+
+    def __init__(self):
+        self.counters = dict()
+        self.spans = dict()
+        self._lock = threading.Lock()
+
+    def _notify(self, kind, name, value):
+        for hook in HOOKS:
+            hook(kind, name, value)
+
+    def incr(self, name, value=1):
+        """ Increments the counter by value
+
+        Args:
+            name (str): The name of the counter
+            value (int): The amount to add to the counter
+
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if HOOKS:
+            self._notify('counter', name, value)
+
+    def record(self, name, duration):
+        """ Records a span duration
+
+        Args:
+            name (str): The name of the span
+            duration (float): The duration of the span in seconds
+
+        """
+        with self._lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += duration
+            span[2] = max(span[2], duration)
+        if HOOKS:
+            self._notify('span', name, duration)
+
+    @contextmanager
+    def span(self, name):
+        """ Times the enclosed block and records it as a span
+
+        Args:
+            name (str): The name of the span
+
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def todict(self):
+        """ Returns the metrics as a dict
+
+        Returns:
+            dict: The counters and the spans with count, total and max keys
+
+        """
+        with self._lock:
+            spans = dict((name, dict(count=count, total=round(total, 6),
+                                     max=round(longest, 6)))
+                         for name, (count, total, longest)
+                         in self.spans.items())
+            return dict(counters=dict(self.counters), spans=spans)
+
+    def prometheus(self):
+        """ Returns the metrics in the Prometheus text exposition format
+
+        Returns:
+            str: The metrics text
+
+        """
+        data = self.todict()
+        lines = list()
+        for name, value in sorted(data['counters'].items()):
+            lines.append('# TYPE eapictl_%s_total counter' % name)
+            lines.append('eapictl_%s_total %s' % (name, value))
+
+        if data['spans']:
+            lines.append('# TYPE eapictl_span_seconds summary')
+            for name, span in sorted(data['spans'].items()):
+                lines.append('eapictl_span_seconds_count{span="%s"} %d'
+                             % (name, span['count']))
+                lines.append('eapictl_span_seconds_sum{span="%s"} %s'
+                             % (name, span['total']))
+            lines.append('# TYPE eapictl_span_seconds_max gauge')
+            for name, span in sorted(data['spans'].items()):
+                lines.append('eapictl_span_seconds_max{span="%s"} %s'
+                             % (name, span['max']))
+        return '\n'.join(lines)
@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" Rolling rollouts of eapictl actions across a fleet
+
+A rollout runs an action against the fleet in batches so that only a
+bounded share of the nodes has eAPI down at any time.  Each batch is run
+with a bounded number of concurrent workers and is followed by a health
+check of its nodes.  Failed actions and failed health checks count against
+a failure budget and the rollout halts once the budget is exceeded.
+
+The progress of a rollout is saved to a state file after every batch.
+Running the rollout again with the same state file skips the nodes that
+already completed.
+
+Example:
+
+    # restart eAPI on 10% of the leaf nodes at a time, stop after 2 failures
+    $ eapictl restart @leaf --batch-size 10% --max-failures 2 \
+          --resume restart.state
+
+"""
+import os
+import json
+import tempfile
+
+from eapictl.fleet import DEFAULT_PARALLEL, run_fleet
+
+DEFAULT_MAX_FAILURES = 0
+
+
+def batch_count(value, total):
+    """ Converts a batch size into a number of nodes
+
+    Args:
+        value (str): The batch size as a number of nodes or as a
+            percentage of the fleet, such as "10%"
+        total (int): The number of nodes in the fleet
+
+    Returns:
+        int: The number of nodes per batch, at least 1
+
+    Raises:
+        ValueError: If the value is not a valid batch size
+
+    """
+    value = str(value).strip()
+    if value.endswith('%'):
+        percent = float(value[:-1])
+        if not 0 < percent <= 100:
+            raise ValueError('invalid batch size: %s' % value)
+        return max(1, int(total * percent / 100))
+
+    count = int(value)
+    if count < 1:
+        raise ValueError('invalid batch size: %s' % value)
+    return count
+
+def plan_batches(targets, batch_size):
+    """ Splits the targets into consecutive batches
+
+    Args:
+        targets (list): The ordered list of connection names
+        batch_size (str): The batch size as accepted by batch_count
+
+    Returns:
+        list: The list of batches, each a list of connection names
+
+    """
+    count = batch_count(batch_size, len(targets))
+    return [targets[index:index + count]
+            for index in range(0, len(targets), count)]
+
+def load_state(path):
+    """ Loads the rollout state file
+
+    Args:
+        path (str): The full path to the state file
+
+    Returns:
+        dict: The state with the list of completed nodes.  An empty state
+            is returned if the file does not exist
+
+    """
+    if path is None or not os.path.exists(path):
+        return dict(completed=list())
+    with open(path) as state_file:
+        state = json.load(state_file)
+    state.setdefault('completed', list())
+    return state
+
+def save_state(path, state):
+    """ Atomically writes the rollout state file
+
+    Args:
+        path (str): The full path to the state file
+        state (dict): The state to write
+
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    handle, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    with os.fdopen(handle, 'w') as tmpfile:
+        json.dump(state, tmpfile, indent=2)
+    os.rename(tmpname, path)
+
+def run_rollout(targets, worker, batch_size, parallel=DEFAULT_PARALLEL,
+                max_failures=DEFAULT_MAX_FAILURES, health=None,
+                state_file=None, callback=None):
+    """ Runs the worker against the targets batch by batch
+
+    Each batch is run with at most parallel concurrent workers.  Once the
+    batch completes, the nodes whose worker succeeded are checked with the
+    health function.  A node fails if its worker returns a non-zero retcode
+    or its health check fails.  The rollout halts after the batch in which
+    the number of failures exceeds max_failures.
+
+    Args:
+        targets (list): The ordered list of connection names
+        worker (callable): The function called with the connection name.
+            Returns the result dict for the node
+        batch_size (str): The batch size as accepted by batch_count
+        parallel (int): The maximum number of nodes worked on at once
+            within a batch
+        max_failures (int): The number of failed nodes tolerated before the
+            rollout halts
+        health (callable): Optional function called with the connection
+            name and result of a node.  Returns an error message or None if
+            the node is healthy
+        state_file (str): Optional path to the file recording the progress
+            used to resume the rollout
+        callback (callable): Optional function called with the result of
+            each node once its batch is checked.  Only the return codes of
+            the nodes are kept when provided
+
+    Returns:
+        tuple: The list of result dicts, or return codes if a callback is
+            provided, for the nodes run and True if the rollout halted
+            before all batches were run
+
+    """
+    state = load_state(state_file)
+    completed = set(state['completed'])
+    pending = [name for name in targets if name not in completed]
+
+    results = list()
+    failures = 0
+    for batch in plan_batches(pending, batch_size) if pending else []:
+        batch_results = run_fleet(batch, worker, min(parallel, len(batch)))
+
+        if health is not None:
+            healthy = [r for r in batch_results if r['retcode'] == 0]
+            checks = run_fleet(healthy, lambda r: dict(
+                retcode=0, error=health(r['connection'], r)), parallel)
+            for result, check in zip(healthy, checks):
+                if check.get('error'):
+                    result['retcode'] = 2
+                    result['error'] = check['error']
+
+        for result in batch_results:
+            if result['retcode'] == 0:
+                state['completed'].append(result['connection'])
+            else:
+                failures += 1
+            if callback is not None:
+                callback(result)
+                result = result['retcode']
+            results.append(result)
+
+        if state_file is not None:
+            save_state(state_file, state)
+
+        if failures > max_failures:
+            return results, len(results) < len(pending)
+
+    return results, False
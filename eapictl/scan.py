@@ -0,0 +1,235 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" Parallel TCP reachability scan of the SSH and eAPI ports
+
+The scan starts a non-blocking TCP connect to the SSH port and the eAPI
+port of every target at once and waits for all of them with a single
+timeout, so a fleet run learns which nodes are down before any worker
+spends a full SSH connection attempt on them.  Each target is classified
+as unreachable, SSH only or eAPI listening.
+
+The hostnames are resolved in parallel within the same timeout, so a slow
+resolver does not delay the scan beyond it.
+
+"""
+import time
+import errno
+import select
+import socket
+import threading
+
+from Queue import Queue, Empty
+
+DEFAULT_SCAN_TIMEOUT = 1
+
+# Caps the number of connections in progress and the file descriptors used
+MAX_SOCKETS = 512
+
+# The number of threads resolving hostnames at once
+MAX_RESOLVERS = 32
+
+UNREACHABLE = 'unreachable'
+SSH_ONLY = 'ssh-only'
+EAPI_LISTENING = 'eapi-listening'
+
+CONNECTING = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK)
+
+
+def resolve(hosts, deadline):
+    """ Resolves the hostnames in parallel
+
+    Args:
+        hosts (iterable): The hostnames or IP addresses to resolve
+        deadline (float): The time.time() value to stop waiting at
+
+    Returns:
+        dict: The (family, socktype, proto, sockaddr) tuple of the first
+            address of each host keyed by host.  Hosts that cannot be
+            resolved before the deadline are left out
+
+    """
+    queue = Queue()
+    for host in set(hosts):
+        queue.put(host)
+    resolved = dict()
+    lock = threading.Lock()
+
+    def work():
+        while time.time() < deadline:
+            try:
+                host = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+                    host, None, 0, socket.SOCK_STREAM)[0]
+            except (socket.error, UnicodeError):
+                continue
+            with lock:
+                resolved[host] = (family, socktype, proto, sockaddr)
+
+    threads = list()
+    for _ in range(min(MAX_RESOLVERS, queue.qsize())):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+
+    with lock:
+        return dict(resolved)
+
+def scan_ports(addresses, timeout=DEFAULT_SCAN_TIMEOUT):
+    """ Returns the addresses accepting TCP connections
+
+    The hostnames are resolved and the first MAX_SOCKETS connections are
+    waited for within timeout seconds.  Each further group of MAX_SOCKETS
+    connections waits for at most timeout seconds more.  Addresses that
+    cannot be resolved in time are reported as closed.
+
+    Args:
+        addresses (iterable): The (host, port) tuples to connect to
+        timeout (float): The number of seconds to wait for the connections
+
+    Returns:
+        set: The (host, port) tuples that accepted a connection
+
+    """
+    addresses = list(set(addresses))
+    deadline = time.time() + timeout
+    resolved = resolve([host for host, _ in addresses], deadline)
+    listening = set()
+    for index in range(0, len(addresses), MAX_SOCKETS):
+        listening.update(_scan(addresses[index:index + MAX_SOCKETS],
+                               resolved, deadline))
+        deadline = time.time() + timeout
+    return listening
+
+def _scan(addresses, resolved, deadline):
+    pending = dict()
+    listening = set()
+    try:
+        for address in addresses:
+            if address[0] not in resolved:
+                continue
+            family, socktype, proto, sockaddr = resolved[address[0]]
+            try:
+                sockaddr = (sockaddr[0], int(address[1])) + sockaddr[2:]
+                sock = socket.socket(family, socktype, proto)
+            except (socket.error, ValueError):
+                continue
+            sock.setblocking(0)
+            error = sock.connect_ex(sockaddr)
+            if error in CONNECTING:
+                pending[sock.fileno()] = (sock, address)
+                continue
+            if error == 0:
+                listening.add(address)
+            sock.close()
+
+        for fileno in wait_writable(list(pending), deadline):
+            sock, address = pending.pop(fileno)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                listening.add(address)
+            sock.close()
+    finally:
+        for sock, _ in pending.values():
+            sock.close()
+    return listening
+
+def wait_writable(filenos, deadline):
+    """ Yields the file descriptors as they turn writable
+
+    poll is used where available since select cannot wait for file
+    descriptors at or above FD_SETSIZE.
+
+    Args:
+        filenos (list): The file descriptors to wait for
+        deadline (float): The time.time() value to stop waiting at
+
+    Yields:
+        int: The file descriptors that are writable or in error
+
+    """
+    waiting = set(filenos)
+    poller = None
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        for fileno in waiting:
+            poller.register(fileno, select.POLLOUT)
+
+    while waiting:
+        # connections completed by the deadline are still collected
+        left = max(0, deadline - time.time())
+        if poller is not None:
+            ready = [fileno for fileno, _ in poller.poll(left * 1000)]
+        else:
+            _, ready, _ = select.select([], list(waiting), [], left)
+        for fileno in ready:
+            if fileno in waiting:
+                waiting.discard(fileno)
+                if poller is not None:
+                    poller.unregister(fileno)
+                yield fileno
+        if not left:
+            return
+
+def classify(targets, timeout=DEFAULT_SCAN_TIMEOUT):
+    """ Classifies the targets by the ports they answer on
+
+    Args:
+        targets (dict): The (host, SSH port, eAPI port) tuples keyed by
+            target name
+        timeout (float): The number of seconds to wait for the connections
+
+    Returns:
+        dict: One of UNREACHABLE, SSH_ONLY or EAPI_LISTENING keyed by target
+            name
+
+    """
+    addresses = set()
+    for host, ssh_port, eapi_port in targets.values():
+        addresses.update([(host, ssh_port), (host, eapi_port)])
+    listening = scan_ports(addresses, timeout)
+
+    classes = dict()
+    for name, (host, ssh_port, eapi_port) in targets.items():
+        if (host, eapi_port) in listening:
+            classes[name] = EAPI_LISTENING
+        elif (host, ssh_port) in listening:
+            classes[name] = SSH_ONLY
+        else:
+            classes[name] = UNREACHABLE
+    return classes
@@ -0,0 +1,204 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" Local store of the last known eAPI state of each node
+
+Every run records the eAPI status returned by each node and the eAPI
+configuration the action applied in a SQLite database, keyed by host and
+connection profile.  Later runs use the records to skip nodes that are
+already in the desired state and the state action reads them to report
+the state of the whole fleet without connecting to any node.
+
+The database is shared by concurrent eapictl processes and the agent.
+Failing to open or write the database is not an error, the run then
+simply does not use the store.  The sqlite3 module is imported when the
+store is opened to keep it off the start-up path.
+
+"""
+import os
+import json
+import time
+import threading
+
+from eapictl.config import DEFAULT_INDEX_DIR
+
+DEFAULT_STATE_FILE = os.path.join(DEFAULT_INDEX_DIR, 'state.db')
+
+# Records older than this many seconds are not used to skip nodes
+DEFAULT_MAX_AGE = 600
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS nodes (
+    host TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    action TEXT,
+    status TEXT,
+    applied TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (host, profile)
+)"""
+
+COLUMNS = ['host', 'profile', 'action', 'status', 'applied', 'error',
+           'updated']
+
+
+class StateStore(object):
+    """ Reads and writes the node records in the state database
+
+    The store can be used from several threads at once.
+
+    Attributes:
+        filename (str): The full path to the database file
+
+    Args:
+        filename (str): The path to the database file.  Default value is
+            ~/.cache/eapictl/state.db
+
+    Raises:
+        sqlite3.Error: If the database cannot be opened
+        OSError: If the database directory cannot be created
+
+    """
+
+    def __init__(self, filename=DEFAULT_STATE_FILE):
+        self.filename = os.path.expanduser(filename)
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0o700)
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.filename, timeout=5,
+                                     check_same_thread=False)
+        with self._conn:
+            self._conn.execute(SCHEMA)
+
+    def record(self, host, profile, status, action=None, applied=None,
+               error=None):
+        """ Records the state of the node
+
+        Args:
+            host (str): The hostname or address of the node
+            profile (str): The name of the connection profile
+            status (dict): The eAPI status returned by the node
+            action (str): The action run against the node
+            applied (dict): The eAPI configuration applied by the action.
+                If None, the configuration recorded previously is kept
+            error (str): The error reported for the node
+
+        Returns:
+            bool: True if the record was written
+
+        """
+        values = [action, json.dumps(status),
+                  json.dumps(applied) if applied is not None else None,
+                  error, time.time(), host, profile]
+        try:
+            with self._lock, self._conn:
+                cursor = self._conn.execute(
+                    'UPDATE nodes SET action = ?, status = ?, '
+                    'applied = COALESCE(?, applied), error = ?, updated = ? '
+                    'WHERE host = ? AND profile = ?', values)
+                if cursor.rowcount == 0:
+                    self._conn.execute(
+                        'INSERT INTO nodes (action, status, applied, error, '
+                        'updated, host, profile) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        values)
+        except self._sqlite3.Error:
+            return False
+        return True
+
+    def get(self, host, profile):
+        """ Returns the record of the node
+
+        Args:
+            host (str): The hostname or address of the node
+            profile (str): The name of the connection profile
+
+        Returns:
+            dict: The record or None if the node has no record
+
+        """
+        rows = self._select('WHERE host = ? AND profile = ?', (host, profile))
+        return rows[0] if rows else None
+
+    def query(self):
+        """ Returns the records of all nodes
+
+        Returns:
+            list: The records sorted by profile and host
+
+        """
+        return self._select('ORDER BY profile, host')
+
+    def _select(self, clause, params=()):
+        try:
+            with self._lock:
+                rows = self._conn.execute('SELECT %s FROM nodes %s'
+                                          % (', '.join(COLUMNS), clause),
+                                          params).fetchall()
+        except self._sqlite3.Error:
+            return list()
+
+        records = list()
+        for row in rows:
+            record = dict(zip(COLUMNS, row))
+            for key in ['status', 'applied']:
+                if record[key] is not None:
+                    record[key] = json.loads(record[key])
+            records.append(record)
+        return records
+
+    def close(self):
+        """ Closes the database
+        """
+        self._conn.close()
+
+
+def open_store(filename=DEFAULT_STATE_FILE):
+    """ Opens the state database
+
+    Args:
+        filename (str): The path to the database file
+
+    Returns:
+        StateStore: The store or None if the database cannot be opened
+
+    """
+    import sqlite3
+
+    try:
+        return StateStore(filename)
+    except (sqlite3.Error, OSError):
+        return None
@@ -0,0 +1,192 @@
+#
+# Copyright (c) 2015, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+""" End-to-end verification of the eAPI service
+
+EOS reporting the HTTP server as running does not prove that eAPI answers
+requests.  The verification sends real eAPI requests through pyeapi to the
+transport and port of the connection profile and measures their latency.
+
+pyeapi closes the HTTP connection after every request.  EapiClient keeps
+it open instead, so consecutive requests to a node reuse the same TCP and
+TLS connection.  Clients are pooled by the same SessionPool used for SSH
+sessions, so the agent keeps them warm between requests.  A request that
+fails on a reused connection before the node answers, because the node
+closed the idle connection, is sent again on a new connection.
+
+"""
+import time
+import select
+import socket
+import httplib
+
+from eapictl.metrics import Metrics, percentile
+
+DEFAULT_VERIFY_REQUESTS = 5
+
+VERIFY_COMMAND = 'show version'
+
+PERCENTILES = [50, 90, 99]
+
+
+class EapiClient(object):
+    """ Keep-alive eAPI connection to a node
+
+    Args:
+        transport (str): The eAPI transport, "http" or "https"
+        host (str): The hostname or IP address of the node
+        username (str): The username to authenticate eAPI requests
+        password (str): The password to authenticate eAPI requests
+        port (str): The eAPI port
+        timeout (float): The timeout value for each request
+
+    """
+
+    def __init__(self, transport, host, username, password, port,
+                 timeout=10):
+        # pyeapi is imported here to keep it off the start-up path
+        import pyeapi.client
+
+        self.connection = pyeapi.client.connect(transport=transport,
+                                                host=host, username=username,
+                                                password=password,
+                                                port=int(port),
+                                                timeout=timeout)
+        self._transport = self.connection.transport
+        self._close = self._transport.close
+        # httplib reopens a closed connection on the next request, so the
+        # real close is only called when the client is closed
+        self._transport.close = lambda: None
+        self._getresponse = self._transport.getresponse
+        self._transport.getresponse = self._tracked_getresponse
+        self._answered = False
+        self.closed = False
+
+    def _tracked_getresponse(self, *args, **kwargs):
+        response = self._getresponse(*args, **kwargs)
+        self._answered = True
+        return response
+
+    def execute(self, commands, encoding='json'):
+        """ Sends an eAPI request with the commands
+
+        If the request fails on a reused connection before the status line
+        of the response is received, the connection is reopened and the
+        request is sent once more.  The connection is closed if the request
+        fails.
+
+        Args:
+            commands (list): The list of commands to run
+            encoding (str): The response encoding, "json" or "text"
+
+        Returns:
+            dict: The decoded eAPI response
+
+        """
+        from pyeapi.eapilib import ConnectionError as EapiConnectionError
+
+        reused = self._transport.sock is not None
+        self._answered = False
+        try:
+            return self.connection.execute(commands, encoding)
+        except (httplib.HTTPException, EapiConnectionError):
+            if not reused or self._answered:
+                self.close()
+                raise
+        except Exception:
+            self.close()
+            raise
+
+        # the node closed the idle connection
+        self._close()
+        try:
+            return self.connection.execute(commands, encoding)
+        except Exception:
+            self.close()
+            raise
+
+    def isalive(self):
+        """ Checks if the client can still be used
+
+        Returns:
+            bool: False if the client is closed or the node has closed the
+                idle connection
+
+        """
+        if self.closed:
+            return False
+        sock = self._transport.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        # an idle connection only turns readable when the node closes it
+        return not readable
+
+    def close(self):
+        self._close()
+        self.closed = True
+
+
+def verify_eapi(client, requests=DEFAULT_VERIFY_REQUESTS, metrics=None):
+    """ Sends eAPI requests to the node and measures their latency
+
+    Args:
+        client (EapiClient): The client connected to the node
+        requests (int): The number of requests to send
+        metrics (Metrics): Optional Metrics instance to record the
+            eapi_request spans
+
+    Returns:
+        dict: The number of requests, the EOS version reported by the node
+            and the request latency percentiles in milliseconds
+
+    Raises:
+        Exception: Any error raised by pyeapi for a failed request
+
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    latencies = list()
+    version = None
+    for _ in range(max(1, requests)):
+        start = time.time()
+        with metrics.span('eapi_request'):
+            response = client.execute([VERIFY_COMMAND])
+        latencies.append(time.time() - start)
+        version = response['result'][0].get('version')
+
+    latency = dict(('p%d' % pct, round(percentile(latencies, pct) * 1000, 3))
+                   for pct in PERCENTILES)
+    return dict(requests=len(latencies), version=version, latency=latency)
@@ -75,6 +75,7 @@ setup(
     entry_points={
         'console_scripts': [
             'eapictl=eapictl:main',
+            'eapictl-agent=eapictl.agent:main',
         ],
     },
 )
@@ -0,0 +1,165 @@
+""" Performance benchmarks for eapictl against the EOS emulator
+
+The benchmarks run against in-process EOS emulators so they can be run on
+a laptop without any switches.  Two sets of results are reported:
+
+  * the latency percentiles of each operation (connect, status, start,
+    stop and a compliant apply) for the shell, pipelined shell and exec
+    channel transports
+  * the fleet throughput of a status sweep across concurrency levels,
+    including the eAPI backend against nodes with eAPI running
+
+Example:
+
+    $ python test/bench/bench_eapictl.py --rtt 0.02 --nodes 50
+
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+
+from eosemu import EosEmulator, EapiEmulator
+
+import eapictl.app
+import eapictl.fleet
+
+from eapictl.metrics import percentile
+
+MODES = [
+    ('shell', []),
+    ('pipeline', ['--pipeline']),
+    ('exec', ['--channel', 'exec'])
+]
+
+FLEET_MODES = MODES + [('eapi', ['--backend', 'eapi'])]
+
+PERCENTILES = [50, 90, 99]
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+def make_args(mode_args, action='status'):
+    return eapictl.app.parse_args([action, 'node', '--no-agent'] + mode_args)
+
+def connect(emulator, args):
+    cls = eapictl.app.SshExec if args.channel == 'exec' else eapictl.app.Ssh
+    ssh = cls('127.0.0.1', 'admin', '', port=emulator.port,
+              pipeline=args.pipeline)
+    if cls is eapictl.app.Ssh:
+        assert ssh.shell is not None
+    return ssh
+
+def bench_operations(opts):
+    """ Measures the latency of each operation for each transport
+    """
+    rows = list()
+    for mode, mode_args in MODES:
+        emulator = EosEmulator(rtt=opts.rtt, chunk_size=opts.chunk_size,
+                               start_delay=opts.start_delay).start()
+        args = make_args(mode_args)
+        samples = dict(connect=[], status=[], start=[], stop=[], apply=[])
+        try:
+            for _ in range(opts.iterations):
+                start = time.time()
+                ssh = connect(emulator, args)
+                samples['connect'].append(time.time() - start)
+
+                eapi = eapictl.app.Eapi(ssh)
+                samples['status'].append(timed(eapi.status, refresh=True))
+                samples['start'].append(timed(eapictl.app.enable_eapi, eapi))
+                samples['apply'].append(timed(eapi.apply, 'https', '443'))
+                samples['stop'].append(timed(eapictl.app.disable_eapi, eapi))
+                ssh.close()
+        finally:
+            emulator.stop()
+
+        for operation in ['connect', 'status', 'start', 'stop', 'apply']:
+            values = samples[operation]
+            rows.append([mode, operation] +
+                        ['%.1f' % (percentile(values, p) * 1000)
+                         for p in PERCENTILES])
+
+    print 'Operation latency (ms), rtt=%sms, %d iterations' % \
+        (opts.rtt * 1000, opts.iterations)
+    print_table(['transport', 'operation'] + ['p%d' % p for p in PERCENTILES],
+                rows)
+
+def bench_fleet(opts):
+    """ Measures the status sweep throughput across concurrency levels
+    """
+    emulators = [EosEmulator(hostname='veos%02d' % i, rtt=opts.rtt,
+                             chunk_size=opts.chunk_size).start()
+                 for i in range(opts.nodes)]
+    servers = [EapiEmulator(rtt=opts.rtt, device=e.device).start()
+               for e in emulators]
+    for emulator, server in zip(emulators, servers):
+        emulator.device.configure('no shutdown')
+        emulator.device.configure('protocol http port %s' % server.port)
+    profiles = dict(('veos%02d' % i, dict(host='127.0.0.1', server_port=e.port,
+                                          username='admin', password='',
+                                          transport='http', port=s.port))
+                    for i, (e, s) in enumerate(zip(emulators, servers)))
+    names = sorted(profiles)
+
+    rows = list()
+    try:
+        for mode, mode_args in FLEET_MODES:
+            args = make_args(mode_args)
+
+            def worker(name, args=args):
+                return eapictl.app.run_node(name, profiles[name], args)
+
+            for parallel in opts.parallel:
+                start = time.time()
+                results = eapictl.fleet.run_fleet(names, worker, parallel)
+                elapsed = time.time() - start
+                failed = len([r for r in results if r['retcode']])
+                rows.append([mode, str(parallel), '%.2f' % elapsed,
+                             '%.1f' % (len(names) / elapsed), str(failed)])
+    finally:
+        for server in servers:
+            server.stop()
+        for emulator in emulators:
+            emulator.stop()
+
+    print 'Fleet status sweep, %d nodes, rtt=%sms' % \
+        (opts.nodes, opts.rtt * 1000)
+    print_table(['transport', 'parallel', 'seconds', 'nodes/s', 'failed'],
+                rows)
+
+def print_table(header, rows):
+    widths = [max(len(r[i]) for r in [header] + rows)
+              for i in range(len(header))]
+    for row in [header] + rows:
+        print '  '.join(v.rjust(w) for v, w in zip(row, widths))
+    print
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--rtt', type=float, default=0.02,
+                        help='Emulated round trip time in seconds')
+    parser.add_argument('--chunk-size', type=int,
+                        help='Splits emulator responses into chunks')
+    parser.add_argument('--start-delay', type=float, default=0.5,
+                        help='Seconds before the HTTP server is running')
+    parser.add_argument('--nodes', type=int, default=20)
+    parser.add_argument('--parallel', type=int, nargs='+',
+                        default=[1, 5, 10, 20])
+    return parser.parse_args(args)
+
+def main(args=None):
+    opts = parse_args(args)
+    bench_operations(opts)
+    bench_fleet(opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+""" Start-up time benchmark for the eapictl command
+
+Scripts often run eapictl hundreds of times, so the time spent starting
+the interpreter and importing modules adds up.  The benchmark reports the
+time to import eapictl.app and to run eapictl --help in a new interpreter,
+and lists the heavy modules pulled in by the import.  It exits with 1 if
+any of them is imported at start-up.
+
+Example:
+
+    $ python test/bench/bench_import.py --iterations 50
+
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+
+sys.path.append(ROOT)
+
+from eapictl.metrics import percentile
+
+HEAVY_MODULES = ['paramiko', 'pyeapi', 'cryptography', 'Crypto', 'sqlite3']
+
+PERCENTILES = [50, 90, 99]
+
+COMMANDS = [
+    ('python', ['-c', 'pass']),
+    ('import', ['-c', 'import eapictl.app']),
+    ('--help', ['-c', 'import eapictl.app; eapictl.app.main(["--help"])'])
+]
+
+
+def run(args):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.call([sys.executable] + args, cwd=ROOT, stdout=devnull,
+                        stderr=devnull)
+        return time.time() - start
+
+def imported_modules():
+    """ Returns the heavy modules imported by eapictl.app
+    """
+    code = ('import sys, eapictl.app; '
+            'print " ".join(m for m in %r if m in sys.modules)'
+            % HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return output.split()
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20)
+    return parser.parse_args(args)
+
+def main(args=None):
+    opts = parse_args(args)
+
+    print 'Start-up time (ms), %d iterations' % opts.iterations
+    for name, command in COMMANDS:
+        values = [run(command) for _ in range(opts.iterations)]
+        columns = ['p%d=%.1f' % (p, percentile(values, p) * 1000)
+                   for p in PERCENTILES]
+        print '%8s  %s' % (name, '  '.join(columns))
+
+    modules = imported_modules()
+    if modules:
+        print 'heavy modules imported at start-up: %s' % ', '.join(modules)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,635 @@
+""" In-process SSH server emulating the EOS CLI used by eapictl
+
+The emulator implements just enough of the EOS CLI for the commands sent by
+eapictl: the exec, privileged and configuration modes and their prompts,
+show management api http-commands (text and JSON), the management api
+http-commands section of the running config and the management api
+http-commands configuration mode, also within configure sessions with
+commit timers.  Both interactive shells and exec
+channels are supported.
+
+The link to the emulated node can be slowed down with a round trip time,
+responses can be split into small chunks and the HTTP server can be made
+to take a while before it reaches the running state.
+
+Example:
+
+    emulator = EosEmulator(rtt=0.05, start_delay=1)
+    emulator.start()
+    ssh = eapictl.app.Ssh('127.0.0.1', 'admin', '', port=emulator.port)
+    ...
+    emulator.stop()
+
+EapiEmulator serves the eAPI JSON-RPC endpoint over plain HTTP with
+keep-alive connections and counts the TCP connections it accepts.
+
+"""
+import json
+import time
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import paramiko
+
+DEFAULT_HOSTNAME = 'veos01'
+
+PROMPTS = {
+    'exec': '>',
+    'enable': '#',
+    'config': '(config)#',
+    'config-mgmt-api-http-cmds': '(config-mgmt-api-http-cmds)#'
+}
+
+INVALID_INPUT = '% Invalid input'
+PRIVILEGED_REQUIRED = '% Invalid input (privileged mode required)'
+
+HOST_KEY = None
+
+
+def host_key():
+    """ Returns the host key shared by all emulators
+
+    Generating an RSA key is slow so a single key is created on first use.
+    """
+    global HOST_KEY
+    if HOST_KEY is None:
+        HOST_KEY = paramiko.RSAKey.generate(1024)
+    return HOST_KEY
+
+
+class EosDevice(object):
+    """ The eAPI state of an emulated node shared by all of its sessions
+
+    Args:
+        hostname (str): The hostname shown in the prompt
+        start_delay (float): Seconds between no shutdown and the HTTP
+            server reaching the running state
+        json (bool): False to emulate an EOS release without JSON output
+        tech_lines (int): The number of lines of show tech-support output
+
+    """
+
+    def __init__(self, hostname=DEFAULT_HOSTNAME, start_delay=0, json=True,
+                 tech_lines=1000):
+        self.hostname = hostname
+        self.start_delay = start_delay
+        self.json = json
+        self.tech_lines = tech_lines
+        self.sessions = dict()
+        self.rollbacks = dict()
+        self.commits = 0
+        self.shutdown = True
+        self.protocols = dict(http=None, https='443')
+        self.changed = 0
+        self.commands = list()
+        self.lock = threading.Lock()
+
+    def running(self):
+        return not self.shutdown and \
+            time.time() - self.changed >= self.start_delay
+
+    def configure(self, line, dry_run=False):
+        """ Applies a management api http-commands configuration line
+
+        With dry_run the line is only validated.
+        """
+        with self.lock:
+            words = line.split()
+            negate = words[0] == 'no'
+            if negate:
+                words = words[1:]
+
+            if words == ['shutdown']:
+                if self.shutdown == negate and not dry_run:
+                    self.shutdown = not negate
+                    self.changed = time.time()
+            elif words[:1] == ['protocol'] and \
+                    words[1:2] in (['http'], ['https']):
+                protocol = words[1]
+                if negate:
+                    port = None
+                elif words[2:3] == ['port'] and len(words) == 4:
+                    port = words[3]
+                elif len(words) == 2:
+                    port = '443' if protocol == 'https' else '80'
+                else:
+                    return INVALID_INPUT
+                if not dry_run:
+                    self.protocols[protocol] = port
+                    self.changed = time.time()
+            else:
+                return INVALID_INPUT
+        return ''
+
+    def commit(self, name, timer=None):
+        """ Applies the lines staged in the configuration session
+
+        With a commit timer, the previous configuration is restored after
+        timer seconds unless the commit is confirmed.
+        """
+        snapshot = (self.shutdown, dict(self.protocols))
+        for line in self.sessions.pop(name):
+            self.configure(line)
+        self.commits += 1
+        if timer:
+            rollback = threading.Timer(timer, self.rollback, args=(name,))
+            rollback.daemon = True
+            self.rollbacks[name] = (snapshot, rollback)
+            rollback.start()
+
+    def confirm(self, name):
+        """ Confirms a commit made with a commit timer
+        """
+        self.rollbacks.pop(name)[1].cancel()
+
+    def rollback(self, name):
+        with self.lock:
+            snapshot, _ = self.rollbacks.pop(name, (None, None))
+            if snapshot is not None:
+                self.shutdown, self.protocols = snapshot
+                self.changed = time.time()
+
+    def server_state(self, protocol):
+        if self.protocols[protocol] is None:
+            return 'shutdown'
+        return 'running' if self.running() else 'enabled'
+
+    def status(self):
+        lines = [
+            'Enabled:            %s' % ('No' if self.shutdown else 'Yes'),
+            'HTTPS server:       %s, set to use port %s'
+            % (self.server_state('https'), self.protocols['https'] or '443'),
+            'HTTP server:        %s, set to use port %s'
+            % (self.server_state('http'), self.protocols['http'] or '80'),
+            'Local HTTP server:  shutdown, no authentication, set to use '
+            'port 8080',
+            'Unix Socket server: shutdown, no authentication',
+            'VRF:                default',
+            'Hits:               0'
+        ]
+        return '\r\n'.join(lines)
+
+    def status_json(self):
+        def server(protocol, default):
+            port = self.protocols[protocol]
+            return dict(configured=port is not None,
+                        running=port is not None and self.running(),
+                        port=int(port or default))
+
+        data = dict(enabled=not self.shutdown,
+                    httpServer=server('http', '80'),
+                    httpsServer=server('https', '443'),
+                    localHttpServer=dict(configured=False, running=False,
+                                         port=8080),
+                    unixSocketServer=dict(configured=False, running=False),
+                    vrfs=['default'])
+        return json.dumps(data, indent=4).replace('\n', '\r\n')
+
+    def running_config(self):
+        lines = ['management api http-commands']
+        for protocol in ['https', 'http']:
+            port = self.protocols[protocol]
+            if port is None:
+                lines.append('   no protocol %s' % protocol)
+            else:
+                lines.append('   protocol %s port %s' % (protocol, port))
+        lines.append('   no protocol http localhost')
+        lines.append('   no protocol unix-socket')
+        lines.append('   %sshutdown' % ('' if self.shutdown else 'no '))
+        lines.append('   vrf default')
+        lines.append('      no shutdown')
+        return '\r\n'.join(lines)
+
+
+class Cli(object):
+    """ A single CLI session on the emulated node
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.mode = 'exec'
+        self.session = None
+
+    def prompt(self):
+        if self.session is not None:
+            # EOS shows the first characters of the session name
+            mode = self.mode.replace('config-s', 'config-s-%s'
+                                     % self.session[:6])
+            return '%s(%s)#' % (self.device.hostname, mode)
+        return self.device.hostname + PROMPTS[self.mode]
+
+    def run_session(self, words):
+        """ Runs a configure session command
+        """
+        if self.mode == 'exec':
+            return PRIVILEGED_REQUIRED
+        device = self.device
+        name = words[2]
+        if len(words) == 3:
+            device.sessions.setdefault(name, list())
+            self.session = name
+            self.mode = 'config-s'
+        elif words[3:] == ['abort'] and name in device.sessions:
+            del device.sessions[name]
+        elif words[3:4] == ['commit'] and name in device.rollbacks:
+            device.confirm(name)
+        elif words[3:4] == ['commit'] and name in device.sessions:
+            timer = None
+            if words[4:5] == ['timer'] and len(words) == 6:
+                hours, minutes, seconds = words[5].split(':')
+                timer = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+            elif len(words) != 4:
+                return INVALID_INPUT
+            device.commit(name, timer)
+        else:
+            return INVALID_INPUT
+        return ''
+
+    def run(self, line):
+        """ Runs the command line and returns its output
+        """
+        line = line.strip()
+        self.device.commands.append(line)
+        if not line:
+            return ''
+
+        if line == 'enable':
+            if self.mode == 'exec':
+                self.mode = 'enable'
+            return ''
+        elif line in ('enable 0', 'disable'):
+            self.mode = 'exec'
+            return ''
+        elif line.startswith('show '):
+            if self.mode == 'exec':
+                return PRIVILEGED_REQUIRED
+            return self.show(line)
+        elif line.startswith('configure session '):
+            return self.run_session(line.split())
+        elif line in ('commit', 'abort') and self.session is not None:
+            if line == 'commit':
+                self.device.commit(self.session)
+            else:
+                del self.device.sessions[self.session]
+            self.session = None
+            self.mode = 'enable'
+            return ''
+        elif line in ('configure', 'configure terminal'):
+            if self.mode == 'exec':
+                return PRIVILEGED_REQUIRED
+            self.mode = 'config'
+            return ''
+        elif line == 'end':
+            if self.mode != 'exec':
+                self.mode = 'enable'
+            self.session = None
+            return ''
+        elif line == 'exit':
+            if self.mode.endswith('-mgmt-api-http-cmds'):
+                self.mode = self.mode[:-len('-mgmt-api-http-cmds')]
+            elif self.mode in ('config', 'config-s'):
+                self.mode = 'enable'
+                self.session = None
+            return ''
+        elif self.mode.startswith('config'):
+            if line == 'management api http-commands':
+                self.mode = 'config-s-mgmt-api-http-cmds' if self.session \
+                    else 'config-mgmt-api-http-cmds'
+                return ''
+            elif self.mode == 'config-mgmt-api-http-cmds':
+                return self.device.configure(line)
+            elif self.mode == 'config-s-mgmt-api-http-cmds':
+                output = self.device.configure(line, dry_run=True)
+                if not output:
+                    self.device.sessions[self.session].append(line)
+                return output
+        return INVALID_INPUT
+
+    def show(self, line):
+        if line == 'show management api http-commands':
+            return self.device.status()
+        elif line == 'show management api http-commands | json':
+            if not self.device.json:
+                return INVALID_INPUT
+            return self.device.status_json()
+        elif line == 'show running-config all | section management api ' \
+                     'http-commands':
+            return self.device.running_config()
+        elif line == 'show version':
+            return 'Arista vEOS\r\nSoftware image version: 4.15.0F'
+        elif line == 'show tech-support':
+            return '\r\n'.join('tech-support line %d' % index
+                               for index in range(self.device.tech_lines))
+        return INVALID_INPUT
+
+
+class SessionHandler(object):
+    """ Sends the CLI output for one channel honouring the link settings
+    """
+
+    def __init__(self, emulator, channel):
+        self.emulator = emulator
+        self.channel = channel
+        self.cli = Cli(emulator.device)
+
+    def send(self, data, arrival):
+        delay = arrival + self.emulator.rtt - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        size = self.emulator.chunk_size or len(data) or 1
+        for index in range(0, len(data), size):
+            self.channel.sendall(data[index:index + size])
+            if self.emulator.chunk_delay and index + size < len(data):
+                time.sleep(self.emulator.chunk_delay)
+
+    def shell(self):
+        try:
+            self.send('Last login: never\r\n' + self.cli.prompt(), time.time())
+            pending = ''
+            while True:
+                data = self.channel.recv(4096)
+                if not data:
+                    return
+                arrival = time.time()
+                pending += data
+                while '\n' in pending:
+                    line, pending = pending.split('\n', 1)
+                    line = line.rstrip('\r')
+                    output = self.cli.run(line)
+                    if output:
+                        output += '\r\n'
+                    self.send('%s\r\n%s%s' % (line, output, self.cli.prompt()),
+                              arrival)
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.channel.close()
+
+    def execute(self, command):
+        # the exec request is acknowledged by the transport thread after
+        # check_channel_exec_request returns, closing the channel before
+        # that makes the client fail the request
+        time.sleep(0.01)
+        try:
+            arrival = time.time()
+            self.cli.mode = 'exec'
+            output = list()
+            status = 0
+            for line in command.split('\n'):
+                response = self.cli.run(line)
+                if response.startswith('%'):
+                    status = 1
+                if response:
+                    output.append(response + '\r\n')
+            self.send(''.join(output), arrival)
+            self.channel.send_exit_status(status)
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.channel.close()
+
+
+class ServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.emulator.username,
+                                    self.emulator.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.emulator.spawn(SessionHandler(self.emulator, channel).shell)
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        handler = SessionHandler(self.emulator, channel)
+        self.emulator.spawn(handler.execute, command)
+        return True
+
+
+class EosEmulator(object):
+    """ SSH server emulating an EOS node on a local port
+
+    Args:
+        hostname (str): The hostname shown in the prompt
+        username (str): The username accepted by the server
+        password (str): The password accepted by the server
+        rtt (float): Seconds added to every response to emulate the round
+            trip time of the link
+        chunk_size (int): Splits responses into chunks of this many bytes
+        chunk_delay (float): Seconds between the chunks of a response
+        start_delay (float): Seconds between no shutdown and the HTTP
+            server reaching the running state
+        json (bool): False to emulate an EOS release without JSON output
+
+    """
+
+    def __init__(self, hostname=DEFAULT_HOSTNAME, username='admin',
+                 password='', rtt=0, chunk_size=None, chunk_delay=0,
+                 start_delay=0, json=True):
+        self.device = EosDevice(hostname, start_delay, json)
+        self.username = username
+        self.password = password
+        self.rtt = rtt
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.sock = None
+        self.transports = list()
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.spawn(self.serve)
+        return self
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.spawn(self.negotiate, conn)
+
+    def negotiate(self, conn):
+        # like sshd for interactive sessions, disable Nagle's algorithm
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key())
+        self.transports.append(transport)
+        try:
+            transport.start_server(server=ServerInterface(self))
+        except (paramiko.SSHException, EOFError):
+            transport.close()
+
+    def stop(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class EapiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers eAPI runCmds requests on keep-alive HTTP connections
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.emulator.connections += 1
+        self.server.emulator.sockets.append(self.connection)
+
+    def do_POST(self):
+        emulator = self.server.emulator
+        length = int(self.headers.getheader('content-length'))
+        request = json.loads(self.rfile.read(length))
+        if emulator.rtt:
+            time.sleep(emulator.rtt)
+
+        device = emulator.device
+        if device is not None and not device.running():
+            # the HTTP server is down, drop the connection
+            self.close_connection = 1
+            return
+
+        emulator.requests += 1
+        emulator.formats.append(request['params']['format'])
+        cli = Cli(device) if device is not None else None
+        commands = request['params']['cmds']
+        response = dict(jsonrpc='2.0', id=request['id'], result=list())
+        for index, command in enumerate(commands):
+            if command == 'show version':
+                response['result'].append(dict(version=emulator.version,
+                                               modelName='vEOS'))
+                continue
+            elif cli is None:
+                response['result'].append(dict())
+                continue
+
+            output = cli.run(command)
+            if output.startswith('%'):
+                message = "CLI command %d of %d '%s' failed: invalid " \
+                          "command" % (index + 1, len(commands), command)
+                data = response.pop('result') + \
+                    [dict(errors=[output.lstrip('% ')])]
+                response['error'] = dict(code=1002, message=message,
+                                         data=data)
+                break
+            elif request['params']['format'] == 'text':
+                response['result'].append(dict(output=output))
+            else:
+                # like EOS, return the JSON model of the command
+                if not command.endswith('| json'):
+                    output = cli.run('%s | json' % command)
+                try:
+                    response['result'].append(json.loads(output))
+                except ValueError:
+                    response['result'].append(dict())
+        body = json.dumps(response)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EapiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class EapiEmulator(object):
+    """ HTTP server emulating the eAPI endpoint of an EOS node
+
+    Without a device, only show version is answered.  With the device of
+    an EosEmulator, the commands run against its state and the connections
+    are dropped while its HTTP server is not running.
+
+    Attributes:
+        connections (int): The number of TCP connections accepted
+        requests (int): The number of eAPI requests answered
+
+    Args:
+        version (str): The EOS version reported by show version
+        rtt (float): Seconds added to every response
+        device (EosDevice): Optional device state to run the commands on
+
+    """
+
+    def __init__(self, version='4.15.0F', rtt=0, device=None):
+        self.version = version
+        self.rtt = rtt
+        self.device = device
+        self.connections = 0
+        self.requests = 0
+        self.formats = list()
+        self.server = None
+        self.sockets = list()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self, port=0):
+        self.server = EapiServer(('127.0.0.1', port), EapiHandler)
+        self.server.emulator = self
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the server and closes the open connections
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        del self.sockets[:]
+
+    def restart(self):
+        """ Restarts the server on the same port
+        """
+        port = self.port
+        self.stop()
+        return self.start(port)
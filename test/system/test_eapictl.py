@@ -26,13 +26,14 @@ class TestStatus(unittest.TestCase):
     def runcmd(self, cmdline):
         cmdline = str(cmdline).format(connection=self.connection)
         cmdline = shlex.split(cmdline)
-        cmdline.extend(['--config', self.config])
+        cmdline.extend(['--config', self.config, '--no-state'])
         eapictl.app.main(cmdline)
 
     def test_status_command(self):
         """ status {connection}
         """
-        keys = ['http', 'http_port', 'enabled', 'https_port', 'https']
+        keys = ['http', 'http_port', 'enabled', 'https_port', 'https',
+                'local_http', 'local_http_port', 'unix_socket', 'vrfs']
         self.runcmd('status {connection}')
         resp = json.loads(sys.stdout.getvalue())
         self.assertEqual(sorted(resp.keys()), sorted(keys))
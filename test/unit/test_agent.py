@@ -0,0 +1,140 @@
+import os
+import unittest
+import shutil
+import tempfile
+import threading
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+
+from mock import MagicMock, patch
+
+import eapictl.agent
+
+class TestSessionPool(unittest.TestCase):
+
+    def test_acquire_creates_session(self):
+        pool = eapictl.agent.SessionPool()
+        factory = MagicMock()
+        resp = pool.acquire('veos01', factory)
+        self.assertEqual(resp, factory.return_value)
+
+    def test_acquire_reuses_session(self):
+        pool = eapictl.agent.SessionPool()
+        session = MagicMock()
+        session.isalive.return_value = True
+        pool.release('veos01', session)
+        factory = MagicMock()
+        self.assertEqual(pool.acquire('veos01', factory), session)
+        self.assertFalse(factory.called)
+        self.assertEqual(pool.sessions, dict())
+
+    def test_acquire_replaces_dead_session(self):
+        pool = eapictl.agent.SessionPool()
+        session = MagicMock()
+        session.isalive.return_value = False
+        pool.release('veos01', session)
+        factory = MagicMock()
+        self.assertEqual(pool.acquire('veos01', factory),
+                         factory.return_value)
+        self.assertTrue(session.close.called)
+
+    def test_release_duplicate_closes(self):
+        pool = eapictl.agent.SessionPool()
+        first, second = MagicMock(), MagicMock()
+        pool.release('veos01', first)
+        pool.release('veos01', second)
+        self.assertTrue(second.close.called)
+        self.assertFalse(first.close.called)
+
+    def test_evict(self):
+        pool = eapictl.agent.SessionPool(idle_timeout=60)
+        idle, dead, active = MagicMock(), MagicMock(), MagicMock()
+        dead.isalive.return_value = False
+        pool.sessions = dict(idle=(idle, 0), dead=(dead, 100),
+                             active=(active, 100))
+        self.assertEqual(pool.evict(now=120), 2)
+        self.assertEqual(pool.sessions.keys(), ['active'])
+        self.assertTrue(idle.close.called)
+        self.assertTrue(dead.close.called)
+
+
+class TestAgentServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'agent.sock')
+        self.server = eapictl.agent.AgentServer(self.path, None)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _conf(self, name):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as conf:
+            conf.write('[connection:veos01]\n')
+        return filename
+
+    def test_request_no_agent(self):
+        path = os.path.join(self.tmpdir, 'missing.sock')
+        self.assertIsNone(eapictl.agent.request(path, ['status']))
+
+    def test_request_roundtrip(self):
+        def runner(argv, cwd, emit, config):
+            return 0, [' '.join(argv), cwd]
+
+        self.server.runner = runner
+        resp = eapictl.agent.request(self.path, ['status', 'veos01'], '/tmp')
+        self.assertEqual(resp, (0, ['status veos01', '/tmp']))
+
+    def test_request_streams_lines(self):
+        def runner(argv, cwd, emit, config):
+            emit('first')
+            emit('second')
+            return 0, ['last']
+
+        self.server.runner = runner
+        streamed = list()
+        resp = eapictl.agent.request(self.path, ['status'],
+                                     emit=streamed.append)
+        self.assertEqual(streamed, ['first', 'second'])
+        self.assertEqual(resp, (0, ['last']))
+
+    def test_request_runner_error(self):
+        def runner(argv, cwd, emit, config):
+            raise IOError('Socket timeout for host veos01')
+
+        self.server.runner = runner
+        retcode, output = eapictl.agent.request(self.path, ['status'])
+        self.assertEqual(retcode, 2)
+        self.assertIn('veos01', output[0])
+
+    def test_runner_uses_client_config(self):
+        filename = self._conf('client.conf')
+        runner = eapictl.agent.make_runner(eapictl.agent.SessionPool())
+        with patch.dict(os.environ, clear=False):
+            os.environ.pop('EAPI_CONF', None)
+            with patch('eapictl.app.run', return_value=(0, [])) as run:
+                runner(['status', 'veos01'], self.tmpdir, None, filename)
+        self.assertEqual(run.call_args[0][0].config, filename)
+
+    def test_request_runs_locally_on_config_mismatch(self):
+        filename = self._conf('client.conf')
+        self.server.runner = \
+            eapictl.agent.make_runner(eapictl.agent.SessionPool())
+        # the EAPI_CONF of the agent wins over the client file
+        with patch.dict(os.environ, EAPI_CONF=self._conf('agent.conf')):
+            with patch('eapictl.app.run') as run:
+                resp = eapictl.agent.request(self.path, ['status', 'veos01'],
+                                             config=filename)
+        self.assertIsNone(resp)
+        self.assertFalse(run.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,258 @@
 import os
+import time
+import shutil
+import tempfile
 import unittest
 import shlex
+import json
 
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
 
-from mock import patch
+from StringIO import StringIO
+
+from mock import patch, MagicMock
 
 from systestlib import get_fixture
 
 import eapictl.app
+import eapictl.state
+
+class FakeChannel(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sizes = list()
+        self.sent = list()
+
+    def recv(self, size):
+        self.sizes.append(size)
+        if not self.chunks:
+            raise eapictl.app.socket.timeout()
+        return self.chunks.pop(0)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+
+def make_ssh(chunks, cls=eapictl.app.Ssh, prompt='veos01>', status=0,
+             **kwargs):
+    """ Returns an Ssh instance of cls reading chunks from a FakeChannel
+
+    Shell sessions first read the login banner ending with prompt.  Exec
+    channels end with the exit status.
+    """
+    with patch('eapictl.app.connect_ssh'):
+        ssh = cls('veos01', 'admin', '', **kwargs)
+    if issubclass(cls, eapictl.app.SshExec):
+        channel = FakeChannel(chunks + [''])
+        channel.exec_command = MagicMock()
+        channel.set_combine_stderr = MagicMock()
+        channel.recv_exit_status = MagicMock(return_value=status)
+        channel.close = MagicMock()
+        transport = ssh.ssh.get_transport.return_value
+        transport.open_session.return_value = channel
+    else:
+        channel = FakeChannel(['Last login: never\r\n%s' % prompt] + chunks)
+        ssh.ssh.invoke_shell.return_value = channel
+    return ssh, channel
+
+
+class TestResponseReader(unittest.TestCase):
+
+    def test_read_prompt_split_across_chunks(self):
+        channel = FakeChannel(['show version\r\nArista vEOS\r\nveo',
+                               's01#'])
+        reader = eapictl.app.ResponseReader(channel, 'veos01')
+        resp = reader.read()
+        self.assertEqual(resp, 'show version\r\nArista vEOS\r\nveos01#')
+
+    def test_read_timeout(self):
+        reader = eapictl.app.ResponseReader(FakeChannel(['output']), 'veos01')
+        with self.assertRaises(IOError):
+            reader.read()
+
+    def test_read_closed(self):
+        reader = eapictl.app.ResponseReader(FakeChannel(['']), 'veos01')
+        with self.assertRaises(IOError):
+            reader.read()
+
+    def test_read_size_grows(self):
+        size = eapictl.app.MIN_READ_SIZE
+        channel = FakeChannel(['x' * size, 'x' * size * 2, 'veos01>'])
+        reader = eapictl.app.ResponseReader(channel, 'veos01')
+        reader.read()
+        self.assertEqual(channel.sizes, [size, size * 2, size * 4])
+
+    def test_learned_prompt(self):
+        channel = FakeChannel(['show run\r\n   description uplink>',
+                               '\r\nveos01(config)#'])
+        reader = eapictl.app.ResponseReader(channel, 'veos01')
+        reader.learn('Last login: never\r\nveos01>')
+        resp = reader.read()
+        self.assertTrue(resp.endswith('veos01(config)#'))
+
+    def test_stream_prompt_split_across_chunks(self):
+        channel = FakeChannel(['show version\r\nArista vEOS\r\nveo',
+                               's01#'])
+        reader = eapictl.app.ResponseReader(channel, 'veos01')
+        reader.learn('veos01#')
+        resp = ''.join(reader.stream())
+        self.assertEqual(resp, 'show version\r\nArista vEOS\r\n')
+
+    def test_stream_yields_before_prompt(self):
+        window = eapictl.app.PROMPT_WINDOW
+        channel = FakeChannel(['x' * window * 2, '\r\nveos01#'])
+        reader = eapictl.app.ResponseReader(channel, 'veos01')
+        chunks = reader.stream()
+        self.assertEqual(next(chunks), 'x' * window)
+        self.assertEqual(len(channel.chunks), 1)
+        self.assertEqual(''.join(chunks), 'x' * window + '\r\n')
+
+
+class TestStream(unittest.TestCase):
+
+    def test_iter_lines(self):
+        lines = eapictl.app.iter_lines(['one\r\ntw', 'o\r', '\nthree'])
+        self.assertEqual(list(lines), ['one', 'two', 'three'])
+
+    def test_stream_lines(self):
+        ssh, channel = make_ssh(['show run\r\nhostname ve',
+                                 'os01\r\n!\r\nveos01#'], prompt='veos01#')
+        lines = list(ssh.stream('show run'))
+        self.assertEqual(lines, ['hostname veos01', '!'])
+        self.assertEqual(channel.sent, ['show run\n'])
+        self.assertEqual(ssh.metrics.counters['commands'], 1)
+
+    def test_stream_chunks(self):
+        ssh, _ = make_ssh(['show run\r', '\nhostname veos01\r\n',
+                           'veos01#'], prompt='veos01#')
+        chunks = list(ssh.stream('show run', lines=False))
+        self.assertEqual(''.join(chunks), 'hostname veos01\r\n')
+
+    def test_stream_close_drains_output(self):
+        ssh, channel = make_ssh(['show run\r\none\r\n' + 'x' * 512,
+                                 '\r\nveos01#',
+                                 'show version\r\nveos01#'], prompt='veos01#')
+        lines = ssh.stream('show run')
+        self.assertEqual(next(lines), 'one')
+        lines.close()
+        self.assertEqual(channel.chunks, ['show version\r\nveos01#'])
+        self.assertEqual(ssh.send('show version'), 'show version\r\nveos01#')
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_read_batch(self):
+        channel = FakeChannel(['enable\r\nveos01#configure\r\nveos01(con',
+                               'fig)#enable 0\r\nveos01>'])
+        reader = eapictl.app.ResponseReader(channel, 'veos01')
+        reader.learn('veos01>')
+        resp = reader.read_batch(3)
+        self.assertEqual(resp, ['enable\r\nveos01#',
+                                'configure\r\nveos01(config)#',
+                                'enable 0\r\nveos01>'])
+
+    def test_send_config_single_write(self):
+        ssh, channel = make_ssh([
+            'enable\r\nveos01#configure\r\nveos01(config)#management api '
+            'http-commands\r\nveos01(config-mgmt-api-http-cmds)#no shutdown'
+            '\r\nveos01(config-mgmt-api-http-cmds)#'], pipeline=True)
+        commands = ['management api http-commands', 'no shutdown']
+        resp = ssh.send_config(commands)
+        self.assertEqual(len(channel.sent), 1)
+        self.assertEqual(len(resp), 2)
+        self.assertTrue(resp[-1].startswith('no shutdown'))
+        self.assertEqual(ssh.mode, 'config-mgmt-api-http-cmds')
+        self.assertEqual(commands, ['management api http-commands',
+                                    'no shutdown'])
+
+    def test_send_batch_reports_failed_command(self):
+        ssh, channel = make_ssh([
+            'enable\r\nveos01#shw version\r\n% Invalid input\r\nveos01#'],
+            pipeline=True)
+        with self.assertRaises(eapictl.app.CommandError) as exc:
+            ssh.send_enable(['shw version'])
+        self.assertEqual(exc.exception.command, 'shw version')
+
+
+class TestModes(unittest.TestCase):
+
+    def test_prompt_mode(self):
+        for output, mode in [('veos01>', 'exec'), ('\r\nveos01#', 'enable'),
+                             ('veos01(config)#', 'config'),
+                             ('veos01(config-mgmt-api-http-cmds)# ',
+                              'config-mgmt-api-http-cmds'),
+                             ('[admin@veos01 ~]$ ', None)]:
+            self.assertEqual(eapictl.app.prompt_mode(output), mode)
+
+    def test_enable_sent_once(self):
+        ssh, channel = make_ssh(['enable\r\nveos01#',
+                                 'show version\r\nArista\r\nveos01#',
+                                 'show version\r\nArista\r\nveos01#'])
+        commands = ['show version']
+        for _ in range(2):
+            resp = ssh.send_enable(commands)
+            self.assertEqual(len(resp), 1)
+        self.assertEqual(channel.sent, ['enable\n', 'show version\n',
+                                        'show version\n'])
+        self.assertEqual(commands, ['show version'])
+        self.assertEqual(ssh.mode, 'enable')
+
+    def test_config_mode_kept(self):
+        ssh, channel = make_ssh([
+            'enable\r\nveos01#', 'configure\r\nveos01(config)#',
+            'management api http-commands\r\n'
+            'veos01(config-mgmt-api-http-cmds)#',
+            'shutdown\r\nveos01(config-mgmt-api-http-cmds)#',
+            'show version\r\nArista\r\nveos01(config-mgmt-api-http-cmds)#'])
+        ssh.send_config(['management api http-commands', 'shutdown'])
+        ssh.send_enable(['show version'])
+        self.assertEqual(channel.sent, ['enable\n', 'configure\n',
+                                        'management api http-commands\n',
+                                        'shutdown\n', 'show version\n'])
+
+    def test_session_unknown_mode(self):
+        # the login prompt does not show the CLI mode
+        ssh, channel = make_ssh([
+            'enable\r\nveos01#',
+            'configure session s1\r\nveos01(config-s-s1)#',
+            'shutdown\r\nveos01(config-s-s1)#', 'end\r\nveos01#',
+            'configure session s1 commit\r\nveos01#'],
+            prompt='[admin@veos01 ~]$ ')
+        with patch('os.urandom', return_value='\x00' * 4):
+            name = ssh.send_session(['shutdown'])
+        self.assertEqual(name, 'eapictl-00000000')
+        self.assertEqual(channel.sent[0], 'enable\n')
+
+    def test_exec_channel_mode(self):
+        ssh, _ = make_ssh([], eapictl.app.SshExec)
+        self.assertEqual(ssh.mode_commands(eapictl.app.CONFIG_MODE),
+                         ['enable', 'configure'])
+        self.assertFalse(ssh.ssh.invoke_shell.called)
+
+
+class TestSshExec(unittest.TestCase):
+
+    def test_send_enable(self):
+        output = open(get_fixture('show_cmd')).read()
+        ssh, channel = make_ssh([output[:100], output[100:]],
+                                eapictl.app.SshExec)
+        resp = ssh.send_enable(['show management api http-commands'])
+        channel.exec_command.assert_called_with(
+            'enable\nshow management api http-commands')
+        self.assertEqual(resp, [output])
+        self.assertTrue(channel.close.called)
+
+    def test_send_exit_status(self):
+        ssh, _ = make_ssh(['% Invalid input\n'], eapictl.app.SshExec,
+                          status=1)
+        with self.assertRaises(eapictl.app.CommandError):
+            ssh.send('shw version')
+
 
 class TestAppParser(unittest.TestCase):
 
@@ -23,6 +266,27 @@ class TestAppParser(unittest.TestCase):
             result = self._run_parser_test(cmd)
             self.assertIsNotNone(result)
 
+    def test_options_before_node(self):
+        args = self._run_parser_test('start --username admin veos01')
+        self.assertEqual(args.connection, ['veos01'])
+        self.assertEqual(args.username, 'admin')
+
+    def test_nodes_around_options(self):
+        args = self._run_parser_test('status veos01 --parallel 5 veos02 '
+                                     '--probe veos03')
+        self.assertEqual(args.connection, ['veos01', 'veos02', 'veos03'])
+        self.assertEqual(args.parallel, 5)
+        self.assertTrue(args.probe)
+
+    def test_unknown_option_after_node(self):
+        with patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                self._run_parser_test('start veos01 --bogus')
+
+    def test_format_timer(self):
+        self.assertEqual(eapictl.app.format_timer(5), '00:00:05')
+        self.assertEqual(eapictl.app.format_timer(3725), '01:02:05')
+
     def test_default_port_http(self):
         for proto, port in [('http', '80'), ('https', '443')]:
             result = eapictl.app.default_port(proto)
@@ -53,6 +317,117 @@ class TestAppParser(unittest.TestCase):
         resp = eapictl.app.parse_https_port(config)
         self.assertEqual(resp, '443')
 
+    def test_parse_status(self):
+        config = open(get_fixture('show_cmd')).read()
+        resp = eapictl.app.parse_status(config)
+        self.assertEqual(resp, dict(enabled=True, http='running',
+                                    http_port='80', https='shutdown',
+                                    https_port='443', local_http='shutdown',
+                                    local_http_port='8080',
+                                    unix_socket='shutdown',
+                                    vrfs=['default']))
+
+    def test_parse_status_missing_fields(self):
+        resp = eapictl.app.parse_status('Enabled:            No\n')
+        self.assertFalse(resp['enabled'])
+        self.assertIsNone(resp['http'])
+        self.assertIsNone(resp['https_port'])
+        self.assertFalse(eapictl.app.parse_enabled_state(''))
+
+    def test_parse_status_json(self):
+        output = open(get_fixture('show_cmd_json')).read()
+        resp = eapictl.app.parse_status_json(output)
+        self.assertEqual(resp['http'], 'running')
+        self.assertEqual(resp['http_port'], '80')
+        self.assertEqual(resp['https'], 'enabled')
+        self.assertEqual(resp['local_http'], 'shutdown')
+        self.assertEqual(resp['unix_socket'], 'shutdown')
+        self.assertEqual(resp['vrfs'], ['default'])
+
+    def test_parse_status_json_invalid(self):
+        resp = eapictl.app.parse_status_json('% Invalid input\r\nveos01#')
+        self.assertIsNone(resp)
+
+    def test_eapi_status_text_fallback(self):
+        output = open(get_fixture('show_cmd')).read()
+        ssh = MagicMock()
+        ssh.send_enable.side_effect = [['', '% Invalid input'], ['', output],
+                                       ['', output]]
+        eapi = eapictl.app.Eapi(ssh)
+        self.assertEqual(eapi.status()['http'], 'running')
+        self.assertEqual(eapi.status(refresh=True)['http'], 'running')
+        self.assertEqual(ssh.send_enable.call_count, 3)
+
+    def test_eapi_status_snapshot(self):
+        output = open(get_fixture('show_cmd_json')).read()
+        ssh = MagicMock()
+        ssh.send_enable.return_value = ['', output]
+        eapi = eapictl.app.Eapi(ssh)
+        self.assertTrue(eapi.isenabled())
+        self.assertTrue(eapi.isrunning())
+        self.assertEqual(eapi.status()['http'], 'running')
+        self.assertEqual(ssh.send_enable.call_count, 1)
+        eapi.isrunning(refresh=True)
+        self.assertEqual(ssh.send_enable.call_count, 2)
+
+    def test_eapi_status_snapshot_invalidated(self):
+        output = open(get_fixture('show_cmd_json')).read()
+        ssh = MagicMock()
+        ssh.send_enable.return_value = ['', output]
+        eapi = eapictl.app.Eapi(ssh)
+        for method, args in [('enable', ()), ('disable', ()),
+                             ('set_protocol', ('http', '80'))]:
+            eapi.status()
+            getattr(eapi, method)(*args)
+            eapi.status()
+        self.assertEqual(ssh.send_enable.call_count, 4)
+
+    def test_eapi_status_snapshot_expires(self):
+        output = open(get_fixture('show_cmd_json')).read()
+        ssh = MagicMock()
+        ssh.send_enable.return_value = ['', output]
+        eapi = eapictl.app.Eapi(ssh, ttl=0)
+        eapi.status()
+        eapi.status()
+        self.assertEqual(ssh.send_enable.call_count, 2)
+
+    def test_parse_http_commands(self):
+        config = open(get_fixture('running_config')).read()
+        resp = eapictl.app.parse_http_commands(config)
+        self.assertEqual(resp, dict(http=False, https='443', shutdown=False))
+
+    def test_parse_http_commands_missing(self):
+        resp = eapictl.app.parse_http_commands('')
+        self.assertEqual(resp, dict(http=None, https=None, shutdown=None))
+
+    def test_config_delta_compliant(self):
+        config = dict(http=False, https='443', shutdown=False)
+        resp = eapictl.app.config_delta(config, 'https', '443')
+        self.assertEqual(resp, [])
+
+    def test_config_delta(self):
+        config = dict(http=False, https='443', shutdown=False)
+        resp = eapictl.app.config_delta(config, 'http', '8080', True)
+        self.assertEqual(resp, ['no protocol https', 'protocol http port 8080',
+                                'shutdown'])
+
+    def test_eapi_apply_compliant(self):
+        config = open(get_fixture('running_config')).read()
+        ssh = MagicMock()
+        ssh.send_enable.return_value = ['', config]
+        resp = eapictl.app.Eapi(ssh).apply('https', '443')
+        self.assertEqual(resp, [])
+        self.assertFalse(ssh.send_config.called)
+
+    def test_eapi_apply_port(self):
+        config = open(get_fixture('running_config')).read()
+        ssh = MagicMock()
+        ssh.send_enable.return_value = ['', config]
+        resp = eapictl.app.Eapi(ssh).apply('https', '8443')
+        self.assertEqual(resp, ['protocol https port 8443'])
+        ssh.send_config.assert_called_with(['management api http-commands',
+                                            'protocol https port 8443'])
+
     def test_enable_eapi_success(self):
         with patch('eapictl.app.Eapi') as eapi_mock:
             instance = eapi_mock.return_value
@@ -89,6 +464,231 @@ class TestAppParser(unittest.TestCase):
             with self.assertRaises(RuntimeWarning) as exc:
                 eapictl.app.disable_eapi(instance, 2)
 
+    def test_connect_ssh_handshakes(self):
+        handshakes = MagicMock()
+        with patch('paramiko.SSHClient') as client_mock, \
+                patch('eapictl.app.socket.create_connection'):
+            eapictl.app.connect_ssh('veos01', 'admin', '', handshakes)
+            self.assertTrue(client_mock.return_value.connect.called)
+        self.assertTrue(handshakes.__enter__.called)
+        self.assertTrue(handshakes.__exit__.called)
+
+    def test_main_fleet(self):
+        def run_node(name, config, args, handshakes=None, sessions=None,
+                     metrics=None, breaker=None):
+            return dict(connection=name, retcode=0 if name != 'b' else 2)
+
+        with patch('eapictl.app.run_node', side_effect=run_node):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['status', 'a', 'b', 'c',
+                                            '--no-agent', '--no-state'])
+
+        resp = json.loads(stdout.getvalue())
+        self.assertEqual([r['connection'] for r in resp], ['a', 'b', 'c'])
+        self.assertEqual(retcode, 2)
+
+    def test_main_jsonl(self):
+        def run_node(name, config, args, handshakes=None, sessions=None,
+                     metrics=None, breaker=None):
+            return dict(connection=name, host=config['host'], error=None,
+                        retcode=0 if name != 'b' else 2, status=None)
+
+        with patch('eapictl.app.run_node', side_effect=run_node):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['status', 'a', 'b', 'c',
+                                            '--output', 'jsonl',
+                                            '--no-agent', '--no-state'])
+
+        lines = [json.loads(l) for l in stdout.getvalue().splitlines()]
+        self.assertEqual(sorted(l['connection'] for l in lines),
+                         ['a', 'b', 'c'])
+        for line in lines:
+            self.assertEqual(line['action'], 'status')
+            self.assertIn('elapsed', line)
+            self.assertNotIn('error', line)
+            self.assertNotIn('status', line)
+        self.assertEqual(retcode, 2)
+
+    def test_compact_result(self):
+        result = dict(connection='veos01', retcode=0, error=None,
+                      status=dict(enabled=True))
+        resp = eapictl.app.compact_result(result, 'start')
+        self.assertEqual(resp, dict(connection='veos01', retcode=0,
+                                    status=dict(enabled=True),
+                                    action='start'))
+
+    def test_main_rollout(self):
+        def run_node(name, config, args, handshakes=None, sessions=None,
+                     metrics=None, breaker=None):
+            status = dict(enabled=True, http='shutdown', https='running')
+            return dict(connection=name, retcode=0, status=status)
+
+        with patch('eapictl.app.run_node', side_effect=run_node), \
+                patch('eapictl.app.probe_port', side_effect=[True, False]):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['restart', 'a', 'b', 'c',
+                                            '--batch-size', '1',
+                                            '--no-agent', '--no-state'])
+
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Error: Rollout halted'))
+        resp = json.loads(lines[1])
+        self.assertEqual([r['connection'] for r in resp], ['a', 'b'])
+        self.assertEqual(resp[1]['error'], 'eAPI is not answering on port 443')
+        self.assertEqual(retcode, 2)
+
+    def test_check_health(self):
+        args = eapictl.app.parse_args(['stop', 'veos01'])
+        config = dict(host='veos01')
+        result = dict(status=dict(enabled=False, http='shutdown',
+                                  https='enabled'))
+        self.assertIsNone(eapictl.app.check_health(config, args, result))
+        args.action = 'restart'
+        self.assertEqual(eapictl.app.check_health(config, args, result),
+                         'eAPI is not enabled')
+
+    def test_parse_args_batch_size(self):
+        with patch('sys.stderr', new_callable=StringIO):
+            with self.assertRaises(SystemExit):
+                eapictl.app.parse_args(['restart', 'veos*',
+                                        '--batch-size', '0'])
+
+    def test_timeout_for(self):
+        now = eapictl.app.time.time()
+        self.assertEqual(eapictl.app.timeout_for(5, None, 'veos01'), 5)
+        self.assertIsNone(eapictl.app.timeout_for(None, None, 'veos01'))
+        self.assertLessEqual(eapictl.app.timeout_for(5, now + 1, 'veos01'), 1)
+        self.assertEqual(eapictl.app.timeout_for(0.5, now + 60, 'veos01'), 0.5)
+        with self.assertRaises(IOError):
+            eapictl.app.timeout_for(5, now - 1, 'veos01')
+
+    def test_backoff(self):
+        for attempt in range(1, 10):
+            delay = eapictl.app.backoff(attempt, 0.5, 4)
+            base = min(0.5 * 2 ** (attempt - 1), 4)
+            self.assertTrue(base * 0.5 <= delay <= base * 1.5)
+
+    def test_connect_ssh_banner_timeout(self):
+        # a listening socket that never sends the SSH banner
+        server = eapictl.app.socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        start = eapictl.app.time.time()
+        try:
+            with self.assertRaises(Exception):
+                eapictl.app.connect_ssh('127.0.0.1', 'admin', '', port=port,
+                                        timeout=0.5)
+        finally:
+            server.close()
+        self.assertLess(eapictl.app.time.time() - start, 2)
+
+    def test_connect_ssh_circuit_open(self):
+        breaker = eapictl.app.CircuitBreaker(threshold=2)
+        error = eapictl.app.socket.error('connection refused')
+        with patch('eapictl.app.socket.create_connection',
+                   side_effect=error) as connect_mock, \
+                patch('eapictl.app.time.sleep'):
+            for host in ['10.0.0.1', '10.0.0.2']:
+                with self.assertRaises(eapictl.app.socket.error):
+                    eapictl.app.connect_ssh(host, 'admin', '', retries=1,
+                                            breaker=breaker)
+            # the subnet failed twice, its next host is not attempted
+            with self.assertRaises(IOError) as exc:
+                eapictl.app.connect_ssh('10.0.0.3', 'admin', '', retries=1,
+                                        breaker=breaker)
+        self.assertIn('Circuit open', str(exc.exception))
+        self.assertEqual(connect_mock.call_count, 4)
+        self.assertTrue(breaker.allow('10.0.1.1'))
+
+    def test_main_breaker_skips_failed_subnet(self):
+        error = eapictl.app.socket.error('connection refused')
+        hosts = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4']
+        with patch('eapictl.app.socket.create_connection',
+                   side_effect=error) as connect_mock:
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['status'] + hosts + [
+                    '--parallel', '1', '--batch-size', '1',
+                    '--max-failures', '4', '--retries', '0',
+                    '--breaker-threshold', '2', '--no-agent',
+                    '--no-state'])
+        errors = [r['error'] for r in json.loads(stdout.getvalue())]
+        self.assertEqual(retcode, 2)
+        self.assertEqual(connect_mock.call_count, 2)
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(all('Circuit open' in e for e in errors[2:]))
+
+    def test_connect_ssh_retries_exhausted(self):
+        error = eapictl.app.socket.error('connection refused')
+        with patch('eapictl.app.socket.create_connection',
+                   side_effect=error) as connect_mock, \
+                patch('eapictl.app.time.sleep'):
+            with self.assertRaises(eapictl.app.socket.error):
+                eapictl.app.connect_ssh('veos01', 'admin', '', retries=2)
+        self.assertEqual(connect_mock.call_count, 3)
+
+    def test_wait_for_backoff(self):
+        sleeps = list()
+        check = MagicMock(side_effect=[False, False, False, True])
+        with patch('eapictl.app.time.sleep', side_effect=sleeps.append):
+            eapictl.app.wait_for(check, eapictl.app.time.time() + 60,
+                                 interval=0.1, max_interval=0.2)
+        self.assertEqual(len(sleeps), 3)
+        self.assertTrue(0.05 <= sleeps[0] <= 0.15)
+        self.assertTrue(all(0.1 <= s <= 0.3 for s in sleeps[1:]))
+
+    def test_wait_for_deadline(self):
+        check = MagicMock(return_value=False)
+        with self.assertRaises(RuntimeWarning):
+            eapictl.app.wait_for(check, eapictl.app.time.time() + 0.3)
+
+    def test_probe_port(self):
+        server = eapictl.app.socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        self.assertTrue(eapictl.app.probe_port('127.0.0.1', port))
+        server.close()
+        self.assertFalse(eapictl.app.probe_port('127.0.0.1', port))
+
+    def test_enable_eapi_probe(self):
+        instance = MagicMock()
+        instance.isrunning.return_value = True
+        with patch('eapictl.app.probe_port', return_value=True) as probe:
+            eapictl.app.enable_eapi(instance, 2, ('veos01', '80'))
+        probe.assert_called_with('veos01', '80')
+        self.assertTrue(instance.isrunning.called)
+
+    def test_disable_eapi_probe_timeout(self):
+        instance = MagicMock()
+        with patch('eapictl.app.probe_port', return_value=True):
+            with self.assertRaises(RuntimeWarning):
+                eapictl.app.disable_eapi(instance, 0.5, ('veos01', '80'))
+        self.assertFalse(instance.isstopped.called)
+
+    def test_main_uses_agent(self):
+        with patch('eapictl.app.agent.request') as request_mock:
+            request_mock.return_value = (0, ['{"enabled": true}'])
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['status', 'veos01'])
+        args = request_mock.call_args[0]
+        self.assertEqual(args, (eapictl.app.agent.DEFAULT_AGENT_SOCKET,
+                                ['status', 'veos01']))
+        self.assertEqual(stdout.getvalue(), '{"enabled": true}\n')
+        self.assertEqual(retcode, 0)
+
+    def test_run_node_releases_session(self):
+        args = eapictl.app.parse_args(['status', 'veos01'])
+        config = dict(host='veos01', server_port=22, username='admin',
+                      password='')
+        sessions = MagicMock()
+        with patch('eapictl.app.Eapi'):
+            eapictl.app.run_node('veos01', config, args, sessions=sessions)
+        ssh = sessions.acquire.return_value
+        sessions.release.assert_called_with(
+            eapictl.app.session_key(config, args), ssh)
+        self.assertFalse(ssh.close.called)
+
     def test_check_prompt(self):
         prompts = ['localhost>', 'localhost#', 'localhost(config)#',
                    'veos01(config-mgmt-api-http-cmds)#']
@@ -97,6 +697,184 @@ class TestAppParser(unittest.TestCase):
             resp = eapictl.app.check_prompt('localhost>')
             self.assertTrue(prompt)
 
+    def test_check_prompt_no_match(self):
+        resp = eapictl.app.check_prompt('Enabled:            Yes\r\n')
+        self.assertFalse(resp)
+
+
+
+class TestPrescan(unittest.TestCase):
+
+    def _main(self, argv, classes):
+        def run_node(name, config, args, handshakes=None, sessions=None,
+                     metrics=None, breaker=None):
+            return dict(connection=name, host=config['host'], retcode=0,
+                        error=None, status=None)
+
+        def run_verify(name, config, args, sessions=None, metrics=None):
+            return dict(connection=name, host=config['host'],
+                        retcode=0 if name == 'a' else 2, error=None,
+                        status=None, verify=dict(requests=1))
+
+        with patch('eapictl.app.classify', return_value=classes), \
+                patch('eapictl.app.run_node', side_effect=run_node) as node, \
+                patch('eapictl.app.run_verify', side_effect=run_verify):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(argv + ['--prescan', '--no-agent',
+                                                   '--no-state'])
+        resp = dict((r['connection'], r) for r in
+                    json.loads(stdout.getvalue()))
+        return retcode, resp, sorted(c[0][0] for c in node.call_args_list)
+
+    def test_prescan_start(self):
+        classes = dict(a=eapictl.app.EAPI_LISTENING,
+                       b=eapictl.app.EAPI_LISTENING,
+                       c=eapictl.app.SSH_ONLY,
+                       d=eapictl.app.UNREACHABLE)
+        retcode, resp, ran = self._main(['start', 'a', 'b', 'c', 'd'],
+                                        classes)
+        # a is verified, b fails verification and is started over SSH
+        self.assertEqual(ran, ['b', 'c'])
+        self.assertEqual(resp['a']['verify'], dict(requests=1))
+        self.assertTrue(resp['d']['error'].startswith('Host unreachable'))
+        self.assertEqual(resp['d']['prescan'], 'unreachable')
+        self.assertEqual(resp['c']['prescan'], 'ssh-only')
+        self.assertEqual(retcode, 2)
+
+    def test_prescan_verify(self):
+        classes = dict(a=eapictl.app.SSH_ONLY, b=eapictl.app.EAPI_LISTENING)
+        retcode, resp, _ = self._main(['verify', 'a', 'b'], classes)
+        self.assertEqual(resp['a']['error'],
+                         'eAPI is not listening on port 443')
+        self.assertEqual(resp['b']['prescan'], 'eapi-listening')
+        self.assertEqual(retcode, 2)
+
+    def test_prescan_targets(self):
+        args = eapictl.app.parse_args(['start', 'a', 'b', '--transport',
+                                       'http', '--prescan-timeout', '0.5'])
+        with patch('eapictl.app.classify') as classify:
+            eapictl.app.prescan_targets(['a', 'b'], args)
+        classify.assert_called_with(dict(a=('a', 22, '80'), b=('b', 22, '80')),
+                                    0.5)
+
+
+class TestConverged(unittest.TestCase):
+
+    running = dict(enabled=True, http='shutdown', https='running')
+    stopped = dict(enabled=False, http='shutdown', https='enabled')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'state.db')
+        self.store = eapictl.state.StateStore(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _converged(self, argv, record, probe=True):
+        args = eapictl.app.parse_args(argv)
+        with patch('eapictl.app.probe_port', return_value=probe) as probe_port:
+            resp = eapictl.app.is_converged(dict(host='veos01'), args, record)
+        return resp, probe_port
+
+    def _record(self, status, **kwargs):
+        record = dict(status=status, applied=None, error=None,
+                      updated=time.time())
+        record.update(kwargs)
+        return record
+
+    def test_converged_start(self):
+        resp, probe = self._converged(['start', 'veos01'],
+                                      self._record(self.running))
+        self.assertTrue(resp)
+        probe.assert_called_with('veos01', '443')
+
+    def test_converged_start_port_closed(self):
+        resp, _ = self._converged(['start', 'veos01'],
+                                  self._record(self.running), probe=False)
+        self.assertFalse(resp)
+
+    def test_converged_stop(self):
+        resp, _ = self._converged(['stop', 'veos01'],
+                                  self._record(self.stopped), probe=False)
+        self.assertTrue(resp)
+        resp, _ = self._converged(['stop', 'veos01'],
+                                  self._record(self.running), probe=False)
+        self.assertFalse(resp)
+
+    def test_converged_record_stale_or_failed(self):
+        stale = self._record(self.running, updated=time.time() - 60)
+        resp, probe = self._converged(['start', 'veos01',
+                                       '--state-max-age', '30'], stale)
+        self.assertFalse(resp)
+        self.assertFalse(probe.called)
+        failed = self._record(self.running, error='failed')
+        self.assertFalse(self._converged(['start', 'veos01'], failed)[0])
+        self.assertFalse(self._converged(['start', 'veos01'], None)[0])
+
+    def test_converged_apply(self):
+        applied = dict(protocol='http', port='8080', shutdown=False)
+        record = self._record(self.running, applied=applied)
+        resp, _ = self._converged(['apply', 'veos01'], record)
+        self.assertFalse(resp)
+        resp, _ = self._converged(['apply', 'veos01', '--transport', 'http',
+                                   '--eapi-port', '8080'], record)
+        self.assertTrue(resp)
+
+    def test_not_converged_actions(self):
+        for action in ['status', 'restart', 'verify']:
+            resp, _ = self._converged([action, 'veos01'],
+                                      self._record(self.running))
+            self.assertFalse(resp)
+
+    def test_main_skip_converged(self):
+        self.store.record('a', 'a', self.running, 'start')
+
+        def run_node(name, config, args, handshakes=None, sessions=None,
+                     metrics=None, breaker=None):
+            return dict(connection=name, host=config['host'], retcode=0,
+                        error=None, status=self.running)
+
+        with patch('eapictl.app.run_node', side_effect=run_node) as mock, \
+                patch('eapictl.app.probe_port', return_value=True):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['start', 'a', 'b', '--no-agent',
+                                            '--skip-converged',
+                                            '--state-db', self.filename])
+
+        resp = json.loads(stdout.getvalue())
+        self.assertTrue(resp[0]['cached'])
+        self.assertNotIn('cached', resp[1])
+        self.assertEqual([c[0][0] for c in mock.call_args_list], ['b'])
+        self.assertEqual(self.store.get('b', 'b')['action'], 'start')
+        self.assertEqual(retcode, 0)
+
+    def test_main_no_state(self):
+        def run_node(name, config, args, handshakes=None, sessions=None,
+                     metrics=None, breaker=None):
+            return dict(connection=name, host=config['host'], retcode=0,
+                        error=None, status=self.running)
+
+        with patch('eapictl.app.run_node', side_effect=run_node):
+            with patch('sys.stdout', new_callable=StringIO):
+                eapictl.app.main(['status', 'a', '--no-agent', '--no-state',
+                                  '--state-db', self.filename])
+        self.assertEqual(self.store.query(), [])
+
+    def test_main_state(self):
+        self.store.record('10.0.0.1', 'veos01', self.running, 'start')
+        self.store.record('10.0.0.2', 'spine01', self.stopped, 'stop')
+        with patch('eapictl.app.run_node') as mock:
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                retcode = eapictl.app.main(['state', 'veos*', '--no-agent',
+                                            '--state-db', self.filename])
+        resp = json.loads(stdout.getvalue())
+        self.assertEqual([r['profile'] for r in resp], ['veos01'])
+        self.assertEqual(resp[0]['status'], self.running)
+        self.assertIn('age', resp[0])
+        self.assertFalse(mock.called)
+        self.assertEqual(retcode, 0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+
+from systestlib import get_fixture
+
+from mock import patch
+
+import eapictl.config
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.config = eapictl.config.Config(get_fixture('eapi_profiles.conf'),
+                                            self.index_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_connections(self):
+        self.assertEqual(sorted(self.config.connections),
+                         ['spine01', 'veos01', 'veos02'])
+
+    def test_get_connection(self):
+        resp = self.config.get_connection('veos01')
+        self.assertEqual(resp['host'], '192.168.1.16')
+        self.assertEqual(resp['username'], 'eapi')
+        self.assertEqual(resp['transport'], 'http')
+
+    def test_get_connection_defaults_host_to_name(self):
+        resp = self.config.get_connection('veos02')
+        self.assertEqual(resp['host'], 'veos02')
+
+    def test_get_connection_returns_copy(self):
+        self.config.get_connection('veos01')['host'] = 'changed'
+        resp = self.config.get_connection('veos01')
+        self.assertEqual(resp['host'], '192.168.1.16')
+
+    def test_get_connection_missing(self):
+        self.assertIsNone(self.config.get_connection('veos99'))
+
+    def test_tags(self):
+        self.assertEqual(self.config.tags, dict(leaf=['veos01', 'veos02'],
+                                                lab=['veos01']))
+
+    def test_missing_file(self):
+        config = eapictl.config.Config('/does/not/exist', self.index_dir)
+        with patch.dict(os.environ, clear=True):
+            self.assertEqual(config.connections, [])
+
+    def test_eapi_conf_environment(self):
+        config = eapictl.config.Config(index_dir=None)
+        env = dict(EAPI_CONF=get_fixture('eapi_profiles.conf'))
+        with patch.dict(os.environ, env):
+            self.assertIn('spine01', config.connections)
+
+    def test_load_config(self):
+        with patch.object(eapictl.config, 'config',
+                          eapictl.config.Config(index_dir=None)):
+            eapictl.config.load_config(get_fixture('eapi_profiles.conf'))
+            resp = eapictl.config.config_for('spine01')
+            self.assertEqual(resp['host'], '192.168.1.30')
+
+    def test_index_is_saved(self):
+        self.assertEqual(self.config.connections,
+                         ['spine01', 'veos01', 'veos02'])
+        self.assertEqual(len(os.listdir(self.index_dir)), 1)
+
+    def test_index_is_reused(self):
+        filename = get_fixture('eapi_profiles.conf')
+        eapictl.config.load_index(filename, self.index_dir)
+        with patch.object(eapictl.config, 'read_profiles') as read_mock:
+            index = eapictl.config.load_index(filename, self.index_dir)
+            self.assertFalse(read_mock.called)
+        self.assertEqual(index['profiles']['veos01']['username'], 'eapi')
+
+    def test_index_rebuilt_when_file_changes(self):
+        filename = os.path.join(self.index_dir, 'eapi.conf')
+        with open(filename, 'w') as conf:
+            conf.write('[connection:veos01]\n')
+        index = eapictl.config.load_index(filename, self.index_dir)
+        self.assertEqual(index['names'], ['veos01'])
+
+        with open(filename, 'a') as conf:
+            conf.write('[connection:veos02]\n')
+        mtime = time.time() + 10
+        os.utime(filename, (mtime, mtime))
+        index = eapictl.config.load_index(filename, self.index_dir)
+        self.assertEqual(index['names'], ['veos01', 'veos02'])
+
+    def test_config_reloaded_when_file_changes(self):
+        filename = os.path.join(self.index_dir, 'eapi.conf')
+        with open(filename, 'w') as conf:
+            conf.write('[connection:veos01]\nhost: 10.0.0.1\n')
+        config = eapictl.config.Config(filename, self.index_dir)
+        self.assertEqual(config.get_connection('veos01')['host'], '10.0.0.1')
+
+        with open(filename, 'w') as conf:
+            conf.write('[connection:veos01]\nhost: 10.0.0.2\n')
+        mtime = time.time() + 10
+        os.utime(filename, (mtime, mtime))
+        self.assertEqual(config.get_connection('veos01')['host'], '10.0.0.2')
+
+    def test_index_corrupt_file_is_rebuilt(self):
+        filename = get_fixture('eapi_profiles.conf')
+        path = eapictl.config.index_path(filename, self.index_dir)
+        with open(path, 'w') as index_file:
+            index_file.write('garbage')
+        index = eapictl.config.load_index(filename, self.index_dir)
+        self.assertIn('veos02', index['names'])
+
+    def test_index_dir_not_writable(self):
+        filename = get_fixture('eapi_profiles.conf')
+        index = eapictl.config.load_index(filename, '/proc/eapictl')
+        self.assertIn('veos02', index['names'])
+
+    def test_app_import_skips_heavy_modules(self):
+        # eapictl.app must not import paramiko, pyeapi or sqlite3 until
+        # they are needed so short commands start quickly
+        root = os.path.join(os.path.dirname(__file__), '../..')
+        code = ('import sys, eapictl.app; '
+                'print sorted(m for m in ("paramiko", "pyeapi", "sqlite3") '
+                'if m in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=root)
+        self.assertEqual(output.strip(), '[]')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+import os
+import unittest
+import time
+import threading
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+
+from systestlib import get_fixture
+
+from mock import patch
+
+import eapictl.fleet
+
+class TestFleet(unittest.TestCase):
+
+    def test_isglob(self):
+        self.assertTrue(eapictl.fleet.isglob('veos*'))
+        self.assertTrue(eapictl.fleet.isglob('veos0[12]'))
+        self.assertFalse(eapictl.fleet.isglob('veos01'))
+
+    def test_load_inventory(self):
+        resp = eapictl.fleet.load_inventory(get_fixture('inventory'))
+        self.assertEqual(resp, ['veos01', 'veos02', 'spine*'])
+
+    def test_select_targets(self):
+        profiles = ['veos01', 'veos02', 'spine01', 'spine02', 'localhost']
+        names = ['veos01', 'spine*', 'spine01', '192.168.1.16']
+        resp = eapictl.fleet.select_targets(names, profiles)
+        self.assertEqual(resp, ['veos01', 'spine01', 'spine02',
+                                '192.168.1.16'])
+
+    def test_select_targets_tags(self):
+        profiles = ['veos01', 'veos02', 'spine01']
+        tags = dict(leaf=['veos01', 'veos02'])
+        names = ['@leaf', 'spine01', '@missing']
+        resp = eapictl.fleet.select_targets(names, profiles, tags)
+        self.assertEqual(resp, ['veos01', 'veos02', 'spine01'])
+
+    def test_isselector(self):
+        self.assertTrue(eapictl.fleet.isselector('@leaf'))
+        self.assertTrue(eapictl.fleet.isselector('veos*'))
+        self.assertFalse(eapictl.fleet.isselector('veos01'))
+
+    def test_run_fleet_preserves_order(self):
+        def worker(name):
+            time.sleep(0.01 * (5 - int(name)))
+            return dict(connection=name, retcode=0)
+
+        targets = [str(i) for i in range(5)]
+        resp = eapictl.fleet.run_fleet(targets, worker, parallel=5)
+        self.assertEqual([r['connection'] for r in resp], targets)
+
+    def test_run_fleet_callback(self):
+        def worker(name):
+            time.sleep(0.02 * (3 - int(name)))
+            return dict(connection=name, retcode=int(name) % 2 * 2)
+
+        streamed = list()
+        resp = eapictl.fleet.run_fleet(['0', '1', '2'], worker, 3,
+                                       streamed.append)
+        self.assertEqual([r['connection'] for r in streamed],
+                         ['2', '1', '0'])
+        self.assertEqual(resp, [0, 2, 0])
+        self.assertEqual(eapictl.fleet.fleet_retcode(resp), 2)
+
+    def test_run_fleet_bounds_workers(self):
+        lock = eapictl.fleet.threading.Lock()
+        active = dict(current=0, peak=0)
+
+        def worker(name):
+            with lock:
+                active['current'] += 1
+                active['peak'] = max(active['peak'], active['current'])
+            time.sleep(0.01)
+            with lock:
+                active['current'] -= 1
+            return dict(connection=name, retcode=0)
+
+        eapictl.fleet.run_fleet([str(i) for i in range(20)], worker, 3)
+        self.assertLessEqual(active['peak'], 3)
+
+    def test_run_fleet_captures_errors(self):
+        def worker(name):
+            raise IOError('Socket timeout for host %s' % name)
+
+        resp = eapictl.fleet.run_fleet(['veos01'], worker)
+        self.assertEqual(resp[0]['retcode'], 2)
+        self.assertIn('veos01', resp[0]['error'])
+
+    def test_run_fleet_stops_workers(self):
+        def worker(name):
+            return dict(connection=name, retcode=0)
+
+        count = threading.active_count()
+        for _ in range(5):
+            eapictl.fleet.run_fleet(['veos%02d' % i for i in range(10)],
+                                    worker)
+        self.assertEqual(threading.active_count(), count)
+
+    def test_handshake_limiter(self):
+        self.assertIsNone(eapictl.fleet.handshake_limiter(0))
+        limiter = eapictl.fleet.handshake_limiter(2)
+        self.assertTrue(limiter.acquire(False))
+        self.assertTrue(limiter.acquire(False))
+        self.assertFalse(limiter.acquire(False))
+
+    def test_run_fleet_keeps_stack_size(self):
+        # stack_size() without a size resets it, so read it by setting it
+        previous = threading.stack_size(256 * 1024)
+        try:
+            eapictl.fleet.run_fleet(['veos01'], lambda n: dict(retcode=0))
+        finally:
+            current = threading.stack_size(previous)
+        self.assertEqual(current, 256 * 1024)
+
+    def test_set_stack_size(self):
+        previous = threading.stack_size()
+        try:
+            eapictl.fleet.set_stack_size()
+        finally:
+            current = threading.stack_size(previous)
+        self.assertEqual(current, eapictl.fleet.THREAD_STACK_SIZE)
+
+    def test_circuit_breaker(self):
+        breaker = eapictl.fleet.CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.failure('veos01')
+        self.assertTrue(breaker.allow('veos01'))
+        breaker.failure('veos01')
+        self.assertFalse(breaker.allow('veos01'))
+        self.assertTrue(breaker.isopen('veos01'))
+        self.assertTrue(breaker.allow('veos02'))
+
+    def test_failure_domain(self):
+        self.assertEqual(eapictl.fleet.failure_domain('10.1.2.3'),
+                         '10.1.2.0/24')
+        self.assertEqual(eapictl.fleet.failure_domain('10.1.2.3', 16),
+                         '10.1.0.0/16')
+        self.assertEqual(eapictl.fleet.failure_domain('10.1.2.3', 32),
+                         '10.1.2.3')
+        with patch('eapictl.fleet.socket.gethostbyname',
+                   side_effect=eapictl.fleet.socket.error):
+            self.assertEqual(eapictl.fleet.failure_domain('veos01'), 'veos01')
+
+    def test_circuit_breaker_subnet(self):
+        breaker = eapictl.fleet.CircuitBreaker(threshold=2)
+        breaker.failure('10.0.0.1')
+        breaker.failure('10.0.0.2')
+        self.assertFalse(breaker.allow('10.0.0.3'))
+        self.assertTrue(breaker.allow('10.0.1.3'))
+        breaker = eapictl.fleet.CircuitBreaker(threshold=2, prefix=32)
+        breaker.failure('10.0.0.1')
+        breaker.failure('10.0.0.2')
+        self.assertTrue(breaker.allow('10.0.0.3'))
+
+    def test_circuit_breaker_half_open(self):
+        breaker = eapictl.fleet.CircuitBreaker(threshold=2, reset_timeout=0)
+        breaker.failure('veos01')
+        breaker.failure('veos01')
+        self.assertTrue(breaker.allow('veos01'))
+        breaker.failure('veos01')
+        breaker.reset_timeout = 60
+        self.assertFalse(breaker.allow('veos01'))
+        breaker.success('veos01')
+        self.assertTrue(breaker.allow('veos01'))
+
+    def test_circuit_breaker_disabled(self):
+        breaker = eapictl.fleet.CircuitBreaker(threshold=0)
+        for _ in range(10):
+            breaker.failure('veos01')
+        self.assertTrue(breaker.allow('veos01'))
+
+    def test_fleet_retcode(self):
+        results = [dict(retcode=0), dict(retcode=2), dict(retcode=0)]
+        self.assertEqual(eapictl.fleet.fleet_retcode(results), 2)
+        self.assertEqual(eapictl.fleet.fleet_retcode([]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import unittest
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+
+import eapictl.metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def test_incr(self):
+        metrics = eapictl.metrics.Metrics()
+        metrics.incr('recv_calls')
+        metrics.incr('bytes_received', 200)
+        metrics.incr('bytes_received', 100)
+        self.assertEqual(metrics.counters, dict(recv_calls=1,
+                                                bytes_received=300))
+
+    def test_record(self):
+        metrics = eapictl.metrics.Metrics()
+        metrics.record('command', 0.5)
+        metrics.record('command', 1.5)
+        resp = metrics.todict()['spans']['command']
+        self.assertEqual(resp, dict(count=2, total=2.0, max=1.5))
+
+    def test_span(self):
+        metrics = eapictl.metrics.Metrics()
+        with self.assertRaises(IOError):
+            with metrics.span('command'):
+                raise IOError
+        self.assertEqual(metrics.spans['command'][0], 1)
+
+    def test_prometheus(self):
+        metrics = eapictl.metrics.Metrics()
+        metrics.incr('commands', 2)
+        metrics.record('command', 0.25)
+        resp = metrics.prometheus().split('\n')
+        self.assertIn('eapictl_commands_total 2', resp)
+        self.assertIn('eapictl_span_seconds_count{span="command"} 1', resp)
+        self.assertIn('eapictl_span_seconds_sum{span="command"} 0.25', resp)
+        self.assertIn('eapictl_span_seconds_max{span="command"} 0.25', resp)
+
+    def test_subscribe(self):
+        events = list()
+
+        def hook(*args):
+            events.append(args)
+
+        eapictl.metrics.subscribe(hook)
+        try:
+            metrics = eapictl.metrics.Metrics()
+            metrics.incr('commands')
+            metrics.record('poll', 1.0)
+        finally:
+            eapictl.metrics.unsubscribe(hook)
+        metrics.incr('commands')
+        self.assertEqual(events, [('counter', 'commands', 1),
+                                  ('span', 'poll', 1.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+
+import eapictl.rollout
+
+def worker(failed=()):
+    def run(name):
+        return dict(connection=name, retcode=2 if name in failed else 0,
+                    error=None)
+    return run
+
+class TestRollout(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmpdir, 'rollout.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch_count(self):
+        self.assertEqual(eapictl.rollout.batch_count('5', 100), 5)
+        self.assertEqual(eapictl.rollout.batch_count('10%', 55), 5)
+        self.assertEqual(eapictl.rollout.batch_count('10%', 3), 1)
+        for value in ['0', '0%', '150%', 'many']:
+            with self.assertRaises(ValueError):
+                eapictl.rollout.batch_count(value, 10)
+
+    def test_plan_batches(self):
+        targets = ['veos%02d' % i for i in range(5)]
+        resp = eapictl.rollout.plan_batches(targets, '2')
+        self.assertEqual(resp, [['veos00', 'veos01'], ['veos02', 'veos03'],
+                                ['veos04']])
+
+    def test_run_rollout(self):
+        targets = ['veos%02d' % i for i in range(5)]
+        results, halted = eapictl.rollout.run_rollout(targets, worker(), '2')
+        self.assertFalse(halted)
+        self.assertEqual([r['connection'] for r in results], targets)
+
+    def test_run_rollout_batches_are_sequential(self):
+        running = list()
+
+        def run(name):
+            running.append(name)
+            return dict(connection=name, retcode=0)
+
+        def health(name, result):
+            # every node of the batch has completed before the health check
+            self.assertEqual(len(running) % 2 or 2, 2)
+            return None
+
+        targets = ['veos%02d' % i for i in range(4)]
+        eapictl.rollout.run_rollout(targets, run, '2', parallel=2,
+                                    health=health)
+
+    def test_run_rollout_halts_on_failure_budget(self):
+        targets = ['veos%02d' % i for i in range(6)]
+        results, halted = eapictl.rollout.run_rollout(
+            targets, worker(['veos01', 'veos02']), '2', max_failures=1)
+        self.assertTrue(halted)
+        self.assertEqual([r['connection'] for r in results],
+                         ['veos00', 'veos01', 'veos02', 'veos03'])
+
+    def test_run_rollout_health_failure(self):
+        def health(name, result):
+            return 'down' if name == 'veos00' else None
+
+        results, halted = eapictl.rollout.run_rollout(
+            ['veos00', 'veos01', 'veos02'], worker(), '1', health=health)
+        self.assertTrue(halted)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['retcode'], 2)
+        self.assertEqual(results[0]['error'], 'down')
+
+    def test_run_rollout_stops_workers(self):
+        count = threading.active_count()
+        targets = ['veos%02d' % i for i in range(20)]
+        eapictl.rollout.run_rollout(targets, worker(), '5', parallel=5,
+                                    health=lambda name, result: None)
+        self.assertEqual(threading.active_count(), count)
+
+    def test_run_rollout_health_exception(self):
+        def health(name, result):
+            raise IOError('probe failed')
+
+        results, _ = eapictl.rollout.run_rollout(['veos00'], worker(), '1',
+                                                 health=health)
+        self.assertEqual(results[0]['retcode'], 2)
+
+    def test_run_rollout_resume(self):
+        targets = ['veos%02d' % i for i in range(4)]
+        eapictl.rollout.run_rollout(targets, worker(['veos02']), '2',
+                                    state_file=self.state_file)
+        state = json.load(open(self.state_file))
+        self.assertEqual(state['completed'], ['veos00', 'veos01', 'veos03'])
+
+        results, halted = eapictl.rollout.run_rollout(
+            targets, worker(), '2', state_file=self.state_file)
+        self.assertFalse(halted)
+        self.assertEqual([r['connection'] for r in results], ['veos02'])
+
+    def test_run_rollout_callback(self):
+        streamed = list()
+        results, _ = eapictl.rollout.run_rollout(
+            ['veos00', 'veos01', 'veos02'], worker(['veos01']), '2',
+            max_failures=1, callback=streamed.append)
+        self.assertEqual(results, [0, 2, 0])
+        self.assertEqual([r['connection'] for r in streamed],
+                         ['veos00', 'veos01', 'veos02'])
+
+    def test_load_state_missing(self):
+        resp = eapictl.rollout.load_state(self.state_file)
+        self.assertEqual(resp, dict(completed=[]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import time
+import socket
+import resource
+import unittest
+
+from mock import patch
+
+import eapictl.scan
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.open_port = self.server.getsockname()[1]
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_scan_ports(self):
+        addresses = [('127.0.0.1', self.open_port),
+                     ('127.0.0.1', self.closed_port),
+                     ('host.invalid', 22),
+                     ('127.0.0.1', 'ssh')]
+        start = time.time()
+        resp = eapictl.scan.scan_ports(addresses, timeout=2)
+        self.assertEqual(resp, set([('127.0.0.1', self.open_port)]))
+        self.assertLess(time.time() - start, 2)
+
+    def test_scan_ports_groups(self):
+        addresses = [('127.0.0.1', self.open_port),
+                     ('127.0.0.1', self.closed_port)]
+        original = eapictl.scan.MAX_SOCKETS
+        eapictl.scan.MAX_SOCKETS = 1
+        try:
+            resp = eapictl.scan.scan_ports(addresses)
+        finally:
+            eapictl.scan.MAX_SOCKETS = original
+        self.assertEqual(resp, set([('127.0.0.1', self.open_port)]))
+
+    def test_scan_slow_resolver(self):
+        getaddrinfo = socket.getaddrinfo
+
+        def slow(host, *args):
+            if host == 'slow.invalid':
+                time.sleep(3)
+            return getaddrinfo(host, *args)
+
+        addresses = [('127.0.0.1', self.open_port), ('slow.invalid', 22)]
+        start = time.time()
+        with patch('eapictl.scan.socket.getaddrinfo', side_effect=slow):
+            resp = eapictl.scan.scan_ports(addresses, timeout=0.5)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(resp, set([('127.0.0.1', self.open_port)]))
+
+    def test_scan_high_file_descriptors(self):
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft < 1100:
+            self.skipTest('file descriptor limit too low')
+        files = [open(os.devnull) for _ in range(1030)]
+        try:
+            resp = eapictl.scan.scan_ports([('127.0.0.1', self.open_port)])
+        finally:
+            for handle in files:
+                handle.close()
+        self.assertEqual(resp, set([('127.0.0.1', self.open_port)]))
+
+    def test_classify(self):
+        targets = dict(
+            eapi=('127.0.0.1', self.closed_port, str(self.open_port)),
+            ssh=('127.0.0.1', str(self.open_port), str(self.closed_port)),
+            down=('127.0.0.1', self.closed_port, self.closed_port))
+        resp = eapictl.scan.classify(targets)
+        self.assertEqual(resp, dict(eapi=eapictl.scan.EAPI_LISTENING,
+                                    ssh=eapictl.scan.SSH_ONLY,
+                                    down=eapictl.scan.UNREACHABLE))
+
+
+if __name__ == '__main__':
+    unittest.main()
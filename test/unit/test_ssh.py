@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import unittest
+import threading
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+
+from eosemu import EosEmulator, EapiEmulator
+
+from mock import patch
+
+import eapictl.app
+
+class TestSshEmulator(unittest.TestCase):
+
+    emulator_args = dict()
+
+    def setUp(self):
+        self.emulator = EosEmulator(**self.emulator_args).start()
+        self.sessions = list()
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.emulator.stop()
+
+    def connect(self, cls=eapictl.app.Ssh, **kwargs):
+        session = cls('127.0.0.1', 'admin', '', port=self.emulator.port,
+                      **kwargs)
+        self.sessions.append(session)
+        return session
+
+    def test_status(self):
+        eapi = eapictl.app.Eapi(self.connect())
+        resp = eapi.status()
+        self.assertFalse(resp['enabled'])
+        self.assertEqual(resp['https'], 'enabled')
+        self.assertEqual(resp['http'], 'shutdown')
+
+    def test_start_stop(self):
+        eapi = eapictl.app.Eapi(self.connect())
+        eapictl.app.enable_eapi(eapi, 5)
+        self.assertTrue(eapi.status()['enabled'])
+        self.assertEqual(eapi.status()['https'], 'running')
+        eapictl.app.disable_eapi(eapi, 5)
+        self.assertFalse(eapi.status()['enabled'])
+
+    def test_pipeline_set_protocol(self):
+        eapi = eapictl.app.Eapi(self.connect(pipeline=True))
+        resp = eapi.set_protocol('http', '8080')
+        self.assertEqual(len(resp), 3)
+        status = eapi.status()
+        self.assertEqual(status['http_port'], '8080')
+        self.assertEqual(status['https'], 'shutdown')
+
+    def test_exec_channel(self):
+        eapi = eapictl.app.Eapi(self.connect(eapictl.app.SshExec))
+        eapi.set_protocol('http', '8080')
+        self.assertEqual(eapi.status()['http_port'], '8080')
+
+    def test_metrics(self):
+        ssh = self.connect()
+        eapictl.app.Eapi(ssh).status()
+        spans = ssh.metrics.todict()['spans']
+        for name in ['tcp_connect', 'ssh_handshake', 'shell', 'command']:
+            self.assertIn(name, spans)
+        self.assertGreaterEqual(ssh.metrics.counters['commands'], 2)
+        self.assertGreater(ssh.metrics.counters['bytes_received'], 0)
+
+    def test_run_metrics(self):
+        args = eapictl.app.parse_args(['start', '127.0.0.1', '--no-agent',
+                                       '--no-state', '--server-port',
+                                       str(self.emulator.port),
+                                       '--metrics', 'json'])
+        retcode, output = eapictl.app.run(args)
+        self.assertEqual(retcode, 0)
+        self.assertTrue(json.loads(output[0])['enabled'])
+        metrics = json.loads(output[1])['metrics']
+        self.assertGreater(metrics['counters']['poll_iterations'], 0)
+        self.assertIn('poll', metrics['spans'])
+
+    def test_status_poll_commands(self):
+        ssh = self.connect()
+        eapi = eapictl.app.Eapi(ssh)
+        eapictl.app.enable_eapi(eapi, 5)
+        del self.emulator.device.commands[:]
+        eapi.status(refresh=True)
+        eapi.status(refresh=True)
+        self.assertNotIn('enable', self.emulator.device.commands)
+        self.assertEqual(len(self.emulator.device.commands), 2)
+
+    def test_apply(self):
+        eapi = eapictl.app.Eapi(self.connect())
+        self.assertEqual(eapi.apply('https', '443'), ['no shutdown'])
+        self.assertEqual(eapi.apply('https', '443'), [])
+
+    def test_parallel_sessions(self):
+        ssh = self.connect()
+        eapi = eapictl.app.Eapi(ssh)
+        ssh.parallel(lambda session: eapictl.app.Eapi(session).enable(),
+                     lambda session: session.send_enable(['show version']))
+        self.assertTrue(eapi.status()['enabled'])
+        self.assertEqual(len(self.emulator.transports), 1)
+
+    def test_parallel_overlaps(self):
+        self.emulator.rtt = 0.2
+        ssh = self.connect()
+
+        def status(session):
+            return eapictl.app.Eapi(session).status()
+
+        start = time.time()
+        resp = ssh.parallel(status, status, status)
+        self.assertLess(time.time() - start, 3 * 2 * 0.2)
+        self.assertEqual(len(resp), 3)
+
+    def test_session_close_keeps_transport(self):
+        ssh = self.connect()
+        with ssh.session() as session:
+            session.send('show version')
+        self.assertTrue(ssh.isalive())
+        self.assertIn('Arista', ssh.send_enable(['show version'])[-1])
+
+    def test_session_channel_limit(self):
+        ssh = self.connect(max_channels=1)
+        opened = list()
+
+        def task(session):
+            with ssh.session() as inner:
+                opened.append(inner.shell)
+
+        with ssh.session() as session:
+            assert session.shell is not None
+            thread = threading.Thread(target=task, args=(session,))
+            thread.daemon = True
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            # the blocked session proceeds once the channel is closed
+            session.close_channel()
+            thread.join(5)
+        self.assertEqual(len(opened), 1)
+
+    def test_parallel_exec_channels(self):
+        ssh = self.connect(eapictl.app.SshExec)
+
+        def show(session):
+            return session.send_enable(['show version'])[-1]
+
+        resp = ssh.parallel(show, show)
+        self.assertTrue(all('Arista' in r for r in resp))
+
+    def test_connect_retry(self):
+        sock = eapictl.app.socket.create_connection(('127.0.0.1',
+                                                     self.emulator.port))
+        error = eapictl.app.socket.error('connection reset')
+        with patch('eapictl.app.socket.create_connection',
+                   side_effect=[error, sock]):
+            ssh = self.connect()
+        self.assertEqual(ssh.metrics.counters['connect_retries'], 1)
+
+    def test_auth_failure_not_retried(self):
+        import paramiko
+        with self.assertRaises(paramiko.AuthenticationException):
+            eapictl.app.Ssh('127.0.0.1', 'admin', 'wrong',
+                            port=self.emulator.port, retries=3)
+        self.assertEqual(len(self.emulator.transports), 1)
+
+    def test_command_deadline(self):
+        ssh = self.connect()
+        assert ssh.shell is not None
+        self.emulator.rtt = 1
+        ssh.deadline = time.time() + 0.2
+        start = time.time()
+        with self.assertRaises(IOError):
+            ssh.send_enable(['show version'])
+        self.assertLess(time.time() - start, 0.8)
+
+    def test_stream(self):
+        self.emulator.device.tech_lines = 2000
+        ssh = self.connect()
+        count = 0
+        for count, line in enumerate(ssh.stream('show tech-support',
+                                                enable=True), 1):
+            self.assertEqual(line, 'tech-support line %d' % (count - 1))
+        self.assertEqual(count, 2000)
+        self.assertIn('Arista', ssh.send('show version'))
+
+    def test_exec_stream(self):
+        ssh = self.connect(eapictl.app.SshExec)
+        lines = list(ssh.stream('show tech-support', enable=True))
+        self.assertEqual(len(lines), 1000)
+        with self.assertRaises(eapictl.app.CommandError):
+            list(ssh.stream('show tech-support'))
+
+    def test_config_session(self):
+        eapi = eapictl.app.Eapi(self.connect(), session=True)
+        eapictl.app.run_action(eapi, 'start', 'http', '8080', 5)
+        status = eapi.status(refresh=True)
+        self.assertTrue(status['enabled'])
+        self.assertEqual(status['http_port'], '8080')
+        self.assertEqual(self.emulator.device.commits, 1)
+        self.assertEqual(self.emulator.device.sessions, {})
+
+    def test_config_session_abort(self):
+        ssh = self.connect()
+        with self.assertRaises(eapictl.app.CommandError):
+            ssh.send_session(['management api http-commands', 'no shutdown',
+                              'protocol bogus'])
+        self.assertEqual(self.emulator.device.sessions, {})
+        self.assertTrue(self.emulator.device.shutdown)
+        self.assertIn('Arista', ssh.send_enable(['show version'])[-1])
+
+    def test_commit_timer(self):
+        device = self.emulator.device
+        eapi = eapictl.app.Eapi(self.connect(), commit_timer=1)
+        eapictl.app.run_action(eapi, 'restart', 'http', '8080', 5)
+        self.assertTrue(eapi.status(refresh=True)['enabled'])
+        self.assertEqual(device.commits, 2)
+        self.assertIsNotNone(eapi.pending)
+        # the expired timer restores the configuration before the restart
+        time.sleep(1.5)
+        self.assertTrue(device.shutdown)
+        self.assertEqual(device.protocols['http'], None)
+
+    def test_commit_timer_confirm(self):
+        eapi = eapictl.app.Eapi(self.connect(), commit_timer=1)
+        eapictl.app.run_action(eapi, 'start', 'http', '8080', 5)
+        eapi.confirm()
+        self.assertIsNone(eapi.pending)
+        time.sleep(1.5)
+        self.assertFalse(self.emulator.device.shutdown)
+
+    def test_run_node_rollback(self):
+        args = eapictl.app.parse_args(['start', 'veos01', '--verify',
+                                       '--commit-timer', '1',
+                                       '--transport', 'http',
+                                       '--eapi-port', '1', '--no-agent'])
+        config = dict(host='127.0.0.1', server_port=self.emulator.port,
+                      username='admin', password='')
+        result = eapictl.app.run_node('veos01', config, args)
+        self.assertNotEqual(result['retcode'], 0)
+        self.assertTrue(result['rollback'])
+        self.assertFalse(self.emulator.device.shutdown)
+        time.sleep(1.5)
+        self.assertTrue(self.emulator.device.shutdown)
+
+class TestSshEmulatorText(TestSshEmulator):
+
+    emulator_args = dict(json=False, chunk_size=7, start_delay=0.2)
+
+
+class TestEapiBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = EosEmulator().start()
+        self.eapi = EapiEmulator(device=self.emulator.device).start()
+        self.emulator.device.configure('no shutdown')
+        self.emulator.device.configure('protocol http port %s'
+                                       % self.eapi.port)
+
+    def tearDown(self):
+        self.eapi.stop()
+        self.emulator.stop()
+
+    def run_node(self, action, *argv):
+        args = eapictl.app.parse_args([action, 'veos01', '--backend', 'eapi',
+                                       '--transport', 'http',
+                                       '--eapi-port', str(self.eapi.port),
+                                       '--poll-timeout', '5'] + list(argv))
+        config = dict(host='127.0.0.1', server_port=self.emulator.port,
+                      username='admin', password='')
+        metrics = eapictl.app.Metrics()
+        result = eapictl.app.run_node('veos01', config, args,
+                                      metrics=metrics)
+        return result, metrics
+
+    def test_status_over_eapi(self):
+        result, metrics = self.run_node('status')
+        self.assertEqual(result['retcode'], 0)
+        self.assertEqual(result['status']['http'], 'running')
+        self.assertEqual(result['status']['http_port'], str(self.eapi.port))
+        self.assertEqual(self.emulator.transports, [])
+        self.assertIn('eapi_request', metrics.spans)
+
+    def test_stop_falls_back_to_ssh(self):
+        result, metrics = self.run_node('stop')
+        self.assertEqual(result['retcode'], 0)
+        self.assertFalse(result['status']['enabled'])
+        self.assertTrue(self.emulator.device.shutdown)
+        # the shutdown is sent over eAPI, the status polls then use SSH
+        self.assertIn('shutdown', self.emulator.device.commands)
+        self.assertEqual(metrics.counters['eapi_fallbacks'], 1)
+        self.assertEqual(len(self.emulator.transports), 1)
+
+    def test_protocol_change_over_ssh(self):
+        result, _ = self.run_node('apply', '--eapi-port', '8080')
+        self.assertEqual(result['changes'], ['no protocol https',
+                                             'protocol http port 8080'])
+        self.assertEqual(self.emulator.device.protocols['http'], '8080')
+        self.assertEqual(len(self.emulator.transports), 1)
+
+    def test_eapi_down(self):
+        self.emulator.device.configure('shutdown')
+        result, metrics = self.run_node('status')
+        self.assertFalse(result['status']['enabled'])
+        self.assertEqual(metrics.counters['eapi_fallbacks'], 1)
+
+    def test_reused_client_after_restart(self):
+        client = eapictl.app.EapiClient('http', '127.0.0.1', 'admin', '',
+                                        self.eapi.port)
+        backend = eapictl.app.EapiBackend(client, None, 'veos01')
+        backend.send_enable(['show version'])
+        self.eapi.restart()
+        self.assertEqual(backend.send_enable(['show version']), [''])
+        self.assertNotIn('eapi_fallbacks', backend.metrics.counters)
+        client.close()
+
+    def test_status_json_encoding(self):
+        client = eapictl.app.EapiClient('http', '127.0.0.1', 'admin', '',
+                                        self.eapi.port)
+        backend = eapictl.app.EapiBackend(client, None, 'veos01')
+        output = backend.send_enable(['show management api http-commands '
+                                      '| json'])
+        status = eapictl.app.parse_status_json(output[-1])
+        self.assertEqual(status['http'], 'running')
+        self.assertEqual(status['http_port'], str(self.eapi.port))
+        self.assertEqual(self.eapi.formats, ['json'])
+        client.close()
+
+    def test_command_error(self):
+        client = eapictl.app.EapiClient('http', '127.0.0.1', 'admin', '',
+                                        self.eapi.port)
+        backend = eapictl.app.EapiBackend(client, None, 'veos01')
+        with self.assertRaises(eapictl.app.CommandError):
+            backend.send_enable(['show bogus'])
+
+
+if __name__ == '__main__':
+    unittest.main()
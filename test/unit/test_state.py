@@ -0,0 +1,83 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+import eapictl.state
+
+STATUS = dict(enabled=True, http='shutdown', https='running',
+              https_port=443)
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'cache', 'state.db')
+        self.store = eapictl.state.StateStore(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_and_get(self):
+        self.assertTrue(self.store.record('10.0.0.1', 'veos01', STATUS,
+                                          'start'))
+        resp = self.store.get('10.0.0.1', 'veos01')
+        self.assertEqual(resp['status'], STATUS)
+        self.assertEqual(resp['action'], 'start')
+        self.assertIsNone(resp['applied'])
+        self.assertIsNone(resp['error'])
+        self.assertAlmostEqual(resp['updated'], time.time(), delta=5)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.store.get('10.0.0.1', 'veos01'))
+
+    def test_record_keeps_applied(self):
+        applied = dict(protocol='https', port='443', shutdown=False)
+        self.store.record('10.0.0.1', 'veos01', STATUS, 'apply', applied)
+        self.store.record('10.0.0.1', 'veos01', STATUS, 'status')
+        resp = self.store.get('10.0.0.1', 'veos01')
+        self.assertEqual(resp['action'], 'status')
+        self.assertEqual(resp['applied'], applied)
+
+    def test_records_keyed_by_host_and_profile(self):
+        self.store.record('10.0.0.1', 'veos01', STATUS)
+        self.store.record('10.0.0.2', 'veos01', dict(enabled=False))
+        self.assertTrue(self.store.get('10.0.0.1', 'veos01')['status']
+                        ['enabled'])
+        self.assertFalse(self.store.get('10.0.0.2', 'veos01')['status']
+                         ['enabled'])
+
+    def test_query(self):
+        for name in ['veos02', 'veos01']:
+            self.store.record(name, name, STATUS)
+        resp = self.store.query()
+        self.assertEqual([r['profile'] for r in resp], ['veos01', 'veos02'])
+
+    def test_shared_between_stores(self):
+        self.store.record('10.0.0.1', 'veos01', STATUS)
+        other = eapictl.state.StateStore(self.filename)
+        self.assertEqual(len(other.query()), 1)
+        other.close()
+
+    def test_record_from_threads(self):
+        threads = [threading.Thread(target=self.store.record,
+                                    args=('host%d' % i, 'node%d' % i, STATUS))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.store.query()), 10)
+
+    def test_open_store_failure(self):
+        path = os.path.join(self.tmpdir, 'file')
+        open(path, 'w').close()
+        self.assertIsNone(eapictl.state.open_store(os.path.join(path,
+                                                                'state.db')))
+
+
+if __name__ == '__main__':
+    unittest.main()
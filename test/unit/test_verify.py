@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import unittest
+
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../lib'))
+
+from eosemu import EapiEmulator, EosEmulator
+
+import eapictl.app
+import eapictl.verify
+
+from eapictl.agent import SessionPool
+from eapictl.metrics import Metrics
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = EapiEmulator().start()
+
+    def tearDown(self):
+        self.emulator.stop()
+
+    def client(self, port=None):
+        return eapictl.verify.EapiClient('http', '127.0.0.1', 'admin', '',
+                                         port or self.emulator.port)
+
+    def args(self, action='verify', *extra):
+        return eapictl.app.parse_args([action, '127.0.0.1', '--no-agent',
+                                       '--no-state', '--transport', 'http',
+                                       '--eapi-port',
+                                       str(self.emulator.port)] +
+                                      list(extra))
+
+    def test_verify_eapi(self):
+        client = self.client()
+        metrics = Metrics()
+        resp = eapictl.verify.verify_eapi(client, 5, metrics)
+        client.close()
+        self.assertEqual(resp['requests'], 5)
+        self.assertEqual(resp['version'], '4.15.0F')
+        self.assertEqual(sorted(resp['latency']), ['p50', 'p90', 'p99'])
+        self.assertEqual(metrics.spans['eapi_request'][0], 5)
+
+    def test_client_keeps_connection_open(self):
+        client = self.client()
+        eapictl.verify.verify_eapi(client, 5)
+        client.close()
+        self.assertEqual(self.emulator.requests, 5)
+        self.assertEqual(self.emulator.connections, 1)
+
+    def test_client_reconnects_after_restart(self):
+        client = self.client()
+        eapictl.verify.verify_eapi(client, 1)
+        self.emulator.restart()
+        time.sleep(0.1)
+        self.assertFalse(client.isalive())
+        resp = eapictl.verify.verify_eapi(client, 1)
+        client.close()
+        self.assertEqual(resp['requests'], 1)
+        self.assertEqual(self.emulator.connections, 2)
+
+    def test_client_retries_stale_connection(self):
+        client = self.client()
+        eapictl.verify.verify_eapi(client, 1)
+        self.emulator.restart()
+        time.sleep(0.1)
+        # the request is sent on the closed connection first
+        self.assertEqual(eapictl.verify.verify_eapi(client, 2)['requests'], 2)
+        client.close()
+        self.assertEqual(self.emulator.requests, 3)
+
+    def test_client_closed_on_error(self):
+        self.emulator.stop()
+        client = self.client()
+        with self.assertRaises(Exception):
+            eapictl.verify.verify_eapi(client, 1)
+        self.assertFalse(client.isalive())
+        self.emulator.start()
+
+    def test_run_verify(self):
+        retcode, output = eapictl.app.run(self.args())
+        self.assertEqual(retcode, 0)
+        resp = json.loads(output[0])['verify']
+        self.assertEqual(resp['requests'],
+                         eapictl.verify.DEFAULT_VERIFY_REQUESTS)
+
+    def test_run_verify_failed(self):
+        args = self.args()
+        args.eapi_port = '1'
+        retcode, output = eapictl.app.run(args)
+        self.assertEqual(retcode, 2)
+        self.assertTrue(output[0].startswith('Error: eAPI verification '
+                                             'failed'))
+
+    def test_run_verify_pooled(self):
+        sessions = SessionPool()
+        for _ in range(3):
+            retcode, _ = eapictl.app.run(self.args(), sessions)
+            self.assertEqual(retcode, 0)
+        sessions.close()
+        self.assertEqual(self.emulator.connections, 1)
+
+    def test_start_verify(self):
+        emulator = EosEmulator().start()
+        try:
+            args = self.args('start', '--verify', '--server-port',
+                             str(emulator.port))
+            retcode, output = eapictl.app.run(args)
+        finally:
+            emulator.stop()
+        self.assertEqual(retcode, 0)
+        self.assertTrue(json.loads(output[0])['enabled'])
+        self.assertIn('latency', json.loads(output[1])['verify'])
+
+
+if __name__ == '__main__':
+    unittest.main()